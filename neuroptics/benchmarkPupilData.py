@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the NeurOptics scripts on a synthetic cohort generated by
+simulatePupilData.py. Stages are timed separately, each over all subjects:
+    parse: read exports, join continued lines, split records by task and
+        build record tables (parsePupilData up to create_*_df and sort_time)
+    expand: expand Pupil Profile into one column per time point
+        (create_plr_file, create_task_file)
+    write: save parsed csv files
+    missing_timestamps: check_missing_timestamps.main
+    template_DS, template_PLR: createPupilTemplate.main
+Wall time (s) of each stage is reported, and with --memory also peak memory
+(MB, Python and numpy allocations traced with tracemalloc). Tracing slows
+down pandas considerably, so times of runs with and without --memory should
+not be compared. Timings can be saved and later runs compared against them
+as a baseline.
+
+Usage:
+    python benchmarkPupilData.py [--subjects 100] [--memory] [--save timings.csv] [--baseline timings.csv]
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+import pandas as pd
+import parsePupilData
+import check_missing_timestamps
+import createPupilTemplate
+import simulatePupilData
+
+TASK_PARSERS = {'PLR': (parsePupilData.create_plr_df, parsePupilData.create_plr_file),
+                'DS': (parsePupilData.create_task_df, parsePupilData.create_task_file),
+                'CFREC': (parsePupilData.create_task_df, parsePupilData.create_task_file)}
+
+
+def parse_records(filelist):
+    """Record tables of each task of each file, sorted by time."""
+    parsed = []
+    for filename in filelist:
+        lines = parsePupilData.join_multilines(parsePupilData.clean_text(parsePupilData.read_file(filename)))
+        sublists = parsePupilData.get_task_lists(parsePupilData.split_trial_lists(lines))
+        for task, tasklists in zip(['PLR', 'DS', 'CFREC'], sublists):
+            if len(tasklists) == 0:
+                continue
+            df = TASK_PARSERS[task][0](tasklists)
+            if task == 'PLR':
+                df.columns = df.columns.str.replace('C. Lat', 'Lat')
+            parsed.append((task, parsePupilData.sort_time(df, 'Time')))
+    return parsed
+
+
+def expand_profiles(parsed):
+    return [(task, TASK_PARSERS[task][1](df)) for task, df in parsed]
+
+
+def write_parsed(expanded, outdir):
+    for task, df in expanded:
+        subid = parsePupilData.get_subid(df)
+        df.to_csv(os.path.join(outdir, subid + '_Pupil_' + task + '_Parsed_benchmark.csv'), index=False)
+
+
+def get_stages(filelist, behavfile, workdir, fmt='xlsx'):
+    """Stages as (name, function of previous result) run in order."""
+    parseddir = os.path.join(workdir, 'parsed')
+    outdir = os.path.join(workdir, 'out')
+    for d in [parseddir, outdir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    parsedfiles = lambda task: sorted(f for f in os.listdir(parseddir) if '_%s_' % task in f)
+    return [('parse', lambda _: parse_records(filelist)),
+            ('expand', expand_profiles),
+            ('write', lambda expanded: write_parsed(expanded, parseddir)),
+            ('missing_timestamps', lambda _: check_missing_timestamps.main(parseddir, behavfile, outdir))] + \
+           [('template_' + task,
+             lambda _, task=task: createPupilTemplate.main(
+                 outdir, behavfile, [os.path.join(parseddir, f) for f in parsedfiles(task)],
+                 task=task, fmt=fmt))
+            for task in ['DS', 'PLR']]
+
+
+def run_stages(stages, memory=False):
+    """Run stages in order, passing on the result of each stage. Returns
+    dataframe of wall time (s) and, if memory is True, peak traced memory
+    (MB) of each stage."""
+    timings = []
+    result = None
+    if memory:
+        tracemalloc.start()
+    try:
+        for name, stage in stages:
+            if memory:
+                tracemalloc.reset_peak()
+                start_mem = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            result = stage(result)
+            timing = {'Stage': name, 'Seconds': time.perf_counter() - start}
+            if memory:
+                timing['PeakMB'] = (tracemalloc.get_traced_memory()[1] - start_mem) / 1e6
+            timings.append(timing)
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return pd.DataFrame(timings)
+
+
+def run_benchmark(workdir, nsubjects=100, repeat=1, fmt='xlsx', memory=False, seed=0):
+    """Generate cohort in workdir and return best time and peak memory of
+    each stage over repeat runs."""
+    rawdir = os.path.join(workdir, 'raw')
+    if not os.path.isdir(rawdir):
+        os.makedirs(rawdir)
+    start = time.perf_counter()
+    filelist, behavfile = simulatePupilData.make_cohort(rawdir, nsubjects=nsubjects, seed=seed)
+    print('Generated {0} exports in {1:.1f}s'.format(len(filelist), time.perf_counter() - start))
+    runs = [run_stages(get_stages(filelist, behavfile, workdir, fmt=fmt), memory=memory)
+            for _ in range(repeat)]
+    return pd.concat(runs).groupby('Stage', sort=False).min().reset_index()
+
+
+def compare_baseline(timings, baselinefile):
+    """Add baseline time and ratio of current to baseline time."""
+    baseline = pd.read_csv(baselinefile).set_index('Stage')
+    timings = timings.copy()
+    timings['Baseline'] = timings['Stage'].map(baseline['Seconds'])
+    timings['Ratio'] = timings['Seconds'] / timings['Baseline']
+    return timings
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="""Time parsing and
+                                     processing of synthetic NeurOptics
+                                     exports.""")
+    parser.add_argument('--subjects', type=int, default=100, help='Number of subjects.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of runs; best time of each stage is reported.')
+    parser.add_argument('-f', '--format', choices=['xlsx', 'csv', 'parquet'], default='xlsx',
+                        help='Template file format.')
+    parser.add_argument('--memory', action='store_true',
+                        help='Also report peak memory of each stage (slower).')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory for synthetic files and outputs (default: temporary, removed).')
+    parser.add_argument('--save', default=None, help='Save timings to csv file.')
+    parser.add_argument('--baseline', default=None, help='Compare with timings saved by --save.')
+    args = parser.parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pupil_benchmark_')
+    try:
+        timings = run_benchmark(workdir, nsubjects=args.subjects, repeat=args.repeat,
+                                fmt=args.format, memory=args.memory)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+    if args.save:
+        timings.to_csv(args.save, index=False)
+    if args.baseline:
+        timings = compare_baseline(timings, args.baseline)
+    with pd.option_context('display.width', 120, 'display.precision', 3):
+        print(timings.to_string(index=False))
@@ -22,8 +22,21 @@ import argparse
 import string
 from datetime import datetime
 import itertools
-import Tkinter,tkFileDialog
 from glob import glob
+try:
+    # for Python2
+    import Tkinter as tkinter
+    import tkFileDialog as filedialog
+except ImportError:
+    # for Python3
+    import tkinter
+    from tkinter import filedialog
+# Shared readers live alongside the Tobii scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tobii'))
+import pupil_io
+
+# Only columns needed to match pupillometer times against the database
+PUPILTIME_COLS = ['Subject ID', 'Date', 'Time', 'Measurement Duration']
 
 
 def rotate(strg,n):
@@ -38,26 +51,20 @@ def get_pupil_files(indir, pttrn='*_Pupil_*Parsed_*.csv'):
     return filelist
 
 
-def merge_parsed_files(infiles):
-    """Loop through pupil files, load, and append to dataframe"""
-    pupildf_list = []
-    for infile in infiles:
-        print("Loading {}".format(infile))
-        # Load parsed pupil data
-        subjdf = pd.read_csv(infile, sep=",")
-        # Append to list
-        pupildf_list.append(subjdf)
-    # Merge individual files
-    pupildf = pd.concat(pupildf_list, sort=False)
+def merge_parsed_files(infiles, usecols=PUPILTIME_COLS):
+    """Load parsed pupil files concurrently and concatenate into one dataframe.
+    Only columns in usecols are read."""
+    pupildf = pupil_io.read_csv_files(infiles, usecols=usecols,
+                                      dtype=pupil_io.parsed_pupil_dtypes,
+                                      verbose=True)
     return pupildf
 
 
 def get_pupil_times(pupildf):
     """Get timestamp and data columns from pupillometer file"""
     pupilcols = ['Subject ID', 'Date', 'Time', 'Measurement Duration']
-    pupiltime = pupildf[pupilcols]
-    pupiltime.rename(columns={"Subject ID":"vetsaid"}, inplace=True)
-    pupiltime.loc[:,'Date'] = pd.to_datetime(pupiltime['Date'])
+    pupiltime = pupildf[pupilcols].rename(columns={"Subject ID":"vetsaid"})
+    pupiltime['Date'] = pd.to_datetime(pupiltime['Date'])
     return pupiltime.sort_values(by=['vetsaid', 'Date', 'Time'])
 
 
@@ -74,7 +81,7 @@ def get_practice_mask(x):
 def drop_plr_practice(pupiltime):
     """Mask out the PLR practice trial by dropping the first trial of 
     5 sec duration"""
-    pupilgrp = pupiltime.groupby(['vetsaid','Date','Measurement Duration'])['Measurement Duration']
+    pupilgrp = pupiltime.groupby(['vetsaid','Date','Measurement Duration'], observed=True)['Measurement Duration']
     mask = pupilgrp.transform(get_practice_mask).astype(bool)
     return pupiltime[mask]
 
@@ -93,7 +100,7 @@ def get_behav_times(behavdf):
     behavdflong['TIM'].replace(999999,np.nan, inplace=True)
     behavdflong = behavdflong.dropna(axis=0)    
     # Get rid of decimal and convert to string
-    behavdflong['TIM'] = behavdflong['TIM'].astype(str).str.replace("\.0","").str.zfill(6)
+    behavdflong['TIM'] = behavdflong['TIM'].astype(str).str.replace(r"\.0$", "", regex=True).str.zfill(6)
     # Convert to timestamp
     behavdflong['Time'] = behavdflong['TIM'].str[:2] + ":" + behavdflong['TIM'].str[2:4] + ":" + behavdflong['TIM'].str[4:]
     behavdflong["Date"] = behavdflong["Date"].str.split(":").str[0]
@@ -132,25 +139,25 @@ def main(indir, behav, outdir):
     outfile = os.path.join(outdir, fname)
     try:
         missingdf.to_csv(outfile, index=False)
-        print "Missing timestamp list saved successfully" 
+        print("Missing timestamp list saved successfully")
     except IOError:
-        print "Missing timestamp list could not be saved"
+        print("Missing timestamp list could not be saved")
         
         
     
 if __name__ == '__main__':
 
-    root = Tkinter.Tk()
+    root = tkinter.Tk()
     root.withdraw()
 
     # Select parsed pupil data files
-    indir = tkFileDialog.askdirectory(parent=root,initialdir=os.getcwd(),
+    indir = filedialog.askdirectory(parent=root,initialdir=os.getcwd(),
                                       title='Please select input directory containing parsed pupil data')
     # Select file with behavioral info
-    behav = tkFileDialog.askopenfilename(parent=root,
+    behav = filedialog.askopenfilename(parent=root,
                                          title='Choose behavioral performance file')    
     # Select output directory to save out to
-    outdir = tkFileDialog.askdirectory(parent=root,initialdir=os.getcwd(), 
+    outdir = filedialog.askdirectory(parent=root,initialdir=os.getcwd(), 
                                        title='Please select output directory')
     # Run script
     main(indir, behav, outdir)
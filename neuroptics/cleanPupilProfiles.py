@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Applies the Tobii preprocessing chain (blink detection, smoothing, gap
+interpolation and low-pass filtering from pupil_utils) to the digit span
+(15 s, 450 samples) and category fluency/recognition (25 s, 750 samples)
+profiles in files created by parsePupilData.py.
+
+All records of a task are cleaned together as one (records x samples) matrix.
+Output has one row per record with the record info, the fraction of samples
+flagged as blinks (BlinkPct) and interpolated (InterpPct), and the cleaned
+profile in the same columns as the parsed files.
+"""
+
+import os, sys
+import numpy as np
+import pandas as pd
+from datetime import datetime
+try:
+    # for Python2
+    import Tkinter as tkinter
+    import tkFileDialog as filedialog
+except ImportError:
+    # for Python3
+    import tkinter
+    from tkinter import filedialog
+# Shared readers and preprocessing live alongside the Tobii scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tobii'))
+import pupil_io
+import pupil_utils
+
+# NeurOptics profiles are sampled at 30Hz
+SAMPLE_RATE = 30.
+TASKS = ['DS', 'CFREC']
+
+
+def get_task_files(infiles, task):
+    """Select parsed files for a given task based on filename."""
+    return [f for f in infiles if '_Pupil_{}_'.format(task) in os.path.basename(f)]
+
+
+def clean_profiles(pupildf, **kwargs):
+    """Clean all profiles in a dataframe of parsed records. Returns record
+    info, quality fractions, and cleaned profiles."""
+    profcols = [col for col in pupildf.columns if pupil_io.is_profile_col(col)]
+    infocols = [col for col in pupildf.columns if col not in profcols]
+    cleaned, quality = pupil_utils.clean_matrix(pupildf[profcols].to_numpy(),
+                                                fs=SAMPLE_RATE, **kwargs)
+    cleandf = pd.DataFrame(cleaned.astype(np.float32), columns=profcols)
+    return pd.concat([pupildf[infocols].reset_index(drop=True), quality, cleandf], axis=1)
+
+
+def main(infiles, outdir, filt_type='low'):
+    timestamp = datetime.now().strftime("%Y%m%d")
+    for task in TASKS:
+        taskfiles = get_task_files(infiles, task)
+        if len(taskfiles) == 0:
+            continue
+        pupildf = pupil_io.read_csv_files(taskfiles, dtype=pupil_io.parsed_pupil_dtypes)
+        cleandf = clean_profiles(pupildf, filt_type=filt_type)
+        outfile = os.path.join(outdir, task + '_Cleaned_' + timestamp + '.csv')
+        try:
+            cleandf.to_csv(outfile, index=False)
+            print("Cleaned {0} profiles saved to {1}".format(task, outfile))
+        except IOError:
+            print("Cleaned {0} profiles could not be saved".format(task))
+
+
+if __name__ == '__main__':
+
+    root = tkinter.Tk()
+    root.withdraw()
+    # Select parsed DS and CFREC files
+    infiles = filedialog.askopenfilenames(parent=root,title='Choose parsed DS and/or CFREC files')
+    infiles = list(infiles)
+    # Select output directory to save out to
+    outdir = filedialog.askdirectory(parent=root,initialdir=os.getcwd(), title='Please select output directory')
+    # Run script
+    main(infiles, outdir)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Recomputes pupil light reflex (PLR) metrics from the 150 point pupil profiles
+in files created by parsePupilData.py, rather than relying on the values
+reported by the pupillometer. All records are processed at once as array
+operations along the time axis so definitions are consistent across waves and
+devices.
+
+Metrics (diameters in mm, times in s, velocities in mm/s):
+    Init: diameter at stimulus onset (mean of pre-stimulus samples if present)
+    Min: minimum diameter after stimulus onset
+    Amplitude: Init - Min
+    ConstrictionPct: Amplitude / Init
+    Latency: time from stimulus onset to start of constriction, taken as the
+        point of maximal constriction acceleration before Min
+    MaxConstrictionVel: peak velocity between Latency and Min (negative)
+    MeanConstrictionVel: average velocity between Latency and Min (negative)
+    DilationVel: average velocity from Min until 75% recovery (or end of
+        profile if the pupil does not recover)
+    Recovery75: time from Min until the pupil recovers 75% of Amplitude
+"""
+
+import os, sys
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from scipy.ndimage import uniform_filter1d
+try:
+    # for Python2
+    import Tkinter as tkinter
+    import tkFileDialog as filedialog
+except ImportError:
+    # for Python3
+    import tkinter
+    from tkinter import filedialog
+# Shared readers live alongside the Tobii scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tobii'))
+import pupil_io
+
+# Record level columns carried over to output, including device reported
+# metrics for comparison.
+INFO_COLS = ['Subject ID', 'Date', 'Time', 'Device ID', 'Eye Measured',
+             'Record ID', 'Diameter', 'Mean/Max C. Vel', 'dilation velocity',
+             'Lat', '75% recovery time']
+
+
+def get_profile_matrix(pupildf):
+    """Return pupil profiles as (records x timepoints) float matrix and the
+    vector of timepoints in seconds."""
+    profcols = [col for col in pupildf.columns if pupil_io.is_profile_col(col)]
+    times = np.array([float(col) for col in profcols])
+    profiles = pupildf[profcols].to_numpy(dtype=np.float64)
+    return profiles, times
+
+
+def take_along(x, idx):
+    """Select one value per row of x given column indices."""
+    return np.take_along_axis(x, idx[:, None], axis=1)[:, 0]
+
+
+def plr_metrics(profiles, times, onset=0., smooth=3, recovery=.75):
+    """Compute PLR metrics for every record in profiles (records x timepoints).
+        times: timepoint of each column in seconds
+        onset: time of light stimulus in seconds
+        smooth: width of moving average (in samples) applied before taking
+            derivatives
+        recovery: fraction of constriction amplitude used for recovery time
+    Returns a dataframe with one row per record."""
+    profiles = np.atleast_2d(profiles)
+    nrec, npts = profiles.shape
+    valid = ~np.all(np.isnan(profiles), axis=1)
+    diam = uniform_filter1d(profiles, size=smooth, axis=1, mode='nearest')
+    velocity = np.gradient(diam, times, axis=1)
+    accel = np.gradient(velocity, times, axis=1)
+    colidx = np.arange(npts)
+    post = times >= onset
+    # Initial diameter from pre-stimulus samples, or first sample at onset.
+    # Taken from the smoothed profiles, as peak constriction, so amplitude
+    # is not biased by smoothing.
+    if (~post).any():
+        init = np.nanmean(diam[:, ~post], axis=1)
+    else:
+        init = diam[:, 0]
+    # Peak constriction after stimulus onset
+    idx_min = np.argmin(np.where(post & ~np.isnan(diam), diam, np.inf), axis=1)
+    dmin = take_along(diam, idx_min)
+    amplitude = init - dmin
+    # Constriction onset is the point of maximal constriction acceleration
+    constricting = post & (colidx[None, :] <= idx_min[:, None])
+    idx_lat = np.argmin(np.where(constricting & ~np.isnan(accel), accel, np.inf), axis=1)
+    t_lat = times[idx_lat]
+    t_min = times[idx_min]
+    constricting &= colidx[None, :] >= idx_lat[:, None]
+    maxcvel = np.min(np.where(constricting, velocity, np.inf), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meancvel = (dmin - take_along(diam, idx_lat)) / (t_min - t_lat)
+    # Recovery after peak constriction
+    target = dmin + recovery * amplitude
+    recovered = (colidx[None, :] > idx_min[:, None]) & (diam >= target[:, None])
+    has_rec = recovered.any(axis=1)
+    idx_rec = np.where(has_rec, np.argmax(recovered, axis=1), npts - 1)
+    t_rec = times[idx_rec]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dilvel = (take_along(diam, idx_rec) - dmin) / (t_rec - t_min)
+    recovery_time = np.where(has_rec, t_rec - t_min, np.nan)
+    metrics = pd.DataFrame({'Init': init,
+                            'Min': dmin,
+                            'Amplitude': amplitude,
+                            'ConstrictionPct': amplitude / init,
+                            'Latency': t_lat - onset,
+                            'MaxConstrictionVel': maxcvel,
+                            'MeanConstrictionVel': meancvel,
+                            'DilationVel': dilvel,
+                            'Recovery75': recovery_time})
+    metrics = metrics.replace([np.inf, -np.inf], np.nan)
+    metrics.loc[~valid, :] = np.nan
+    return metrics
+
+
+def proc_plr_data(pupildf, **kwargs):
+    """Compute metrics for all PLR records and attach record info."""
+    profiles, times = get_profile_matrix(pupildf)
+    metrics = plr_metrics(profiles, times, **kwargs)
+    infocols = [col for col in INFO_COLS if col in pupildf.columns]
+    return pd.concat([pupildf[infocols].reset_index(drop=True), metrics], axis=1)
+
+
+def main(infiles, outdir, **kwargs):
+    pupildf = pupil_io.read_csv_files(infiles, dtype=pupil_io.parsed_pupil_dtypes)
+    metricsdf = proc_plr_data(pupildf, **kwargs)
+    timestamp = datetime.now().strftime("%Y%m%d")
+    outfile = os.path.join(outdir, 'PLR_Metrics_' + timestamp + '.csv')
+    try:
+        metricsdf.to_csv(outfile, index=False)
+        print("PLR metrics saved to {}".format(outfile))
+    except IOError:
+        print("PLR metrics could not be saved")
+
+
+if __name__ == '__main__':
+
+    root = tkinter.Tk()
+    root.withdraw()
+    # Select parsed PLR files
+    infiles = filedialog.askopenfilenames(parent=root,title='Choose parsed PLR files (*_Pupil_PLR_Parsed_*.csv)')
+    infiles = list(infiles)
+    # Select output directory to save out to
+    outdir = filedialog.askdirectory(parent=root,initialdir=os.getcwd(), title='Please select output directory')
+    # Run script
+    main(infiles, outdir)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Dec  2 14:08:17 2016
+
+@author: jelman
+
+Creates the template file for Digit Span (DS) or Pupil Light Reflex (PLR)
+processing. Pupil data parsed by parsePupilData.py are matched to trial times
+and scan quality from the behavioral database. Min, Max and the data point
+columns are computed on the float matrix of pupil profiles.
+
+Templates are written as xlsx with a streaming (write-only) writer. csv and
+parquet (requires pyarrow) are faster alternatives for large waves.
+"""
+
+import os, sys
+import pandas as pd
+import numpy as np
+import argparse
+import string
+from datetime import datetime
+try:
+    # for Python2
+    import Tkinter as tkinter
+    import tkFileDialog as filedialog
+except ImportError:
+    # for Python3
+    import tkinter
+    from tkinter import filedialog
+# Shared readers live alongside the Tobii scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tobii'))
+import pupil_io
+import pupil_quality
+
+
+# Trials are excluded if scan quality is not good (SCN != 1) or the subject's
+# pupil z-score is above 2 or missing
+EXCLUSION_RULES = {'DS': [('SCN', '!=', 1), ('ZPUPILLRDS', '>', 2), ('ZPUPILLRDS', 'missing', None)],
+                   'PLR': [('SCN', '!=', 1), ('ZPUPILLR', '>', 2), ('ZPUPILLR', 'missing', None)]}
+
+
+def rotate(strg,n):
+    """ Create function to rotate characters in a string from front to back"""
+    return strg[n:] + strg[:n]
+
+
+def load_behav(behav_file):
+    """Load behavioral data with trial times and scan quality"""
+    behavdf = pd.read_csv(behav_file, sep=",")
+    behavdf.columns = behavdf.columns.str.replace("_v2","")
+    if 'DSTIM' in behavdf.columns:
+        behavdf = behavdf.drop(columns="DSTIM")
+    if 'SUBJECTID' in behavdf.columns:
+        behavdf = behavdf.rename(columns={"SUBJECTID":"vetsaid"})
+    return behavdf
+
+
+def format_trial_time(behavdflong):
+    """Get rid of decimal and convert to HH:MM:SS string"""
+    behavdflong['TIM'] = behavdflong['TIM'].astype(str).str.replace(r"\.0$", "", regex=True).str.zfill(6)
+    behavdflong.loc[behavdflong['TIM'].str.contains("nan"),'TIM'] = np.nan
+    behavdflong['Pupil Trial Time'] = behavdflong['TIM'].str[:2] + ":" + behavdflong['TIM'].str[2:4] + ":" + behavdflong['TIM'].str[4:]
+    return behavdflong
+
+
+def proc_behav_ds(behav_file):
+    behavdf = load_behav(behav_file)
+    # Select columns of interest
+    dstcols = [col for col in behavdf.columns if ("DST" in col) & (("SCN" in col) or ("TIM" in col))]
+    behavdf = behavdf[["vetsaid","ZPUPILLRDS"]+dstcols]
+    # Rotate variable names to make it easier to go from wide format to long
+    behavdf.columns = [rotate(col, -3) if col in dstcols else col for col in behavdf.columns]
+    # Convert from wide to long format
+    behavdflong = pd.wide_to_long(behavdf, stubnames=["TIM","SCN"], i="vetsaid", j="Trial #", suffix=r"\w+").reset_index()
+    behavdflong['TIM'] = behavdflong['TIM'].replace(999999, np.nan)
+    # Strip string from trial number and convert to int so it will sort in numerical order
+    behavdflong["Trial #"] = behavdflong["Trial #"].str.replace("DST","").astype(int)
+    # Sort by subject id
+    behavdflong = behavdflong.sort_values(by=["vetsaid","Trial #"])
+    # Rename subject ID field
+    behavdflong = behavdflong.rename(columns={"vetsaid":"ID"})
+    behavdflong = format_trial_time(behavdflong)
+    # Create Task field
+    behavdflong['Task (DS)'] = 'DS' + behavdflong['Trial #'].astype(str)
+    # Make sure all subjects have 12 rows
+    assert (behavdflong.groupby('ID')['ID'].count()==12).all()
+    bxtrialnames = [''.join(['S',i]) for i in np.repeat(['3','6','9'], 4)]
+    behavdflong['Bx Trial'] = bxtrialnames * behavdflong.ID.nunique()
+    # Specify bad data trials and filter out unacquired trials
+    behavdflong = behavdflong.dropna(axis=0, subset=["Pupil Trial Time"])
+    behavdflong = behavdflong.loc[~pupil_quality.get_exclusions(behavdflong, EXCLUSION_RULES['DS'])]
+    bxtrialletts = behavdflong.groupby(['ID','Bx Trial']).cumcount().map(lambda i: string.ascii_lowercase[i])
+    behavdflong['Bx Trial'] = behavdflong['Bx Trial'] + bxtrialletts
+    return behavdflong
+
+
+def proc_behav_plr(behav_file):
+    behavdf = load_behav(behav_file)
+    # Select columns of interest
+    lrtcols = [col for col in behavdf.columns if ("LRT" in col) & (("SCN" in col) or ("TIM" in col))]
+    behavdf = behavdf[["vetsaid", "ZPUPILLR"]+lrtcols]
+    # Rotate variable names to make it easier to go from wide format to long
+    behavdf.columns = [rotate(col, -3) if col in lrtcols else col for col in behavdf.columns]
+    behavdf.columns = behavdf.columns.str.replace("LRT","PLR")
+    # Convert from wide to long format
+    behavdflong = pd.wide_to_long(behavdf, stubnames=["TIM","SCN"], i="vetsaid", j="Trial #", suffix=r"\w+").reset_index()
+    behavdflong['TIM'] = behavdflong['TIM'].replace(999999, np.nan)
+    behavdflong['SCN'] = behavdflong['SCN'].replace(9, np.nan)
+    # Strip string from trial number and convert to int so it will sort in numerical order
+    behavdflong["Trial #"] = behavdflong["Trial #"].str.replace("PLR","").astype(int)
+    # Sort by subject id
+    behavdflong = behavdflong.sort_values(by=["vetsaid","Trial #"])
+    # Rename subject ID field
+    behavdflong = behavdflong.rename(columns={"vetsaid":"ID"})
+    behavdflong = format_trial_time(behavdflong)
+    # Create Task field
+    behavdflong['Task (PLR)'] = 'PLR' + behavdflong['Trial #'].astype(str)
+    # Make sure all subjects have 10 rows
+    assert (behavdflong.groupby('ID')['ID'].count()==10).all()
+    # Specify bad data trials and filter out unacquired trials
+    behavdflong = behavdflong.dropna(axis=0, subset=["Pupil Trial Time"])
+    behavdflong = behavdflong.loc[~pupil_quality.get_exclusions(behavdflong, EXCLUSION_RULES['PLR'])]
+    bxtrialletts = behavdflong.groupby('ID').cumcount().map(lambda i: string.ascii_lowercase[i])
+    behavdflong['Bx Trial'] = 'S' + bxtrialletts
+    return behavdflong
+
+
+# Task specific behavioral processing, template columns and number of data
+# points of each profile (as asserted by parsePupilData.py)
+TASKS = {'DS': {'proc_behav': proc_behav_ds, 'taskcol': 'Task (DS)', 'npoints': 450},
+         'PLR': {'proc_behav': proc_behav_plr, 'taskcol': 'Task (PLR)', 'npoints': 150}}
+
+
+def use_template_col(col):
+    """Template only needs ID, trial time, and pupil profile columns."""
+    return col in ['Subject ID', 'Time'] or pupil_io.is_profile_col(col)
+
+
+def check_parsed_files(infiles, task):
+    """Raise if any parsed file does not have the profile width of task, e.g.
+    CFREC files given for a DS template. Only headers are read."""
+    npoints = TASKS[task]['npoints']
+    badfiles = []
+    for infile in infiles:
+        header = pd.read_csv(infile, nrows=0).columns
+        if sum(pupil_io.is_profile_col(col) for col in header) != npoints:
+            badfiles.append(os.path.basename(infile))
+    if badfiles:
+        raise Exception('Expected {0} data points per {1} profile, wrong width in: {2}'.format(
+            npoints, task, ', '.join(badfiles)))
+
+
+def merge_parsed_files(infiles):
+    """Load parsed pupil files concurrently and concatenate into one dataframe."""
+    pupildf = pupil_io.read_csv_files(infiles, usecols=use_template_col,
+                                      dtype=pupil_io.parsed_pupil_dtypes)
+    return pupildf
+
+
+def proc_pupil_data(pupildf):
+    """Split parsed pupil data into trial info and a float matrix of pupil
+    profiles (trials x data points). Min and Max of each profile are added
+    to the trial info."""
+    profcols = [col for col in pupildf.columns if pupil_io.is_profile_col(col)]
+    pupilmat = pupildf[profcols].to_numpy(dtype=np.float32)
+    trialdf = pupildf.drop(columns=profcols)
+    trialdf = trialdf.rename(columns={"Subject ID":"ID", "Time":"Pupil Trial Time"})
+    trialdf['ID'] = trialdf['ID'].astype(str)
+    # fmin/fmax ignore missing data points without warning on empty profiles
+    trialdf['Min'] = np.fmin.reduce(pupilmat, axis=1)
+    trialdf['Max'] = np.fmax.reduce(pupilmat, axis=1)
+    datacolnames = [str(x +1) + 'st data pt' for x in range(pupilmat.shape[1])]
+    return trialdf, pupilmat, datacolnames
+
+
+def create_template(behavdflong, trialdf, pupilmat, datacolnames, task):
+    """Match behavioral trials to pupil trials and attach pupil profiles."""
+    trialdf = trialdf.assign(row=np.arange(trialdf.shape[0]))
+    mergeddf = behavdflong.merge(trialdf, how="inner", on=["ID","Pupil Trial Time"])
+    infocols = ['ID', TASKS[task]['taskcol'], 'Pupil Trial Time', 'Trial #',
+                'Bx Trial', 'Min', 'Max']
+    datadf = pd.DataFrame(pupilmat[mergeddf['row'].to_numpy()], columns=datacolnames)
+    templatedf = pd.concat([mergeddf[infocols].reset_index(drop=True), datadf], axis=1)
+    return templatedf
+
+
+def write_xlsx(df, outfile, chunksize=1000):
+    """Write dataframe to xlsx using openpyxl write-only mode. Rows are
+    streamed to disk in chunks rather than building the full workbook in
+    memory."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(list(df.columns))
+    for start in range(0, df.shape[0], chunksize):
+        chunk = df.iloc[start:start+chunksize].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        for row in chunk.itertuples(index=False, name=None):
+            ws.append(row)
+    wb.save(outfile)
+
+
+def write_template(templatedf, outfile, fmt='xlsx'):
+    """Save template as xlsx, csv, or parquet."""
+    if fmt == 'xlsx':
+        write_xlsx(templatedf, outfile)
+    elif fmt == 'csv':
+        templatedf.to_csv(outfile, index=False)
+    elif fmt == 'parquet':
+        templatedf.to_parquet(outfile, index=False)
+    else:
+        raise ValueError('Unknown output format: {}'.format(fmt))
+
+
+def main(outdir, behav, infiles, task='DS', fmt='xlsx'):
+    # Process behavioral data
+    behavdflong = TASKS[task]['proc_behav'](behav)
+    # Merge all parsed pupil files
+    check_parsed_files(infiles, task)
+    pupildf = merge_parsed_files(infiles)
+    # Process pupil data
+    trialdf, pupilmat, datacolnames = proc_pupil_data(pupildf)
+    # Merge data and select columns
+    templatedf = create_template(behavdflong, trialdf, pupilmat, datacolnames, task)
+    # Save out template file
+    timestamp = datetime.now().strftime("%Y%m%d")
+    fname = task + '_Template_' + timestamp + '.' + fmt
+    outfile = os.path.join(outdir, fname)
+    write_template(templatedf, outfile, fmt=fmt)
+    print('Template saved to {}'.format(outfile))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="""This is a script to create
+                                     template file for Digit Span or Pupil
+                                     Light Reflex processing. Any paths not
+                                     given are selected from a dialog.""")
+    parser.add_argument('task', choices=sorted(TASKS.keys()),
+                        help='Task to create template for.')
+    parser.add_argument('-o', '--outdir', type=str,
+                        help='Directory to save output file.')
+    parser.add_argument('-b', '--behav', type=str,
+                        help='File containing behavioral and accuracy info.')
+    parser.add_argument('-i','--infiles', nargs='+', help='List of parsed input files')
+    parser.add_argument('-f', '--format', choices=['xlsx', 'csv', 'parquet'],
+                        default='xlsx', help='Output file format.')
+    args = parser.parse_args()
+
+    if not (args.outdir and args.behav and args.infiles):
+        root = tkinter.Tk()
+        root.withdraw()
+    # Select parsed pupil data files
+    if not args.infiles:
+        args.infiles = list(filedialog.askopenfilenames(parent=root,title='Choose parsed pupil data files'))
+    # Select file with behavioral info
+    if not args.behav:
+        args.behav = filedialog.askopenfilename(parent=root,title='Choose behavioral performance file')
+    # Select output directory to save out to
+    if not args.outdir:
+        args.outdir = filedialog.askdirectory(parent=root,initialdir=os.getcwd(), title='Please select output directory')
+    # Run script
+    main(args.outdir, args.behav, args.infiles, task=args.task, fmt=args.format)
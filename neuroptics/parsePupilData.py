@@ -3,15 +3,28 @@
 Created on Mon Jun 20 10:24:32 2016
 
 @author: jelman
+
+Parses text exports of NeurOptics pupillometers. Records of each subject are
+split by task based on measurement duration (5s: pupil light reflex, 15s:
+digit span, 25s: category fluency and recognition) and saved to one csv file
+per task with the pupil profile expanded to one column per time point.
 """
 
 import re
 import os, sys
+import argparse
 import itertools
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import Tkinter,tkFileDialog
+try:
+    # for Python2
+    import Tkinter as tkinter
+    import tkFileDialog as filedialog
+except ImportError:
+    # for Python3
+    import tkinter
+    from tkinter import filedialog
 
 def read_file(filename):
 # Open file and read lines
@@ -99,7 +112,7 @@ def get_subid(df):
         assert len(df['Subject ID'].unique())==1
         return df['Subject ID'][0]
     except AssertionError:
-        print "Found multiple subject IDs in file: %s" % ', '.join(df['Subject ID'].unique())
+        print("Found multiple subject IDs in file: %s" % ', '.join(df['Subject ID'].unique()))
     
     
 def sort_time(df, timevar):
@@ -173,9 +186,9 @@ def parse_pupil_data(filelist, outdir):
             plroutfile = os.path.join(outdir, plrfname)
             try:
                 plr_data.to_csv(plroutfile, index=False)
-                print "PLR file for %s saved successfully" %(subid)
+                print("PLR file for %s saved successfully" %(subid))
             except IOError:
-                print "PLR file for %s could not be saved" %(subid)
+                print("PLR file for %s could not be saved" %(subid))
         # Digit Span
         if len(sublistsDS) > 0:
             ds_data = parse_DS(sublistsDS)
@@ -184,9 +197,9 @@ def parse_pupil_data(filelist, outdir):
             dsoutfile = os.path.join(outdir, dsfname)
             try:
                 ds_data.to_csv(dsoutfile, index=False)
-                print "DS file for %s saved successfully" %(subid)
+                print("DS file for %s saved successfully" %(subid))
             except IOError:
-                print "DS file for %s could not be saved" %(subid)
+                print("DS file for %s could not be saved" %(subid))
         # Category Fluency and Recognition
         if len(sublistsCFREC) > 0:
             cfrec_data = parse_CFREC(sublistsCFREC)
@@ -195,19 +208,29 @@ def parse_pupil_data(filelist, outdir):
             cfrecoutfile = os.path.join(outdir, cfrecfname)
             try:
                 cfrec_data.to_csv(cfrecoutfile, index=False) 
-                print "CFREC file for %s saved successfully" %(subid)
+                print("CFREC file for %s saved successfully" %(subid))
             except IOError:
-                print "CFREC file for %s could not be saved" %(subid)
+                print("CFREC file for %s could not be saved" %(subid))
             
 
 if __name__ == '__main__':
 
-    root = Tkinter.Tk()
-    root.withdraw()
+    parser = argparse.ArgumentParser(description="""Parse NeurOptics text
+                                     exports into csv files per task. Any
+                                     paths not given are selected from a
+                                     dialog.""")
+    parser.add_argument('-i', '--infiles', nargs='+', help='List of raw NeurOptics files')
+    parser.add_argument('-o', '--outdir', type=str, help='Directory to save parsed files.')
+    args = parser.parse_args()
+
+    if not (args.infiles and args.outdir):
+        root = tkinter.Tk()
+        root.withdraw()
     # Select files to parse
-    filelist = tkFileDialog.askopenfilenames(parent=root,title='Choose files to parse')
-    filelist = list(filelist)
+    if not args.infiles:
+        args.infiles = list(filedialog.askopenfilenames(parent=root,title='Choose files to parse'))
     # Select output directory to save out to
-    outdir = tkFileDialog.askdirectory(parent=root,initialdir=os.getcwd(), title='Please select output directory')
+    if not args.outdir:
+        args.outdir = filedialog.askdirectory(parent=root,initialdir=os.getcwd(), title='Please select output directory')
     # Run script
-    parse_pupil_data(filelist, outdir)
+    parse_pupil_data(args.infiles, args.outdir)
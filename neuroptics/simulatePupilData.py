@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic NeurOptics text exports and a matching behavioral file,
+so that parsePupilData.py and the scripts that use its outputs can be run and
+timed without device exports.
+
+Each subject file holds one record per measurement, separated by blank lines,
+in the layout of the device export:
+    key = value lines (Subject ID, Time, Device ID, Measurement Duration, ...)
+    Measurement Duration of 5.000sec (pupil light reflex, PLR), 15.000sec
+        (digit span, DS) or 25.000sec (category fluency and recognition, CFREC)
+    Time Profile and Pupil Profile as tab separated vectors sampled at 30Hz,
+        with the values on the line after "= "
+    PLR latency lines followed by a redundant ", 75% recovery time" fragment
+The first PLR record of each subject is a practice trial that is not entered
+in the database. The behavioral file has the trial times (HHMMSS) and scan
+quality of DS and PLR trials as in the VETSA database. A fraction of trial
+times are not entered (999999) or marked as bad scans.
+
+Usage:
+    python simulatePupilData.py <output dir> [--subjects 100] [--plr 11] [--ds 12] [--cfrec 2]
+"""
+
+import os
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+SAMPLING_RATE = 30.
+TIME_FORMAT = '%m/%d/%Y %H:%M:%S'
+DURATIONS = {'PLR': 5, 'DS': 15, 'CFREC': 25}
+# Number of DS and PLR trials in the behavioral database
+DB_TRIALS = {'DS': 12, 'PLR': 10}
+
+
+def format_vector(values, fmt):
+    return '\t'.join(fmt % x for x in values)
+
+
+def simulate_plr(times, rng):
+    """Light reflex: constriction after a latency followed by slow recovery.
+    Returns profile and device reported metrics."""
+    init = rng.uniform(4., 6.5)
+    amplitude = init * rng.uniform(.25, .4)
+    latency = rng.normal(.23, .02)
+    t = np.clip(times - latency, 0, None)
+    response = (1 - np.exp(-t / .25)) * np.exp(-np.clip(t - .8, 0, None) / 1.5)
+    profile = init - amplitude * response / response.max() + rng.normal(0, .01, len(times))
+    # Time from minimum until 75% of the constriction is recovered
+    imin = np.argmin(profile)
+    recovered = profile[imin:] >= profile[imin] + .75 * amplitude
+    recovery = times[imin + np.argmax(recovered)] if recovered.any() else times[-1]
+    recovery -= times[imin]
+    metrics = {'Diameter': '%.2f/%.2f' % (profile.max(), profile.min()),
+               'Mean/Max C. Vel': '%.2f/%.2f' % (-amplitude / .8, -amplitude / .4),
+               'dilation velocity': '%.2f' % (amplitude / 2.),
+               'C. Lat': '%.3f' % latency,
+               '75% recovery time': '%.3f' % recovery}
+    return profile, metrics
+
+
+def simulate_task(times, rng):
+    """Slowly drifting pupil diameter with a task evoked dilation."""
+    drift = np.cumsum(rng.normal(0, .01, len(times)))
+    dilation = rng.uniform(.1, .4) * np.sin(np.pi * times / times[-1])
+    return rng.uniform(3.5, 5.5) + drift + dilation
+
+
+def make_record(subid, time, task, record_id, rng):
+    """Lines of one record of the device export."""
+    duration = DURATIONS[task]
+    times = np.arange(int(duration * SAMPLING_RATE)) / SAMPLING_RATE
+    lines = ['Subject ID = %s' % subid,
+             'Time = %s' % time.strftime(TIME_FORMAT),
+             'Device ID = PLR-3000 SN 0042',
+             'Record ID = %d' % record_id,
+             'Eye Measured = %s' % rng.choice(['Left', 'Right']),
+             'Profile Normal = Yes',
+             'Pulse Intensity = %s' % ('180' if task == 'PLR' else '0'),
+             'DC Intensity = 0',
+             'Pulse Start Time = 0.000sec',
+             'Pulse Duration = %s' % ('0.800sec' if task == 'PLR' else '0.000sec'),
+             'Measurement Duration = %d.000sec' % duration]
+    if task == 'PLR':
+        profile, metrics = simulate_plr(times, rng)
+        lines += ['Diameter = ' + metrics['Diameter'],
+                  'C. Lat = %s, 75%% recovery time = %s' % (metrics['C. Lat'], metrics['75% recovery time']),
+                  'Mean/Max C. Vel = ' + metrics['Mean/Max C. Vel'],
+                  'dilation velocity = ' + metrics['dilation velocity'],
+                  '75% recovery time = ' + metrics['75% recovery time']]
+    else:
+        profile = simulate_task(times, rng)
+    # Profiles are continued on the next line after "= "
+    lines += ['Time Profile = ', format_vector(times, '%.3f'),
+              'Pupil Profile = ', format_vector(profile, '%.2f')]
+    return lines
+
+
+def make_subject(subid, start, nplr, nds, ncfrec, rng):
+    """Export lines and record times of one subject. Records of each task are
+    measured in blocks about a minute apart."""
+    lines = ['']
+    trialtimes = {}
+    time = start
+    record_id = int(rng.integers(1, 1000))
+    for task, ntrials in [('PLR', nplr), ('DS', nds), ('CFREC', ncfrec)]:
+        trialtimes[task] = []
+        for _ in range(ntrials):
+            time += timedelta(seconds=int(rng.integers(30, 90)))
+            lines += make_record(subid, time, task, record_id, rng) + ['']
+            trialtimes[task].append(time)
+            record_id += 1
+    return lines, trialtimes
+
+
+def get_behav_row(subid, date, trialtimes, missing, badscan, rng):
+    """Database entry of one subject. The first PLR record is the practice
+    trial and is not entered."""
+    row = {'SUBJECTID': subid, 'TESTDATE': date.strftime('%m/%d/%Y'),
+           'ZPUPILLRDS': round(rng.normal(0, 1), 3), 'ZPUPILLR': round(rng.normal(0, 1), 3)}
+    for task, prefix, times in [('DS', 'DST', trialtimes['DS']),
+                                ('PLR', 'LRT', trialtimes['PLR'][1:])]:
+        for trial in range(1, DB_TRIALS[task] + 1):
+            entered = trial <= len(times) and rng.random() >= missing
+            row['%s%dTIM' % (prefix, trial)] = int(times[trial - 1].strftime('%H%M%S')) if entered else 999999
+            row['%s%dSCN' % (prefix, trial)] = 0 if rng.random() < badscan else 1
+    return row
+
+
+def make_cohort(outdir, nsubjects=100, nplr=11, nds=12, ncfrec=2, missing=.05,
+                badscan=.05, seed=0):
+    """Write one export per subject and the behavioral file to outdir.
+    Returns list of export files and the behavioral file."""
+    rng = np.random.default_rng(seed)
+    subids = rng.choice(np.arange(10000, 100000), size=nsubjects, replace=False)
+    filelist = []
+    behavrows = []
+    for subid in sorted(subids):
+        subid = '%dA' % subid
+        date = datetime(2012, 1, 1) + timedelta(days=int(rng.integers(0, 1000)))
+        start = date + timedelta(hours=int(rng.integers(8, 14)))
+        lines, trialtimes = make_subject(subid, start, nplr, nds, ncfrec, rng)
+        fname = os.path.join(outdir, '%s Pupillometry Data.txt' % subid)
+        # Device exports have Windows line endings
+        with open(fname, 'w', newline='\r\n') as f:
+            f.write('\n'.join(lines))
+        filelist.append(fname)
+        behavrows.append(get_behav_row(subid, date, trialtimes, missing, badscan, rng))
+    behavfile = os.path.join(outdir, 'behav.csv')
+    pd.DataFrame(behavrows).to_csv(behavfile, index=False)
+    return filelist, behavfile
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="""Generate synthetic
+                                     NeurOptics exports and a matching
+                                     behavioral file.""")
+    parser.add_argument('outdir', help='Directory to save files.')
+    parser.add_argument('--subjects', type=int, default=100, help='Number of subjects.')
+    parser.add_argument('--plr', type=int, default=11,
+                        help='PLR records per subject, including practice trial.')
+    parser.add_argument('--ds', type=int, default=12, help='DS records per subject.')
+    parser.add_argument('--cfrec', type=int, default=2, help='CFREC records per subject.')
+    parser.add_argument('--missing', type=float, default=.05,
+                        help='Fraction of trials without time in the behavioral file.')
+    parser.add_argument('--badscan', type=float, default=.05,
+                        help='Fraction of trials marked as bad scans.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    filelist, behavfile = make_cohort(args.outdir, nsubjects=args.subjects, nplr=args.plr,
+                                      nds=args.ds, ncfrec=args.cfrec, missing=args.missing,
+                                      badscan=args.badscan, seed=args.seed)
+    print('Wrote {0} exports and {1}'.format(len(filelist), behavfile))
@@ -7,9 +7,9 @@ for every second at each load (but averaged across trials within a load).
 Note: Visual QC metrics should be used to exclude bad conditions.
 """
 
-import pandas as pd
 import os, sys
 from datetime import datetime
+import pupil_io
 
 try:
     # for Python2
@@ -23,12 +23,7 @@ except ImportError:
 
 def main(filelist, outdir):
     """Takes list of files and concatenates. Writes out to outfile."""
-    allsubs = []
-    for fname in filelist:
-        subdf = pd.read_csv(fname)
-        allsubs.append(subdf)
-        
-    alldf = pd.concat(allsubs).reset_index(drop=True)
+    alldf = pupil_io.read_csv_files(filelist, dtype=pupil_io.PROCESSED_PUPIL_DTYPES)
     tstamp = datetime.now().strftime("%Y-%m-%d")
     outname = 'digitspan_allsubjects_' + tstamp + '.csv'  
     outfile = os.path.join(outdir, outname)    
@@ -38,7 +33,7 @@ def main(filelist, outdir):
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         print('')
-        print('USAGE: {} <processed subject pupil file> '.format(os.path.basename(sys.argv[0])))
+        print('USAGE: {} <processed subject pupil files> <output dir>'.format(os.path.basename(sys.argv[0])))
         print("""Concatenate individual subject files. Resulting group file will
               contain dilation at each second, averaged across trials of a 
               given load.""")
@@ -54,6 +49,8 @@ if __name__ == '__main__':
         main(filelist, outdir)
 
     else:
-        filelist = [os.path.abspath(f) for f in sys.argv[1:]]
-        proc_subject(filelist)
+        # Last argument is the output folder, all others are subject files
+        filelist = [os.path.abspath(f) for f in sys.argv[1:-1]]
+        outdir = sys.argv[-1]
+        main(filelist, outdir)
 
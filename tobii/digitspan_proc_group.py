@@ -9,17 +9,23 @@ Takes as input datafiles created by digitspan_proc_subject.py. This includes:
     DigitSpan_<subject>_ProcessedPupil.csv
     
 Extracts dilation from timepoint of interest (i.e., last second) in each load.
-Plots group level PTSC. Output can be used for statistical analysis.
+Plots group level PTSC with bootstrap confidence intervals, which are also
+saved to digitspan_group_CI_<date>.csv. Output can be used for statistical
+analysis.
 """
 
 from __future__ import division, print_function, absolute_import
 import os
 import sys
-import pandas as pd
-import seaborn as sns
+from functools import partial
 from datetime import datetime
 from glob import glob
 import numpy as np
+import pupil_io
+import pupil_qc
+import pupil_reduce
+import pupil_stats
+import redcap_export
 try:
     # for Python2
     import Tkinter as tkinter
@@ -30,22 +36,25 @@ except ImportError:
     from tkinter import filedialog
     
 
-def glob_files(datadir, suffix):
-    globstr = os.path.join(datadir, '*'+suffix)
+def glob_files(datadir, suffix, prefix=''):
+    globstr = os.path.join(datadir, prefix+'*'+suffix)
     return glob(globstr)
     
     
-def get_sess_data(datadir):
-    sess_filelist = glob_files(datadir, suffix='_ProcessedPupil.csv')
-    sess_list = []
-    for sub_file in sess_filelist:
-        subdf = pd.read_csv(sub_file)
-        sess_list.append(subdf)
-    sessdf = pd.concat(sess_list).reset_index(drop=True)
-    sessdf = sessdf.sort_values(by=['Subject', 'Load', 'Seconds'])
-    # Filter for loads that have data at the last second
-    idx = sessdf.Timestamp.str.slice(-2).values.astype(np.int64) == sessdf.Load.values.astype('int')+1
-    return sessdf.loc[idx,:] 
+def get_last_second(subdf, fname):
+    """Keep the last second of each load."""
+    idx = subdf.Seconds.values == subdf.Load.values.astype('int')+1
+    return subdf.loc[idx,:]
+
+
+def get_sess_data(datadir, compact=False):
+    """Read subject files one at a time, keeping only the timepoint of
+    interest (see pupil_reduce.py). With compact=True files are read with
+    the compact schema (float32 and categorical columns)."""
+    sess_filelist = glob_files(datadir, suffix='_ProcessedPupil.csv', prefix='DigitSpan_')
+    dtype = pupil_io.COMPACT_PUPIL_DTYPES if compact else pupil_io.PROCESSED_PUPIL_DTYPES
+    sessdf = pupil_reduce.reduce_files(sess_filelist, get_last_second, dtype=dtype)
+    return sessdf.sort_values(by=['Subject', 'Load', 'Seconds'])
 
 
 
@@ -64,22 +73,49 @@ def unstack_conditions(dflong):
 
  
     
-def proc_group(datadir):
-    sessdf_long = get_sess_data(datadir)
+def stream_summary(datadir, compact=False):
+    """Group N, mean, SD and SEM of each load computed while streaming
+    subject files (pupil_reduce.RunningStats), without keeping subject
+    rows. Each subject file has one row per load at the last second, so
+    values match digitspan_group_CI_<date>.csv."""
+    sess_filelist = glob_files(datadir, suffix='_ProcessedPupil.csv', prefix='DigitSpan_')
+    dtype = pupil_io.COMPACT_PUPIL_DTYPES if compact else pupil_io.PROCESSED_PUPIL_DTYPES
+    stats = pupil_reduce.RunningStats('Load', ['Dilation', 'Baseline', 'Diameter', 'BlinkPct'])
+    pupil_reduce.reduce_files(sess_filelist, get_last_second, dtype=dtype, stats=stats, keep=False)
+    return stats.summary()
+
+
+def proc_group(datadir, compact=False, delta=False, stream=False):
+    """With delta=True only records and fields that changed since the last
+    export are written for REDCap import (see redcap_export.py). With
+    stream=True only group statistics without confidence intervals are
+    written (digitspan_group_stats_<date>.csv), in memory independent of
+    the number of subjects."""
     tstamp = datetime.now().strftime("%Y-%m-%d")
+    if stream:
+        stats_outfile = os.path.join(datadir, 'digitspan_group_stats_' + tstamp + '.csv')
+        print('Writing group statistics to {0}'.format(stats_outfile))
+        stream_summary(datadir, compact=compact).to_csv(stats_outfile, index=False)
+        return
+    sessdf_long = get_sess_data(datadir, compact=compact)
     sessdf_long_outfile = os.path.join(datadir, 'digitspan_group_long_' + tstamp + '.csv')
     sessdf_long.to_csv(sessdf_long_outfile, index=False)
 
+    # Means and bootstrap confidence intervals of each load
+    summary = pupil_stats.group_summary(sessdf_long, 'Load',
+                                        values=['Dilation', 'Baseline', 'Diameter', 'BlinkPct'])
+    summary_outfile = os.path.join(datadir, 'digitspan_group_CI_' + tstamp + '.csv')
+    summary.to_csv(summary_outfile, index=False)
+
     plot_outfile = os.path.join(datadir, 'digitspan_group_plot_' + tstamp + '.png')
-    sns.set_context('notebook')
-    sns.set_style('ticks')
-    p = sns.catplot(x="Load", y="Dilation",
-                    kind="point", capsize=.2, aspect=1.5, 
-                    data=sessdf_long)
-    p.despine()
-    p.savefig(plot_outfile, dpi=300)
+    pupil_qc.save_plot(partial(pupil_stats.plot_summary, x='Load'),
+                       summary[summary.Measure=='Dilation'], plot_outfile,
+                       style='ticks', figsize=(7.5, 5), dpi=300)
     sessdf_wide = unstack_conditions(sessdf_long)
     sessdf_wide.columns = sessdf_wide.columns.str.lower()
+    if delta:
+        redcap_export.export_delta(sessdf_wide, datadir, 'digitspan_group')
+        return
     sessdf_wide_outfile = os.path.join(datadir, 'digitspan_group_REDCap_' + tstamp + '.csv')
     print('Writing processed group data to {0}'.format(sessdf_wide_outfile))
     sessdf_wide.to_csv(sessdf_wide_outfile, index=False)
@@ -22,9 +22,11 @@ import os
 import sys
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import pupil_utils
+import pupil_io
+import pupil_qc
+import pupil_quality
+import pupil_features
 try:
     # for Python2
     import Tkinter as tkinter
@@ -35,40 +37,57 @@ except ImportError:
     from tkinter import filedialog
 
 def plot_trials(pupildf, pupil_fname):
-    palette = sns.cubehelix_palette(len(pupildf.Load.unique()))
-    p = sns.lineplot(data=pupildf, x="Seconds",y="Dilation", hue="Load", palette=palette, legend="brief", errorbar=None)
-    plt.ylim(-.2, .5)
-    plt.tight_layout()
-    plot_outname = pupil_fname.replace("_ProcessedPupil.csv", "_PupilPlot.png")
-    p.figure.savefig(plot_outname)
-    plt.close()
+    """Plot dilation by load. Figure is not managed by pyplot so plots can be
+    saved from a background thread."""
+    plot_outname = pupil_qc.get_plot_outname(pupil_fname)
+    pupil_qc.save_plot(pupil_qc.plot_digitspan, pupildf, plot_outname)
+
+
+def save_plot(pupildf, pupil_outname):
+    try:
+        plot_trials(pupildf, pupil_outname)
+    except KeyError as e:
+        print(f"Skipping plotting due to KeyError: {e}")
+        print(f"Check {pupil_outname} for missing data (e.g., all NaNs)")
     
     
-def clean_trials(trialevents):
+# Baseline is the last 250ms of the Ready phase. Baselines with more than 50%
+# blinks are set to missing.
+BASELINE = {'phasecol': 'Condition', 'phase': 'Ready', 'duration': '250ms',
+            'align': 'last', 'max_blinks': .5}
+
+
+def resample_trials(trialevents, resample='bin', deblinked=False, blink_method='heuristic'):
+    """Deblink, resample and filter each trial. Returns concatenated trials
+    indexed by Trial and Timestamp, before baseline correction."""
     resampled_dict = {}
     for trial in trialevents.Trial.unique():
         starttime, stoptime =  trialevents.loc[trialevents.Trial==trial,'RTTime'].iloc[[0,-1]]
         rawtrial = trialevents.loc[(trialevents.RTTime>=starttime) & (trialevents.RTTime<=stoptime)]
-        cleantrial = pupil_utils.deblink(rawtrial)
+        cleantrial = rawtrial if deblinked else pupil_utils.deblink(rawtrial, method=blink_method)
         string_cols = ['Load', 'Trial', 'TrialId', 'Condition']
-        trial_resamp = pupil_utils.resamp_filt_data(cleantrial, filt_type='low', string_cols=string_cols)
-        baseline = trial_resamp.loc[trial_resamp.Condition=='Ready', 'PupilDiameterLRFilt'].last('250ms').mean()
-        baseline_blinks = trial_resamp.loc[trial_resamp.Condition=='Ready', 'BlinksLR'].last('250ms').mean()
-        if baseline_blinks > .5:
-            baseline = np.nan
-        trial_resamp['Baseline'] = baseline
-        trial_resamp['Dilation'] = trial_resamp['PupilDiameterLRFilt'] - trial_resamp['Baseline']
-        trial_resamp = trial_resamp[trial_resamp.Condition=='Record']
-        # If trial is empty after filtering, skip
-        if trial_resamp.empty:
-            continue  
-        trial_resamp.index = pd.DatetimeIndex((trial_resamp.index - trial_resamp.index[0]).astype(np.int64))
-        resampled_dict[trial] = trial_resamp        
-    dfresamp = pd.concat(resampled_dict, names=['Trial','Timestamp'])
+        resampled_dict[trial] = pupil_utils.resamp_filt_data(cleantrial, filt_type='low', string_cols=string_cols, method=resample)
+    return pd.concat(resampled_dict, names=['Trial','Timestamp'])
+
+
+def clean_trials(trialevents, resample='bin', deblinked=False, blink_method='heuristic'):
+    dfresamp = resample_trials(trialevents, resample=resample, deblinked=deblinked,
+                               blink_method=blink_method)
+    # Baseline correct all trials at once and keep the Record phase
+    dfresamp = pupil_utils.baseline_correct(dfresamp, 'Trial', **BASELINE)
+    dfresamp = dfresamp[dfresamp.Condition=='Record']
+    # Set time relative to start of Record phase of each trial
+    trials = dfresamp.index.get_level_values('Trial')
+    timestamps = pd.Series(dfresamp.index.get_level_values('Timestamp'))
+    onsets = timestamps.groupby(trials.to_numpy()).transform('min')
+    dfresamp.index = pd.MultiIndex.from_arrays(
+        [trials, pd.DatetimeIndex((timestamps - onsets).to_numpy().astype(np.int64))],
+        names=['Trial','Timestamp'])
     return dfresamp
     
 def define_condition(trialdf):
-    trialdf['Condition'] = np.where((trialdf.RTTime - trialdf.RTTime.iloc[0]) / 1000. > 1., 'Record', 'Ready')
+    trialdf['Condition'] = pd.Categorical(np.where((trialdf.RTTime - trialdf.RTTime.iloc[0]) / 1000. > 1., 'Record', 'Ready'),
+                                          categories=['Ready', 'Record'])
     return trialdf
 
 
@@ -93,7 +112,7 @@ def get_trial_events(df):
         loaddf = loaddf[loaddf['CurrentObject']=='Ready']
         # Confirm TrialId is A, B, or C
         assert all(x in ['A','B','C'] for x in loaddf['TrialId'].unique())        
-        loaddf = loaddf.groupby('Trial').apply(define_condition)
+        loaddf = loaddf.groupby('Trial', observed=True).apply(define_condition)
         triallist.append(loaddf)
     trialevents = pd.concat(triallist)    
     return trialevents
@@ -106,76 +125,112 @@ def recode_digitlist(digitlist):
     digitlist = digitlist.str.replace('2','B')
     return digitlist
    
-def proc_subject(filelist, outdir):
+def prep_trials(df, subid):
+    """Copy of prepared data with Subject, Trial, Load and TrialId columns."""
+    # Load column is incorrect, remove. It will be generated correctly from DigitList
+    df = df.drop('Load', axis=1)
+    df['Subject'] = subid
+    # Recode DigitList values
+    df['Trial'] = recode_digitlist(df['DigitList']).astype('category')
+    # Create Load and TrialId columns
+    df['Load'] = df['Trial'].str[:-1].astype('category')
+    df['TrialId'] = df['Trial'].str[-1].astype('category')
+    return df
+
+
+def proc_task(df, subid, outdir, writer, plot=True, resample='bin', compact=False,
+              deblinked=False, blink_method='heuristic'):
+    """Process digit span data of a single subject after it has been prepared
+    with pupil_utils.prep_gazedata. Input dataframe is not modified, so it can
+    be shared with other task handlers. Set deblinked=True if blinks were
+    already removed (pupil_utils.deblink) from the whole file. blink_method
+    is the method of pupil_utils.deblink. Outputs are submitted to writer."""
+    trialevents = get_trial_events(prep_trials(df, subid))
+    dfresamp = clean_trials(trialevents, resample=resample, deblinked=deblinked,
+                            blink_method=blink_method)
+    dfresamp = dfresamp.reset_index(level='Timestamp').set_index(['Load','Trial'])
+    dfresamp['ValidLR'] = pupil_quality.get_valid(dfresamp)
+    features = pupil_features.get_trial_features(dfresamp, subid, 'DigitSpan')
+    # # Save out dfresamp for cleaned pupil at 30Hz for individuals trials 
+    # pupil_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil30Hz.csv')
+    # pupildf.to_csv(pupil_outname, index=True)
+    
+    dfresamp1s = dfresamp.groupby(level=['Load','Trial'], observed=True).apply(lambda x: x.resample('1s', on='Timestamp', closed='right', label='right').mean(numeric_only=True)).reset_index()
+    dfresamp1s['Subject'] = subid
+    quality = pupil_quality.get_quality_table(dfresamp1s, subid, 'DigitSpan', 'Load', 'Trial')
+    # Select and rename columns of interest
+    pupilcols = ['Subject', 'Trial', 'Load', 'Timestamp', 'Dilation',
+                 'Baseline', 'PupilDiameterLRFilt', 'BlinksLR']
+    dfresamp1s = dfresamp1s[pupilcols].rename(columns={'PupilDiameterLRFilt':'Diameter',
+                                             'BlinksLR':'BlinkPct'})
+    # Set samples with >50% blinks to missing    
+    exclude = pupil_quality.get_exclusions(dfresamp1s, pupil_quality.QUALITY_RULES['DigitSpan']['second'])
+    dfresamp1s.loc[exclude, ['Dilation','Baseline','Diameter','BlinkPct']] = np.nan
+    # Drop missing samples and average of trials within load
+    pupildf = dfresamp1s.groupby(['Load','Timestamp'], observed=True).mean(numeric_only=True)
+    # Add number of non-missing trials that contributed to each sample average
+    pupildf['ntrials'] = dfresamp1s.dropna(subset=['Dilation']).groupby(['Load','Timestamp'], observed=True).size()
+    # Set subject ID and session as (as type string)
+    pupildf['Subject'] = subid
+    # Add column with seconds and format Timestamp
+    pupildf = pupildf.reset_index()
+    pupildf['Timestamp'] = pupil_utils.convert_timestamp(pupildf.Timestamp)
+    pupildf['Seconds'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_seconds)
+    pupildf['Timestamp'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_hms)
+    # Generate output filename
+    pupil_outname = os.path.join(outdir, 'DigitSpan_' + subid + '_ProcessedPupil.csv')
+    print('Writing processed data to {0}'.format(pupil_outname))
+    # Save out data and plots
+    if compact:
+        pupildf = pupil_io.compact_frame(pupildf)
+    writer.submit(pupildf.to_csv, pupil_outname, index=False)
+    if plot:
+        writer.submit(save_plot, pupildf, pupil_outname)
+    # Save out quality table of each trial and second
+    quality_outname = os.path.join(outdir, 'DigitSpan_' + subid + '_Quality.csv')
+    if compact:
+        quality = pupil_io.compact_frame(quality)
+    writer.submit(quality.to_csv, quality_outname, index=False)
+    # Save out response features of each trial
+    features_outname = os.path.join(outdir, 'DigitSpan_' + subid + '_TrialFeatures.csv')
+    if compact:
+        features = pupil_io.compact_frame(features)
+    writer.submit(features.to_csv, features_outname, index=False)
+
+
+def proc_file(fname, df, outdir, writer, plot=True, resample='bin', compact=False,
+              blink_method='heuristic'):
+    """Process raw data of a single subject. Outputs are submitted to writer."""
+    print('Processing {}'.format(fname))
+    subid = pupil_utils.prep_gazedata(df, fname)
+    proc_task(df, subid, outdir, writer, plot=plot, resample=resample, compact=compact,
+              blink_method=blink_method)
+
+
+def proc_subject(filelist, outdir, plot=True, resample='bin', compact=False,
+                 blink_method='heuristic'):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
-    for fname in filelist: 
-        print('Processing {}'.format(fname))
-        if fname.lower().endswith(".gazedata") | fname.lower().endswith(".csv") | fname.lower().endswith(".txt"):
-            df = pd.read_csv(fname, sep="\t")
-        elif fname.lower().endswith(".xlsx"):
-            df = pd.read_excel(fname)
-        else: 
-            raise IOError('Could not open {}'.format(fname))  
-        subid = pupil_utils.get_vetsaid(df, fname)
-        df['Subject'] = subid
-        # Load column is incorrect, remove. It will be generated correctly from DigitList
-        df = df.drop('Load', axis=1)
-        # Recode DigitList values
-        df['Trial'] = recode_digitlist(df['DigitList'])
-        # Convert PupilDiameterLeftEye and PupilDiameterRightEye to numeric
-        df['PupilDiameterLeftEye'] = pd.to_numeric(df['PupilDiameterLeftEye'], errors='coerce')
-        df['PupilDiameterRightEye'] = pd.to_numeric(df['PupilDiameterRightEye'], errors='coerce')      
-        # Create Load and TrialId columns
-        df['Load'] = df['Trial'].str[:-1]
-        df['TrialId'] = df['Trial'].str[-1]
-        trialevents = get_trial_events(df)
-        dfresamp = clean_trials(trialevents)
-        dfresamp = dfresamp.reset_index(level='Timestamp').set_index(['Load','Trial'])
-        # # Save out dfresamp for cleaned pupil at 30Hz for individuals trials 
-        # pupil_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil30Hz.csv')
-        # pupildf.to_csv(pupil_outname, index=True)
-        
-        dfresamp1s = dfresamp.groupby(level=['Load','Trial']).apply(lambda x: x.resample('1s', on='Timestamp', closed='right', label='right').mean(numeric_only=True)).reset_index()
-        dfresamp1s['Subject'] = subid
-        # Select and rename columns of interest
-        pupilcols = ['Subject', 'Trial', 'Load', 'Timestamp', 'Dilation',
-                     'Baseline', 'PupilDiameterLRFilt', 'BlinksLR']
-        dfresamp1s = dfresamp1s[pupilcols].rename(columns={'PupilDiameterLRFilt':'Diameter',
-                                                 'BlinksLR':'BlinkPct'})
-        # Set samples with >50% blinks to missing    
-        dfresamp1s.loc[dfresamp1s.BlinkPct>.5, ['Dilation','Baseline','Diameter','BlinkPct']] = np.nan
-        # Drop missing samples and average of trials within load
-        pupildf = dfresamp1s.groupby(['Load','Timestamp']).mean(numeric_only=True)
-        # Add number of non-missing trials that contributed to each sample average
-        pupildf['ntrials'] = dfresamp1s.dropna(subset=['Dilation']).groupby(['Load','Timestamp']).size()
-        # Set subject ID and session as (as type string)
-        pupildf['Subject'] = subid
-        # Add column with seconds and format Timestamp
-        pupildf = pupildf.reset_index()
-        pupildf['Timestamp'] = pupil_utils.convert_timestamp(pupildf.Timestamp)
-        pupildf['Seconds'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_seconds)
-        pupildf['Timestamp'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_hms)
-        # Generate output filename
-        pupil_outname = os.path.join(outdir, 'DigitSpan_' + subid + '_ProcessedPupil.csv')
-        print('Writing processed data to {0}'.format(pupil_outname))
-        # Save out data and plots
-        pupildf.to_csv(pupil_outname, index=False)
-        try:
-            plot_trials(pupildf, pupil_outname)
-        except KeyError as e:
-            print(f"Skipping plotting due to KeyError: {e}")
-            print(f"Check {pupil_outname} for missing data (e.g., all NaNs)")
-
+        4. Percent of samples with blinks
+    The next file is read and outputs are written on background threads while
+    the current file is processed. Set plot=False to skip plots, which can be
+    rendered later with pupil_qc.py. Set resample='poly' to decimate high
+    rate recordings instead of averaging into bins. Set compact=True to write
+    outputs with the compact schema (pupil_io.COMPACT_PUPIL_DTYPES). Set
+    blink_method='velocity' to detect blinks with
+    pupil_utils.get_blinks_velocity."""
+    with pupil_io.OutputWriter() as writer:
+        for fname, df in pupil_io.prefetch(filelist, pupil_io.read_gazedata):
+            proc_file(fname, df, outdir, writer, plot=plot, resample=resample, compact=compact,
+                      blink_method=blink_method)
 
     
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         print('')
-        print('USAGE: {} <raw pupil file> <output dir>'.format(os.path.basename(sys.argv[0])))
+        print('USAGE: {} <raw pupil files> <output dir>'.format(os.path.basename(sys.argv[0])))
         print("""Processes single subject data from digit span task and outputs
               csv files for use in further group analysis. Takes eye tracker 
               data text file (*.gazedata) as input. Removes artifacts, filters, 
@@ -193,7 +248,8 @@ if __name__ == '__main__':
         proc_subject(filelist, outdir)
 
     else:
-        filelist = [os.path.abspath(f) for f in sys.argv[1:]]
-        outdir = sys.argv[2]
+        # Last argument is the output folder, all others are raw files
+        filelist = [os.path.abspath(f) for f in sys.argv[1:-1]]
+        outdir = sys.argv[-1]
         proc_subject(filelist, outdir)
 
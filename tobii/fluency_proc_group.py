@@ -13,9 +13,13 @@ quartile.
 import os
 import sys
 import numpy as np
-import pandas as pd
 from glob import glob
 from datetime import datetime
+import pupil_io
+import pupil_quality
+import pupil_reduce
+import pupil_stats
+import redcap_export
 try:
     # for Python2
     import Tkinter as tkinter
@@ -35,7 +39,7 @@ def pivot_wide(dflong):
     # Replace 'Task' column values
     dflong['Task'] = dflong['Task'].replace({'Category' : 'cat', 'Letter' : 'let'})
     # Combine Task and Seconds columns into a single column with '_' delimiter
-    dflong['TaskTime'] = dflong.Task + '_' + dflong.Seconds
+    dflong['TaskTime'] = dflong.Task.astype(str) + '_' + dflong.Seconds
     dflong = dflong.drop(columns=['Task','Seconds'])
     colnames = ['Dilation', 'Baseline','Diameter', 'BlinkPct', 'ntrials']
     dfwide = dflong.pivot(index="Subject", columns='TaskTime', values=colnames)
@@ -51,46 +55,76 @@ def pivot_wide(dflong):
     
     
     
-def proc_group(datadir):
-    # Gather processed fluency data
-    globstr = '*_ProcessedPupil_Tertiles.csv'
-    filelist = glob(os.path.join(datadir, globstr))
-    # Initiate empty list to hold subject data
-    allsubs = []
-    for fname in filelist:
-        subdf = pd.read_csv(fname)
-        unique_subid = subdf.Subject.unique()
-        if len(unique_subid) == 1:
-            subid = str(subdf['Subject'].iat[0])
-        else:
-            raise Exception('Found multiple subject IDs in file {0}: {1}'.format(fname, unique_subid))
-        subdf['Subject'] = subid
-        allsubs.append(subdf)
-    
-    # Concatenate all subject date
-    alldf = pd.concat(allsubs)
-    # Save out concatenated data
-    date = datetime.today().strftime('%Y-%m-%d')
-    # outname_all = ''.join(['fluency_Tertiles_AllTrials_',date,'.csv'])
-    # alldf.to_csv(os.path.join(datadir, outname_all), index=False)
-    
-    # Filter out Tertiles with >50% blinks or entire trials with >50% blinks
-    exclude = (alldf.groupby('Subject').BlinkPct.transform(lambda x: x.mean())>.50) | (alldf.BlinkPct>.50)
-    alldf = alldf[-exclude]
+def check_subid(subdf, fname):
+    """Confirm file contains a single subject ID and store it as a string."""
+    unique_subid = subdf.Subject.unique()
+    if len(unique_subid) == 1:
+        subid = str(subdf['Subject'].iat[0])
+    else:
+        raise Exception('Found multiple subject IDs in file {0}: {1}'.format(fname, unique_subid))
+    subdf['Subject'] = subid
+    return subdf
+
+
+def reduce_subject(subdf, fname):
+    """Exclude tertiles with >50% blinks (or the whole subject if blinks
+    exceed 50% on average) and average across trials within task and
+    tertile. Returns one row per task and tertile with number of trials."""
+    subdf = check_subid(subdf, fname)
+    # Filter out Tertiles with >50% blinks or entire subjects with >50% blinks
+    quality, trials, subjects = pupil_quality.apply_rules(subdf, pupil_quality.QUALITY_RULES['Fluency'],
+                                                          trial=['Condition'])
+    subdf = subdf[~quality.Exclude.to_numpy()]
     # Average across trials within quartile and condition
     pupilcols = ['Subject','Seconds','Dilation','Baseline','Diameter','BlinkPct','Task']
-    alldfgrp = alldf[pupilcols].groupby(['Subject','Task','Seconds']).mean().reset_index()
+    subgrp = subdf[pupilcols].groupby(['Subject','Task','Seconds'], observed=True).mean().reset_index()
     # Drop Seconds==0.0, this was only just for plotting purposes
-    alldfgrp = alldfgrp[alldfgrp.Seconds!=0.0]
+    subgrp = subgrp[subgrp.Seconds!=0.0]
     # Get number of trials contributing to each task
-    ntrials = alldf.groupby(['Subject','Task','Seconds']).size().reset_index(name='ntrials')
-    alldfgrp = alldfgrp.merge(ntrials, on=['Subject','Task','Seconds'], validate="one_to_one")
+    ntrials = subdf.groupby(['Subject','Task','Seconds'], observed=True).size().reset_index(name='ntrials')
+    return subgrp.merge(ntrials, on=['Subject','Task','Seconds'], validate="one_to_one")
+
+
+def proc_group(datadir, compact=False, delta=False, stream=False):
+    """Subject files are reduced one at a time (see pupil_reduce.py), so
+    memory use does not grow with the size of the subject files. With
+    delta=True only records and fields that changed since the last export
+    are written for REDCap import (see redcap_export.py). With stream=True
+    only group statistics without confidence intervals are written
+    (fluency_Tertiles_group_stats_<date>.csv), from running sums that do not
+    keep subject rows, so memory use does not grow with the cohort."""
+    # Gather processed fluency data
+    globstr = '*_ProcessedPupil_Tertiles.csv'
+    filelist = glob(os.path.join(datadir, globstr))
+    # Load and reduce each subject file, optionally with compact schema
+    dtype = pupil_io.COMPACT_PUPIL_DTYPES if compact else pupil_io.PROCESSED_PUPIL_DTYPES
+    date = datetime.today().strftime('%Y-%m-%d')
+    if stream:
+        # One row per subject, task and tertile, as averaged by group_summary
+        stats = pupil_reduce.RunningStats(['Task', 'Seconds'],
+                                          ['Dilation', 'Baseline', 'Diameter', 'BlinkPct'])
+        pupil_reduce.reduce_files(filelist, reduce_subject, dtype=dtype, stats=stats, keep=False)
+        outname_stats = ''.join(['fluency_Tertiles_group_stats_',date,'.csv'])
+        print('Writing group statistics to {0}'.format(outname_stats))
+        stats.summary().to_csv(os.path.join(datadir, outname_stats), index=False)
+        return
+    alldfgrp = pupil_reduce.reduce_files(filelist, reduce_subject, dtype=dtype)
+    alldfgrp = alldfgrp.sort_values(['Subject','Task','Seconds']).reset_index(drop=True)
     # Save out summarized data
     outname_avg = ''.join(['fluency_Tertiles_group_long_',date,'.csv'])
     print('Writing processed group data (long format) to {0}'.format(outname_avg))
     alldfgrp.to_csv(os.path.join(datadir, outname_avg), index=False)
+    # Group means and bootstrap confidence intervals of each task and tertile
+    summary = pupil_stats.group_summary(alldfgrp, ['Task', 'Seconds'],
+                                        values=['Dilation', 'Baseline', 'Diameter', 'BlinkPct'])
+    outname_ci = ''.join(['fluency_Tertiles_group_CI_',date,'.csv'])
+    print('Writing group confidence intervals to {0}'.format(outname_ci))
+    summary.to_csv(os.path.join(datadir, outname_ci), index=False)
     
     alldfgrp_wide = pivot_wide(alldfgrp)
+    if delta:
+        redcap_export.export_delta(alldfgrp_wide, datadir, 'fluency_Tertiles_group')
+        return
     outname_wide = ''.join(['fluency_Tertiles_group_wide_',date,'.csv'])
     print('Writing processed group data (wide format) to {0}'.format(outname_wide))
     alldfgrp_wide.to_csv(os.path.join(datadir, outname_wide), index=False)
@@ -4,11 +4,13 @@ Created on Fri Sep 16 12:00:45 2016
 
 @author: jelman
 
-This script takes Tobii .gazedata file from auditory oddball as input. It 
-first performs interpolation and filtering, Then peristimulus timecourses 
-are created for target and standard trials after baselining. Trial-level data 
-and average PSTC waveforms data are output for further group processing using 
-(i.e., with oddball_proc_group.py). 
+This script takes Tobii .gazedata file from verbal fluency as input. It 
+first performs interpolation and filtering, Then dilation is calculated for 
+each second and each 10s block of the letter and category fluency trials 
+after baselining. Baseline is the average of the Baseline phase before the 
+instructions. Output is used for further group processing (i.e., with 
+fluency_proc_group.py). Trial timing is also described by the Fluency spec 
+in pupil_epochs.py.
 
 Some procedures and parameters adapted from:
 Jackson, I. and Sirois, S. (2009), Infant cognition: going full factorial 
@@ -24,9 +26,11 @@ import os
 import sys
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import pupil_utils
+import pupil_io
+import pupil_qc
+import pupil_quality
+import pupil_features
 try:
     # for Python2
     import Tkinter as tkinter
@@ -38,28 +42,21 @@ except ImportError:
 
 
 def plot_trials(pupildf, pupil_fname):
-    sns.set_style("ticks")
-    # Define a custom color palette
-    condition_colors = {'C': 'blue', 'L': 'dodgerblue', 'GirlsNames': 'red',  'Vegetables': 'lightcoral'}
-    palette = [condition_colors[condition] for condition in pupildf.Condition.unique()]
-    p = sns.lineplot(data=pupildf, x="Seconds", y="Dilation", hue="Condition", palette=palette, legend="brief")
-    plt.ylim(-1.0, 1.0)
-    plt.tight_layout()
-    # Set the ordering of the legend
-    handles, labels = p.get_legend_handles_labels()
-    ordered_labels = ['C', 'L', 'GirlsNames', 'Vegetables']
-    ordered_handles = [handles[labels.index(label)] for label in ordered_labels]
-    p.legend(ordered_handles, ordered_labels, loc='best')
-    # Add shading for baseline period
-    p.axvspan(-6, -4, alpha=0.2, color='lightgreen', zorder=0)
-    # Add shading for instruction period
-    p.axvspan(-4, 0, alpha=0.4, color='lightgray', zorder=0)
-    plot_outname = pupil_fname.replace("_ProcessedPupil.csv", "_PupilPlot.png")
-    p.figure.savefig(plot_outname)
-    plt.close()
-    
-    
-def clean_trials(df):
+    """Plot dilation by condition. Figure is not managed by pyplot so plots
+    can be saved from a background thread."""
+    plot_outname = pupil_qc.get_plot_outname(pupil_fname)
+    pupil_qc.save_plot(pupil_qc.plot_fluency, pupildf, plot_outname, style="ticks")
+
+
+# Baseline is the average of the Baseline period of each trial
+BASELINE = {'phasecol': 'CurrentObject', 'phase': 'Baseline'}
+
+
+
+def resample_trials(df, resample='bin', deblinked=False, blink_method='heuristic'):
+    """Check conditions, then deblink, resample and filter each trial.
+    Returns concatenated trials indexed by Condition, before baseline
+    correction."""
     resampled_dict = {}
     conditions = df.Condition.unique()
     # If there are not 4 trials, raise an error
@@ -74,82 +71,126 @@ def clean_trials(df):
         # Fill missing CurrentObject values. Use forward then backward fill
         rawtrial['CurrentObject'] = rawtrial['CurrentObject'].fillna(method='ffill').fillna(method='bfill')
         rawtrial = rawtrial.loc[rawtrial.CurrentObject != "Fixation"]
-        cleantrial = pupil_utils.deblink(rawtrial)
-        trial_resamp = pupil_utils.resamp_filt_data(cleantrial, filt_type='low', string_cols=['CurrentObject', 'Condition'])
-        trial_resamp = trial_resamp.reset_index()
-        # Calculate baseline when CurrentObject is 'Baseline'
-        baseline = trial_resamp.loc[trial_resamp.CurrentObject=='Baseline', 'PupilDiameterLRFilt'].mean(numeric_only=True)
-        trial_resamp['Baseline'] = baseline
-        trial_resamp['Dilation'] = trial_resamp['PupilDiameterLRFilt'] - trial_resamp['Baseline']
-        # Set Timestamp to 0 when CurrentObject is "RecordLetter"
-        trial_resamp['Timestamp'] = trial_resamp['RTTime'] - trial_resamp.loc[trial_resamp.CurrentObject=='RecordLetter', 'RTTime'].iloc[0]
-        trial_resamp['Timestamp'] = pd.to_datetime(trial_resamp.Timestamp.values.astype(np.int64), unit='ms')        
-        resampled_dict[condition] = trial_resamp
-    dfresamp = pd.concat(resampled_dict, names=['Condition','Timestamp'])
+        cleantrial = rawtrial if deblinked else pupil_utils.deblink(rawtrial, method=blink_method)
+        trial_resamp = pupil_utils.resamp_filt_data(cleantrial, filt_type='low', string_cols=['CurrentObject', 'Condition'], method=resample)
+        resampled_dict[condition] = trial_resamp.reset_index()
+    return pd.concat(resampled_dict, names=['Condition','Timestamp'])
+
+
+def clean_trials(df, resample='bin', deblinked=False, blink_method='heuristic'):
+    dfresamp = resample_trials(df, resample=resample, deblinked=deblinked,
+                               blink_method=blink_method)
+    # Baseline correct all trials at once
+    dfresamp = pupil_utils.baseline_correct(dfresamp, 'Condition', **BASELINE)
+    # Set Timestamp to 0 when CurrentObject is "RecordLetter"
+    conditions = dfresamp['Condition'].to_numpy()
+    onsets = dfresamp['RTTime'].where(dfresamp.CurrentObject=='RecordLetter').groupby(conditions).transform('first')
+    # Every trial needs a RecordLetter onset
+    missing = pd.unique(conditions[onsets.isnull().to_numpy()])
+    if len(missing) > 0:
+        raise Exception('No RecordLetter samples in trials {}'.format(list(missing)))
+    dfresamp['Timestamp'] = pd.to_datetime((dfresamp['RTTime'] - onsets).values.astype(np.int64), unit='ms')
     return dfresamp
     
 
    
-def proc_subject(filelist, outdir):
+def proc_task(df, subid, outdir, writer, plot=True, resample='bin', compact=False,
+              deblinked=False, blink_method='heuristic'):
+    """Process fluency data of a single subject after it has been prepared
+    with pupil_utils.prep_gazedata. Input dataframe is not modified, so it can
+    be shared with other task handlers. Set deblinked=True if blinks were
+    already removed (pupil_utils.deblink) from the whole file. blink_method
+    is the method of pupil_utils.deblink. Outputs are submitted to writer."""
+    # Assign conditions to task. Letter: ['C', 'L']; Category: ['Vegetables', 'GirlsNames']
+    dfresamp = clean_trials(df, resample=resample, deblinked=deblinked,
+                            blink_method=blink_method)
+    dfresamp['ValidLR'] = pupil_quality.get_valid(dfresamp)
+    features = pupil_features.get_trial_features(dfresamp, subid, 'Fluency')
+    ### Create data resampled to 1 second
+    dfresamp1s = dfresamp.groupby(level='Condition', observed=True).apply(lambda x: x.resample('1s', on='Timestamp', closed='right', label='right').mean(numeric_only=True))
+    pupilcols = ['Subject', 'Condition', 'Timestamp', 'Dilation', 'Baseline',
+                 'PupilDiameterLRFilt', 'BlinksLR']
+    quality = pupil_quality.get_quality_table(dfresamp1s.reset_index(), subid, 'Fluency', 'Condition', 'Condition')
+    pupildf = dfresamp1s.reset_index()[pupilcols].sort_values(by=['Condition','Timestamp'])
+    pupildf = pupildf[pupilcols].rename(columns={'PupilDiameterLRFilt':'Diameter',
+                                     'BlinksLR':'BlinkPct'})
+    # Set subject ID and session as (as type string)
+    pupildf['Subject'] = subid
+    # Add column with seconds and format Timestamp
+    pupildf['Timestamp'] = pupil_utils.convert_timestamp(pupildf.Timestamp)
+    pupildf['Seconds'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_seconds)
+    pupildf['Timestamp'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_hms)
+    pupildf['Task'] = pupildf['Condition'].apply(lambda x: 'Letter' if x in ['C', 'L'] else ('Category' if x in ['Vegetables', 'GirlsNames'] else np.nan)) 
+    # Only keep samples up to 30.0 seconds
+    pupildf = pupildf[pupildf.Seconds <= 30.0]
+    # Generate output filename
+    pupil_outname = os.path.join(outdir, 'Fluency_' + subid + '_ProcessedPupil.csv')
+    print('Writing processed data to {0}'.format(pupil_outname))
+    if compact:
+        pupildf = pupil_io.compact_frame(pupildf)
+    writer.submit(pupildf.to_csv, pupil_outname, index=False)
+    if plot:
+        writer.submit(plot_trials, pupildf, pupil_outname)
+    # Save out quality table of each trial and second
+    quality_outname = os.path.join(outdir, 'Fluency_' + subid + '_Quality.csv')
+    if compact:
+        quality = pupil_io.compact_frame(quality)
+    writer.submit(quality.to_csv, quality_outname, index=False)
+    # Save out response features of each trial
+    features_outname = os.path.join(outdir, 'Fluency_' + subid + '_TrialFeatures.csv')
+    if compact:
+        features = pupil_io.compact_frame(features)
+    writer.submit(features.to_csv, features_outname, index=False)
+    
+    #### Create data for 15 second blocks
+    dfresamp10s = dfresamp.groupby(level=['Condition'], observed=True).apply(lambda x: x.resample('10s', on='Timestamp', closed='right', label='right').mean(numeric_only=True))
+    pupilcols = ['Subject', 'Condition', 'Timestamp', 'Dilation', 'Baseline',
+                 'PupilDiameterLRFilt', 'BlinksLR']        
+    pupildf10s = dfresamp10s.reset_index()[pupilcols]
+    pupildf10s = pupildf10s[pupilcols].rename(columns={'PupilDiameterLRFilt':'Diameter',
+                                     'BlinksLR':'BlinkPct'})
+    # Set subject ID as (as type string)
+    pupildf10s['Subject'] = subid
+    pupildf10s['Timestamp'] = pupil_utils.convert_timestamp(pupildf10s.Timestamp)
+    pupildf10s['Seconds'] = pupildf10s['Timestamp'].apply(pupil_utils.format_timedelta_seconds)
+    pupildf10s['Timestamp'] = pupildf10s['Timestamp'].apply(pupil_utils.format_timedelta_hms)
+    pupildf10s['Task'] = pupildf10s['Condition'].apply(lambda x: 'Letter' if x in ['C', 'L'] else ('Category' if x in ['Vegetables', 'GirlsNames'] else np.nan)) 
+    # Remove samples after 30.0 seconds
+    pupildf10s = pupildf10s[pupildf10s.Seconds <= 30.0]
+    pupil10s_outname = os.path.join(outdir, 'Fluency_' + subid + '_ProcessedPupil_Tertiles.csv')
+    'Writing quartile data to {0}'.format(pupil10s_outname)
+    if compact:
+        pupildf10s = pupil_io.compact_frame(pupildf10s)
+    writer.submit(pupildf10s.to_csv, pupil10s_outname, index=False)
+
+
+def proc_file(fname, df, outdir, writer, plot=True, resample='bin', compact=False,
+              blink_method='heuristic'):
+    """Process raw data of a single subject. Outputs are submitted to writer."""
+    print('Processing {}'.format(fname))
+    subid = pupil_utils.prep_gazedata(df, fname)
+    proc_task(df, subid, outdir, writer, plot=plot, resample=resample, compact=compact,
+              blink_method=blink_method)
+
+
+def proc_subject(filelist, outdir, plot=True, resample='bin', compact=False,
+                 blink_method='heuristic'):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
-    for fname in filelist:
-        print('Processing {}'.format(fname))
-        if fname.lower().endswith(".gazedata") | fname.lower().endswith(".csv") | fname.lower().endswith(".txt"):
-            df = pd.read_csv(fname, sep="\t")
-        elif fname.lower().endswith(".xlsx"):
-            df = pd.read_excel(fname)
-        else: 
-            raise IOError('Could not open {}'.format(fname))  
-        subid = pupil_utils.get_vetsaid(df, fname)
-        # Convert PupilDiameterLeftEye and PupilDiameterRightEye to numeric
-        df['PupilDiameterLeftEye'] = pd.to_numeric(df['PupilDiameterLeftEye'], errors='coerce')
-        df['PupilDiameterRightEye'] = pd.to_numeric(df['PupilDiameterRightEye'], errors='coerce')      
-        # Assign conditions to task. Letter: ['C', 'L']; Category: ['Vegetables', 'GirlsNames']
-        dfresamp = clean_trials(df)
-        ### Create data resampled to 1 second
-        dfresamp1s = dfresamp.groupby(level='Condition').apply(lambda x: x.resample('1s', on='Timestamp', closed='right', label='right').mean(numeric_only=True))
-        pupilcols = ['Subject', 'Condition', 'Timestamp', 'Dilation', 'Baseline',
-                     'PupilDiameterLRFilt', 'BlinksLR']
-        pupildf = dfresamp1s.reset_index()[pupilcols].sort_values(by=['Condition','Timestamp'])
-        pupildf = pupildf[pupilcols].rename(columns={'PupilDiameterLRFilt':'Diameter',
-                                         'BlinksLR':'BlinkPct'})
-        # Set subject ID and session as (as type string)
-        pupildf['Subject'] = subid
-        # Add column with seconds and format Timestamp
-        pupildf['Timestamp'] = pupil_utils.convert_timestamp(pupildf.Timestamp)
-        pupildf['Seconds'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_seconds)
-        pupildf['Timestamp'] = pupildf['Timestamp'].apply(pupil_utils.format_timedelta_hms)
-        pupildf['Task'] = pupildf['Condition'].apply(lambda x: 'Letter' if x in ['C', 'L'] else ('Category' if x in ['Vegetables', 'GirlsNames'] else np.nan)) 
-        # Only keep samples up to 30.0 seconds
-        pupildf = pupildf[pupildf.Seconds <= 30.0]
-        # Generate output filename
-        pupil_outname = os.path.join(outdir, 'Fluency_' + subid + '_ProcessedPupil.csv')
-        print('Writing processed data to {0}'.format(pupil_outname))
-        pupildf.to_csv(pupil_outname, index=False)
-        plot_trials(pupildf, pupil_outname)
-        
-        #### Create data for 15 second blocks
-        dfresamp10s = dfresamp.groupby(level=['Condition']).apply(lambda x: x.resample('10s', on='Timestamp', closed='right', label='right').mean(numeric_only=True))
-        pupilcols = ['Subject', 'Condition', 'Timestamp', 'Dilation', 'Baseline',
-                     'PupilDiameterLRFilt', 'BlinksLR']        
-        pupildf10s = dfresamp10s.reset_index()[pupilcols]
-        pupildf10s = pupildf10s[pupilcols].rename(columns={'PupilDiameterLRFilt':'Diameter',
-                                         'BlinksLR':'BlinkPct'})
-        # Set subject ID as (as type string)
-        pupildf10s['Subject'] = subid
-        pupildf10s['Timestamp'] = pupil_utils.convert_timestamp(pupildf10s.Timestamp)
-        pupildf10s['Seconds'] = pupildf10s['Timestamp'].apply(pupil_utils.format_timedelta_seconds)
-        pupildf10s['Timestamp'] = pupildf10s['Timestamp'].apply(pupil_utils.format_timedelta_hms)
-        pupildf10s['Task'] = pupildf10s['Condition'].apply(lambda x: 'Letter' if x in ['C', 'L'] else ('Category' if x in ['Vegetables', 'GirlsNames'] else np.nan)) 
-        # Remove samples after 30.0 seconds
-        pupildf10s = pupildf10s[pupildf10s.Seconds <= 30.0]
-        pupil10s_outname = os.path.join(outdir, 'Fluency_' + subid + '_ProcessedPupil_Tertiles.csv')
-        'Writing quartile data to {0}'.format(pupil10s_outname)
-        pupildf10s.to_csv(pupil10s_outname, index=False)
+        4. Percent of samples with blinks
+    The next file is read and outputs are written on background threads while
+    the current file is processed. Set plot=False to skip plots, which can be
+    rendered later with pupil_qc.py. Set resample='poly' to decimate high
+    rate recordings instead of averaging into bins. Set compact=True to write
+    outputs with the compact schema (pupil_io.COMPACT_PUPIL_DTYPES). Set
+    blink_method='velocity' to detect blinks with
+    pupil_utils.get_blinks_velocity."""
+    with pupil_io.OutputWriter() as writer:
+        for fname, df in pupil_io.prefetch(filelist, pupil_io.read_gazedata):
+            proc_file(fname, df, outdir, writer, plot=plot, resample=resample, compact=compact,
+                      blink_method=blink_method)
 
 
 
@@ -157,7 +198,7 @@ def proc_subject(filelist, outdir):
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         print('')
-        print('USAGE: {} <raw pupil file> <output dir>'.format(os.path.basename(sys.argv[0])))
+        print('USAGE: {} <raw pupil files> <output dir>'.format(os.path.basename(sys.argv[0])))
         print("""Processes single subject data from fluency task and outputs csv
               files for use in further group analysis. Takes eye tracker data 
               text file (*.gazedata) as input. Removes artifacts, filters, and 
@@ -176,7 +217,8 @@ if __name__ == '__main__':
         proc_subject(filelist, outdir)
 
     else:
-        filelist = [os.path.abspath(f) for f in sys.argv[1:]]
-        outdir = sys.argv[2]
+        # Last argument is the output folder, all others are raw files
+        filelist = [os.path.abspath(f) for f in sys.argv[1:-1]]
+        outdir = sys.argv[-1]
         proc_subject(filelist, outdir)
 
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of raw gazedata readers.
+
+Writes synthetic digit span and fluency gazedata (as in pupil_regression.py)
+to .xlsx and tab delimited files and times reading them with the previous
+and current paths of pupil_io.read_gazedata:
+    read_excel: pd.read_excel of all columns
+    read_xlsx: pupil_io.read_xlsx, streaming read-only path
+    read_csv: pd.read_csv of all columns, then numeric pupil columns
+    read_tsv: pupil_io.read_tsv, multi-threaded and column pruned
+Best wall time of --repeat reads and peak memory traced by tracemalloc are
+reported (buffers of the pyarrow memory pool are not traced).
+Exports of the eye tracker have many columns that are not used by the
+pipeline (gaze points, eye positions, ...), which are simulated with --extra
+columns. The columns used by the pipeline (pupil_io.GAZEDATA_COLS) must be
+identical with the previous and current readers, except for the order of
+categories (pd.read_csv only sorts them if the file is parsed in a single
+chunk). Tab delimited files are compared with
+pd.read_csv(float_precision='round_trip'), since the default pandas float
+parser is not always correctly rounded.
+
+Usage:
+    python pupil_benchmark.py [--fs 60] [--extra 30] [--repeat 3] [--workdir DIR]
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+from functools import partial
+import numpy as np
+import pandas as pd
+import pupil_io
+import pupil_regression
+
+
+def make_files(workdir, fs, extra, seed=0):
+    """Write each synthetic task as .xlsx and .gazedata. Returns list of
+    (task, xlsx file, gazedata file)."""
+    rng = np.random.default_rng(seed)
+    subid, session = pupil_regression.SUBJECTS[0]
+    files = []
+    for task, make_task in [('DigitSpan', pupil_regression.make_digitspan),
+                            ('Fluency', pupil_regression.make_fluency)]:
+        df = make_task(subid, session, fs, rng)
+        for i in range(extra):
+            df['Unused{}'.format(i)] = rng.normal(size=len(df))
+        basename = os.path.join(workdir, '{0}-{1}-{2}'.format(task, subid, session))
+        df.to_excel(basename + '.xlsx', index=False)
+        df.to_csv(basename + '.gazedata', sep='\t', index=False)
+        files.append((task, basename + '.xlsx', basename + '.gazedata'))
+    return files
+
+
+def read_excel(fname):
+    """Previous .xlsx path of pupil_io.read_gazedata."""
+    df = pd.read_excel(fname)
+    labelcols = [col for col in pupil_io.GAZEDATA_LABEL_COLS if col in df.columns]
+    df[labelcols] = df[labelcols].astype('category')
+    return df
+
+
+def read_csv(fname, float_precision=None):
+    """Previous tab delimited path of pupil_io.read_gazedata, including the
+    numeric conversion of pupil_utils.prep_gazedata."""
+    dtype = dict((col, 'category') for col in pupil_io.GAZEDATA_LABEL_COLS)
+    df = pd.read_csv(fname, sep='\t', dtype=dtype, float_precision=float_precision)
+    for col in pupil_io.GAZEDATA_PUPIL_COLS:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+def time_reader(read, fname, repeat):
+    """Best wall time of repeat reads, peak memory in MB (traced in a
+    separate read) and the frame of the last read."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = read(fname)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    read(fname)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return min(times), peak, df
+
+
+def check_equal(expected, result):
+    """Compare columns used by the pipeline. Returns list of mismatches."""
+    cols = [col for col in expected.columns if col in pupil_io.GAZEDATA_COLS]
+    mismatches = []
+    if list(result.columns) != cols:
+        mismatches.append('columns {}'.format(list(result.columns)))
+        return mismatches
+    for col in cols:
+        try:
+            pd.testing.assert_series_equal(expected[col], result[col], check_categorical=False)
+        except AssertionError:
+            mismatches.append(col)
+    return mismatches
+
+
+def run_benchmark(workdir, fs=60., extra=30, repeat=3):
+    results = []
+    ok = True
+    for task, xlsxfile, tsvfile in make_files(workdir, fs, extra):
+        for fmt, fname, old, new in [('xlsx', xlsxfile, read_excel, pupil_io.read_xlsx),
+                                     ('tsv', tsvfile, read_csv, pupil_io.read_tsv)]:
+            t_old, mem_old, _ = time_reader(old, fname, repeat)
+            t_new, mem_new, result = time_reader(partial(new, usecols=pupil_io.GAZEDATA_COLS),
+                                                 fname, repeat)
+            expected = read_excel(fname) if fmt == 'xlsx' else read_csv(fname, 'round_trip')
+            mismatches = check_equal(expected, result)
+            ok &= not mismatches
+            results.append({'Task': task, 'Format': fmt, 'Rows': len(expected),
+                            'Columns': expected.shape[1], 'Previous': t_old, 'Current': t_new,
+                            'Speedup': t_old / t_new, 'MB_previous': mem_old, 'MB_current': mem_new,
+                            'Equal': 'yes' if not mismatches else ', '.join(mismatches)})
+    return pd.DataFrame(results), ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Time reading synthetic
+                                     .xlsx and tab delimited gazedata with the
+                                     previous and current readers.""")
+    parser.add_argument('--fs', type=float, default=60.,
+                        help='Sampling rate of synthetic data (default: 60).')
+    parser.add_argument('--extra', type=int, default=30,
+                        help='Number of unused columns in the exports (default: 30).')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of reads of each file; best time is reported.')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory for synthetic files (default: temporary, removed).')
+    args = parser.parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pupil_benchmark_')
+    try:
+        results, ok = run_benchmark(workdir, fs=args.fs, extra=args.extra, repeat=args.repeat)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+    with pd.option_context('display.width', 120, 'display.precision', 3):
+        print(results.to_string(index=False))
+    sys.exit(0 if ok else 1)
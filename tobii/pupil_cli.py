@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Headless command line interface to all Tobii and NeurOptics processing
+stages. Inputs can be files, directories (searched recursively with the
+default file pattern of the stage) or glob patterns, so no dialogs are
+needed and the command can be run in batch jobs.
+
+Per-file stages accept --shard i/N to process only the i-th of N disjoint
+subsets of the work list (i from 1 to N). Files are assigned to shards by a
+hash of their file name, so every node computes the same assignment from its
+own listing without any coordination, and files added later do not move
+other files to a different shard. Stages that write one output per subject
+write into the output directory directly. Stages that write one combined
+file per run (plr-metrics, clean-profiles) write into a shard-<i>-of-<N>
+subdirectory; these are combined with the merge stage once all shards have
+finished. Subject stages detect blinks with --blink-method heuristic
+(default, pupil_utils.get_blinks) or velocity (get_blinks_velocity).
+
+Usage:
+    python pupil_cli.py digitspan <inputs> -o <output dir> [--shard i/N] [--blink-method M]
+    python pupil_cli.py fluency <inputs> -o <output dir> [--shard i/N] [--blink-method M]
+    python pupil_cli.py session <inputs> -o <output dir> [--shard i/N] [--shared-deblink]
+        [--blink-method M]
+    python pupil_cli.py qc <inputs> [--shard i/N] [--jobs N] [--mosaic] [--html]
+    python pupil_cli.py concat <inputs> -o <output dir>
+    python pupil_cli.py digitspan-group <data dir> [--delta] [--stream]
+    python pupil_cli.py fluency-group <data dir> [--delta] [--stream]
+    python pupil_cli.py parse <inputs> -o <output dir> [--shard i/N]
+    python pupil_cli.py plr-metrics <inputs> -o <output dir> [--shard i/N]
+    python pupil_cli.py clean-profiles <inputs> -o <output dir> [--shard i/N]
+    python pupil_cli.py template <task> <inputs> -b <behav file> -o <output dir>
+    python pupil_cli.py missing-timestamps <input dir> -b <behav file> -o <output dir>
+    python pupil_cli.py merge <output dir>
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import re
+import sys
+import zlib
+import fnmatch
+import argparse
+from glob import glob
+import pandas as pd
+
+# NeurOptics stages are imported from their own folder when they are run
+NEUROPTICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'neuroptics')
+
+# File patterns used when a directory is given as input
+RAW_PATTERNS = {'digitspan': ['DigitSpan*.gazedata', 'DigitSpan*.xlsx'],
+                'fluency': ['Fluency*.gazedata', 'Fluency*.xlsx'],
+                'session': ['*.gazedata', '*.xlsx'],
+                'parse': ['*.txt']}
+PROCESSED_PATTERNS = {'qc': ['*_ProcessedPupil.csv'],
+                      'concat': ['DigitSpan_*_ProcessedPupil.csv']}
+PARSED_PATTERNS = {'plr-metrics': ['*_Pupil_PLR_Parsed_*.csv'],
+                   'clean-profiles': ['*_Pupil_DS_Parsed_*.csv', '*_Pupil_CFREC_Parsed_*.csv'],
+                   # Formatted with the task (DS or PLR) of the template stage
+                   'template': ['*_Pupil_{task}_Parsed_*.csv']}
+
+SHARD_DIR = 'shard-{0:03d}-of-{1:03d}'
+
+
+def parse_shard(value):
+    """argparse type for --shard i/N. Returns (i, N)."""
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if not match:
+        raise argparse.ArgumentTypeError('shard must be given as i/N, not {}'.format(value))
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard index must be between 1 and {0}, not {1}'.format(count, index))
+    return index, count
+
+
+def expand_inputs(inputs, patterns):
+    """Expand files, directories and glob patterns into a sorted list of
+    unique absolute paths. Directories are searched recursively for files
+    matching any of patterns."""
+    filelist = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for dirpath, dirnames, filenames in os.walk(item):
+                for pattern in patterns:
+                    filelist.update(os.path.join(dirpath, f) for f in fnmatch.filter(filenames, pattern))
+        elif os.path.isfile(item):
+            filelist.add(item)
+        else:
+            matches = glob(item)
+            if not matches:
+                print('No files found for {}'.format(item))
+            filelist.update(f for f in matches if os.path.isfile(f))
+    return sorted(set(os.path.abspath(f) for f in filelist))
+
+
+def shard_key(fname):
+    """Stable hash of file name. Only the name is used, so nodes that mount
+    the data at different paths assign files to the same shard."""
+    return zlib.crc32(os.path.basename(fname).encode('utf-8')) & 0xffffffff
+
+
+def get_shard(filelist, shard=None):
+    """Files of shard (i, N) of filelist. Returns filelist if shard is None."""
+    if shard is None:
+        return filelist
+    index, count = shard
+    return [f for f in filelist if shard_key(f) % count == index - 1]
+
+
+def get_shard_outdir(outdir, shard=None):
+    """Output directory of a shard for stages that write one combined file."""
+    if shard is None:
+        return outdir
+    shard_outdir = os.path.join(outdir, SHARD_DIR.format(*shard))
+    # Shards run concurrently and may race to create the directory
+    os.makedirs(shard_outdir, exist_ok=True)
+    return shard_outdir
+
+
+def get_worklist(args, patterns):
+    """Expand inputs of a stage and select shard. Exits if there is no work."""
+    filelist = expand_inputs(args.inputs, patterns[args.stage])
+    worklist = get_shard(filelist, getattr(args, 'shard', None))
+    if getattr(args, 'shard', None) is not None:
+        print('Shard {0}/{1}: {2} of {3} files'.format(args.shard[0], args.shard[1],
+                                                      len(worklist), len(filelist)))
+    if not worklist:
+        print('Nothing to process for {}'.format(args.stage))
+        sys.exit(0)
+    return worklist
+
+
+def merge_shards(outdir):
+    """Concatenate files of the same name from all shard subdirectories of
+    outdir and write them to outdir. Returns list of merged files."""
+    shard_dirs = sorted(d for d in glob(os.path.join(outdir, 'shard-*-of-*')) if os.path.isdir(d))
+    byname = {}
+    for shard_dir in shard_dirs:
+        for fname in sorted(glob(os.path.join(shard_dir, '*.csv'))):
+            byname.setdefault(os.path.basename(fname), []).append(fname)
+    merged = []
+    for name, filelist in sorted(byname.items()):
+        outfile = os.path.join(outdir, name)
+        mergedf = pd.concat([pd.read_csv(f) for f in filelist], ignore_index=True)
+        mergedf.to_csv(outfile, index=False)
+        print('Merged {0} shard files into {1}'.format(len(filelist), outfile))
+        merged.append(outfile)
+    return merged
+
+
+def import_neuroptics(name):
+    if NEUROPTICS_DIR not in sys.path:
+        sys.path.append(NEUROPTICS_DIR)
+    return __import__(name)
+
+
+def run_digitspan(args):
+    import digitspan_proc_subject
+    digitspan_proc_subject.proc_subject(get_worklist(args, RAW_PATTERNS), args.outdir,
+                                        plot=args.plot, resample=args.resample,
+                                        compact=args.compact, blink_method=args.blink_method)
+
+
+def run_fluency(args):
+    import fluency_proc_subject
+    fluency_proc_subject.proc_subject(get_worklist(args, RAW_PATTERNS), args.outdir,
+                                      plot=args.plot, resample=args.resample,
+                                      compact=args.compact, blink_method=args.blink_method)
+
+
+def run_session(args):
+    import session_proc_subject
+    session_proc_subject.proc_session(get_worklist(args, RAW_PATTERNS), args.outdir,
+                                      plot=args.plot, resample=args.resample,
+                                      compact=args.compact, shared_deblink=args.shared_deblink,
+                                      blink_method=args.blink_method)
+
+
+def run_qc(args):
+    import pupil_qc
+    if args.shard is not None and (args.mosaic or args.html):
+        sys.exit('--mosaic and --html need all plots and cannot be used with --shard')
+    filelist = get_worklist(args, PROCESSED_PATTERNS)
+    pupil_qc.proc_qc(os.path.dirname(filelist[0]), jobs=args.jobs, mosaic=args.mosaic,
+                     html=args.html, filelist=filelist)
+
+
+def run_concat(args):
+    import digitspan_concat_subjects
+    digitspan_concat_subjects.main(get_worklist(args, PROCESSED_PATTERNS), args.outdir)
+
+
+def run_digitspan_group(args):
+    import digitspan_proc_group
+    digitspan_proc_group.proc_group(args.datadir, compact=args.compact, delta=args.delta,
+                                    stream=args.stream)
+
+
+def run_fluency_group(args):
+    import fluency_proc_group
+    fluency_proc_group.proc_group(args.datadir, compact=args.compact, delta=args.delta,
+                                  stream=args.stream)
+
+
+def run_parse(args):
+    parsePupilData = import_neuroptics('parsePupilData')
+    parsePupilData.parse_pupil_data(get_worklist(args, RAW_PATTERNS), args.outdir)
+
+
+def run_plr_metrics(args):
+    computePLRMetrics = import_neuroptics('computePLRMetrics')
+    computePLRMetrics.main(get_worklist(args, PARSED_PATTERNS),
+                           get_shard_outdir(args.outdir, args.shard))
+
+
+def run_clean_profiles(args):
+    cleanPupilProfiles = import_neuroptics('cleanPupilProfiles')
+    cleanPupilProfiles.main(get_worklist(args, PARSED_PATTERNS),
+                            get_shard_outdir(args.outdir, args.shard),
+                            filt_type=args.filt_type)
+
+
+def run_template(args):
+    createPupilTemplate = import_neuroptics('createPupilTemplate')
+    patterns = {'template': [p.format(task=args.task) for p in PARSED_PATTERNS['template']]}
+    createPupilTemplate.main(args.outdir, args.behav, get_worklist(args, patterns),
+                             task=args.task, fmt=args.format)
+
+
+def run_missing_timestamps(args):
+    check_missing_timestamps = import_neuroptics('check_missing_timestamps')
+    check_missing_timestamps.main(args.indir, args.behav, args.outdir)
+
+
+def run_merge(args):
+    if not merge_shards(args.outdir):
+        print('No shard outputs found in {}'.format(args.outdir))
+
+
+def add_inputs(parser, shard=True):
+    parser.add_argument('inputs', nargs='+',
+                        help='Input files, directories or glob patterns.')
+    if shard:
+        parser.add_argument('--shard', type=parse_shard, default=None,
+                            help='Only process shard i of N (given as i/N).')
+
+
+def add_proc_options(parser):
+    parser.add_argument('-o', '--outdir', required=True, help='Folder to save processed data.')
+    parser.add_argument('--no-plot', dest='plot', action='store_false',
+                        help='Skip QC plots (can be rendered later with the qc stage).')
+    parser.add_argument('--resample', choices=['bin', 'poly'], default='bin',
+                        help='Resampling method (poly for high rate recordings).')
+    parser.add_argument('--compact', action='store_true',
+                        help='Write outputs with compact float32/categorical schema.')
+    parser.add_argument('--blink-method', choices=['heuristic', 'velocity'], default='heuristic',
+                        help='Blink detection method (see pupil_utils.deblink).')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="""Run Tobii and NeurOptics
+                                     processing stages without dialogs.""")
+    stages = parser.add_subparsers(dest='stage', metavar='stage')
+    stages.required = True
+
+    for stage, func, desc in [('digitspan', run_digitspan, 'Process digit span subject data.'),
+                              ('fluency', run_fluency, 'Process fluency subject data.'),
+                              ('session', run_session, 'Process all tasks of session files.')]:
+        sub = stages.add_parser(stage, help=desc, description=desc)
+        add_inputs(sub)
+        add_proc_options(sub)
+        if stage == 'session':
+            sub.add_argument('--shared-deblink', action='store_true',
+                             help='Detect blinks once per file instead of per trial (faster, not identical).')
+        sub.set_defaults(func=func)
+
+    sub = stages.add_parser('qc', help='Render QC plots of processed subject files.')
+    add_inputs(sub)
+    sub.add_argument('--jobs', type=int, default=None,
+                     help='Number of worker processes (default: all CPUs).')
+    sub.add_argument('--mosaic', action='store_true', help='Write tiled mosaic images.')
+    sub.add_argument('--html', action='store_true', help='Write HTML index of plots.')
+    sub.set_defaults(func=run_qc)
+
+    sub = stages.add_parser('concat', help='Concatenate processed digit span subject files.')
+    add_inputs(sub, shard=False)
+    sub.add_argument('-o', '--outdir', required=True, help='Folder to save group file.')
+    sub.set_defaults(func=run_concat)
+
+    for stage, func in [('digitspan-group', run_digitspan_group),
+                        ('fluency-group', run_fluency_group)]:
+        sub = stages.add_parser(stage, help='Process group data of {} task.'.format(stage.split('-')[0]))
+        sub.add_argument('datadir', help='Directory of processed subject files.')
+        sub.add_argument('--compact', action='store_true',
+                         help='Read subject files with compact schema.')
+        sub.add_argument('--delta', action='store_true',
+                         help='Only export records changed since the last REDCap export.')
+        sub.add_argument('--stream', action='store_true',
+                         help='Only write group statistics from running sums (no CIs), '
+                              'in memory independent of cohort size.')
+        sub.set_defaults(func=func)
+
+    sub = stages.add_parser('parse', help='Parse NeurOptics text exports into csv files per task.')
+    add_inputs(sub)
+    sub.add_argument('-o', '--outdir', required=True, help='Folder to save parsed files.')
+    sub.set_defaults(func=run_parse)
+
+    sub = stages.add_parser('plr-metrics', help='Compute PLR metrics of parsed NeurOptics files.')
+    add_inputs(sub)
+    sub.add_argument('-o', '--outdir', required=True, help='Folder to save metrics.')
+    sub.set_defaults(func=run_plr_metrics)
+
+    sub = stages.add_parser('clean-profiles', help='Clean parsed NeurOptics DS and CFREC profiles.')
+    add_inputs(sub)
+    sub.add_argument('-o', '--outdir', required=True, help='Folder to save cleaned profiles.')
+    sub.add_argument('--filt-type', choices=['low', 'band'], default='low',
+                     help='Filter applied to profiles.')
+    sub.set_defaults(func=run_clean_profiles)
+
+    sub = stages.add_parser('template', help='Create NeurOptics template file.')
+    sub.add_argument('task', choices=['DS', 'PLR'], help='Task to create template for.')
+    add_inputs(sub, shard=False)
+    sub.add_argument('-b', '--behav', required=True,
+                     help='File containing behavioral and accuracy info.')
+    sub.add_argument('-o', '--outdir', required=True, help='Directory to save output file.')
+    sub.add_argument('-f', '--format', choices=['xlsx', 'csv', 'parquet'], default='xlsx',
+                     help='Output file format.')
+    sub.set_defaults(func=run_template)
+
+    sub = stages.add_parser('missing-timestamps', help='List NeurOptics timestamps missing from database.')
+    sub.add_argument('indir', help='Directory of parsed NeurOptics files.')
+    sub.add_argument('-b', '--behav', required=True, help='Behavioral performance file.')
+    sub.add_argument('-o', '--outdir', required=True, help='Directory to save output file.')
+    sub.set_defaults(func=run_missing_timestamps)
+
+    sub = stages.add_parser('merge', help='Merge outputs of shard subdirectories.')
+    sub.add_argument('outdir', help='Output directory given to the sharded runs.')
+    sub.set_defaults(func=run_merge)
+    return parser
+
+
+def make_outdir(args):
+    """Create output directory of a stage before processing, so that write
+    errors are not only raised after all subjects are processed. The merge
+    stage reads from its directory and is left alone."""
+    if args.stage != 'merge' and getattr(args, 'outdir', None):
+        os.makedirs(args.outdir, exist_ok=True)
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    make_outdir(args)
+    args.func(args)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Event-locked epoching of cleaned, resampled pupil data.
+
+Epochs are defined by a spec dictionary instead of task specific code:
+    event: column whose transitions mark event onsets
+    onset: value (or list of values) of event column at onset. If None,
+        every change of the event column is an onset.
+    trial: optional column labelling trials. A change of trial also starts
+        a new event, and the label is stored with each epoch.
+    offset: seconds added to each onset (default 0)
+    window: (start, stop) of epoch in seconds relative to onset
+    baseline: optional (start, stop) of baseline window in seconds relative
+        to onset. Baseline is the mean signal in this window.
+    baseline_phase: optional baseline window given by a trial phase instead,
+        as keyword arguments of pupil_utils.get_baselines (phasecol, phase,
+        duration, align). Requires trial.
+    max_blinks: optional maximum fraction of blink samples in the baseline
+        window. Baselines with more blinks are set to missing.
+    truncate: if True, samples at or after the next onset (or the start of
+        the next trial) are set to missing so that epochs of trials with
+        different lengths do not overlap.
+
+The continuous signal must be on a regular time grid (e.g. the output of
+pupil_utils.resamp_filt_data). All epochs are taken at once from a strided
+view of every window of the signal (no copy), so only the selected epochs
+are copied into the (trials x time) output matrix.
+
+Adding a task only requires a spec. TASK_EPOCHS describes the existing
+tasks on the resampled trials of their subject scripts (resample_trials of
+digitspan_proc_subject and fluency_proc_subject), with the same onsets and
+baselines. pupil_regression.py checks that epochs of these specs reproduce
+the per second dilation of every trial in the quality tables.
+"""
+from __future__ import division, print_function, absolute_import
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+import pupil_utils
+
+TASK_EPOCHS = {
+    # Onset is the Record phase of each trial (1s after the start of the
+    # digit list, see digitspan_proc_subject.define_condition). Baseline is
+    # the last 250ms of the Ready phase, as digitspan_proc_subject.BASELINE.
+    'DigitSpan': {'event': 'Condition', 'onset': 'Record', 'trial': 'Trial',
+                  'window': (0., 12.), 'truncate': True, 'max_blinks': .5,
+                  'baseline_phase': {'phasecol': 'Condition', 'phase': 'Ready',
+                                     'duration': '250ms', 'align': 'last'}},
+    # Onset is the start of the RecordLetter phase of each condition. Baseline
+    # is the Baseline phase before instructions, as fluency_proc_subject.BASELINE.
+    'Fluency': {'event': 'CurrentObject', 'onset': 'RecordLetter', 'trial': 'Condition',
+                'window': (-6., 31.), 'truncate': True,
+                'baseline_phase': {'phasecol': 'CurrentObject', 'phase': 'Baseline'}}}
+
+
+def get_sample_period(index):
+    """Sample period in seconds of a regular DatetimeIndex or TimedeltaIndex."""
+    return np.median(np.diff(index.asi8)) / 1e9
+
+
+def get_onsets(df, event, onset=None, trial=None):
+    """Positions of rows where the event column changes to onset (or to any
+    value if onset is None), or where a new trial starts. Missing event
+    values are filled forward so gaps do not create spurious onsets."""
+    values = df[event].ffill()
+    starts = values.ne(values.shift()).to_numpy()
+    if trial is not None:
+        trials = df[trial]
+        starts |= trials.ne(trials.shift()).to_numpy()
+    if onset is not None:
+        onset = [onset] if np.isscalar(onset) else onset
+        starts &= values.isin(onset).to_numpy()
+    starts &= values.notnull().to_numpy()
+    return np.flatnonzero(starts)
+
+
+def extract_epochs(signal, onsets, start, stop):
+    """Extract samples start to stop (exclusive) relative to each onset from
+    a 1-d signal. Returns (onsets x samples) array. Samples outside the
+    signal are missing."""
+    signal = np.asarray(signal, dtype=np.float64)
+    onsets = np.asarray(onsets, dtype=np.intp)
+    length = stop - start
+    if len(onsets) == 0:
+        return np.empty((0, length))
+    first = onsets + start
+    padleft = max(0, -first.min())
+    padright = max(0, first.max() + length - len(signal))
+    if padleft or padright:
+        signal = np.pad(signal, (padleft, padright), constant_values=np.nan)
+    # View of every window of the signal; indexing copies only the epochs
+    windows = sliding_window_view(signal, length)
+    return windows[first + padleft]
+
+
+def window_mean(epochs, times, window):
+    """Mean of each epoch over samples with window[0] <= time < window[1]."""
+    mask = (times >= window[0] - 1e-9) & (times < window[1] - 1e-9)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(epochs[:, mask], axis=1)
+
+
+def epoch(df, spec, signal='PupilDiameterLRFilt', blinks='BlinksLR', period=None):
+    """Extract epochs of signal from continuous data indexed by time.
+    Returns (epochs, times, info): epochs is a (trials x time) array,
+    baseline corrected if the spec has a baseline window; times are seconds
+    relative to onset; info is a dataframe with one row per epoch containing
+    the trial label (or event value), onset time and baseline."""
+    if period is None:
+        period = get_sample_period(df.index)
+    onsets = get_onsets(df, spec['event'], spec.get('onset'), spec.get('trial'))
+    labelcol = spec.get('trial') or spec['event']
+    info = pd.DataFrame({labelcol: df[labelcol].to_numpy()[onsets],
+                         'Onset': df.index[onsets]})
+    offset = int(round(spec.get('offset', 0.) / period))
+    start, stop = [int(round(t / period)) for t in spec['window']]
+    times = np.arange(start, stop) * period
+    epochs = extract_epochs(df[signal], onsets + offset, start, stop)
+    if spec.get('truncate'):
+        # Samples from the next onset or trial on belong to the next trial
+        stops = np.append(onsets[1:], len(df))
+        if spec.get('trial') is not None:
+            trials = df[spec['trial']]
+            trialstarts = np.append(np.flatnonzero(trials.ne(trials.shift()).to_numpy()), len(df))
+            stops = np.minimum(stops, trialstarts[np.searchsorted(trialstarts, onsets, side='right')])
+        nextonset = stops - onsets - offset
+        epochs = np.where(np.arange(start, stop)[None, :] < nextonset[:, None], epochs, np.nan)
+    if spec.get('baseline_phase') is not None:
+        baselines = pupil_utils.get_baselines(df, spec['trial'], signal=signal, blinks=blinks,
+                                              **spec['baseline_phase'])
+        baselines = baselines.reindex(info[labelcol].to_numpy())
+        baseline = baselines['Baseline'].to_numpy(dtype=np.float64)
+        if spec.get('max_blinks') is not None:
+            baseline[baselines['BaselineBlinks'].to_numpy() > spec['max_blinks']] = np.nan
+        info['Baseline'] = baseline
+        epochs = epochs - baseline[:, None]
+    elif spec.get('baseline') is not None:
+        baseline = window_mean(epochs, times, spec['baseline'])
+        if spec.get('max_blinks') is not None:
+            blinkpct = window_mean(extract_epochs(df[blinks], onsets + offset, start, stop),
+                                   times, spec['baseline'])
+            baseline[blinkpct > spec['max_blinks']] = np.nan
+        info['Baseline'] = baseline
+        epochs = epochs - baseline[:, None]
+    return epochs, times, info
+
+
+def bin_epochs(epochs, times, width=1.):
+    """Average epochs in bins of width seconds that include their end but
+    not their start, labeled by their end, as the per second data of the
+    subject scripts (resample closed='right', label='right'). Returns
+    (labels, binned) with binned a (trials x bins) array."""
+    bins = np.ceil(np.round(times / width, 9)).astype(np.intp)
+    labels, inverse = np.unique(bins, return_inverse=True)
+    valid = ~np.isnan(epochs)
+    sums = np.zeros((len(epochs), len(labels)))
+    counts = np.zeros((len(epochs), len(labels)))
+    np.add.at(sums.T, inverse, np.where(valid, epochs, 0.).T)
+    np.add.at(counts.T, inverse, valid.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return labels * width, np.where(counts > 0, sums / counts, np.nan)
+
+
+def epochs_to_frame(epochs, times, info, value='Dilation'):
+    """Long dataframe of epochs with a row per epoch and time point."""
+    ntimes = len(times)
+    longdf = info.loc[info.index.repeat(ntimes)].reset_index(drop=True)
+    longdf['Seconds'] = np.tile(times, len(info))
+    longdf[value] = epochs.ravel()
+    return longdf
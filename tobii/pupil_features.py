@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Trial level features of baseline corrected pupil responses.
+
+The processed subject files hold dilation averaged per second. Features of
+the response of each trial are computed here from the resampled (30Hz)
+traces instead: long data of all trials of a subject are scattered once into
+(trials x samples) matrices of times and dilation, and every feature is a
+masked reduction along the sample axis, so all trials are processed together.
+
+Features (dilation in mm, times in s relative to onset):
+    MeanDilation: mean dilation in the response window
+    PeakDilation: maximum dilation in the response window
+    PeakLatency: time of PeakDilation
+    AUC: area under the dilation curve in the response window (mm*s).
+        Missing samples do not contribute.
+    Slope: least squares slope of dilation in the encoding window (mm/s)
+    FinalDilation: mean dilation in the final window
+    ValidPct: fraction of samples in the response window with dilation
+Windows include their stop but not their start, as the per second bins of
+the subject files, so FinalDilation of a digit span trial is the dilation of
+the second kept by digitspan_proc_group. Window bounds are given by
+TASK_FEATURES as numbers, trial columns (e.g. Load) or (column, offset).
+
+The subject scripts write <Task>_<subject>_TrialFeatures.csv with one row
+per trial. Features of a cohort are combined with:
+    python pupil_features.py <data directory>
+which writes all trials and averages per subject and condition.
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import argparse
+import warnings
+from glob import glob
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pupil_io
+import pupil_utils
+
+TASK_FEATURES = {
+    # Response is the Record phase. Digits are read at one per second, so
+    # encoding lasts Load seconds and the final window is the second after
+    # the last digit.
+    'DigitSpan': {'trial': ['Load', 'Trial'], 'condition': 'Load',
+                  'window': (0., np.inf), 'encoding': (0., 'Load'),
+                  'final': ('Load', ('Load', 1.))},
+    # Response is the 30s RecordLetter phase. Slope is taken over the first
+    # 10s (first tertile) of word retrieval.
+    'Fluency': {'trial': ['Condition'], 'condition': 'Condition',
+                'window': (0., 30.), 'encoding': (0., 10.), 'final': (29., 30.)}}
+
+FEATURE_COLS = ['MeanDilation', 'PeakDilation', 'PeakLatency', 'AUC', 'Slope',
+                'FinalDilation', 'ValidPct']
+
+
+def get_seconds(timestamps):
+    """Seconds of datetime or timedelta values relative to zero."""
+    values = np.asarray(timestamps)
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = values.astype('datetime64[ns]').astype(np.int64)
+    else:
+        values = values.astype('timedelta64[ns]').astype(np.int64)
+    return values / 1e9
+
+
+def trial_matrix(df, trial, signal='Dilation', time='Timestamp'):
+    """Scatter long data of all trials into (trials x samples) matrices of
+    sample times (s) and signal, padded with NaN. trial is a list of columns
+    or index levels identifying trials. Returns (info, times, matrix,
+    period) where info has the trial keys (and Baseline if present) of each
+    row and period is the median sampling period."""
+    keys = pd.DataFrame(dict((key, pupil_utils.get_values(df, key)) for key in trial))
+    codes, uniques = pd.MultiIndex.from_frame(keys).factorize()
+    seconds = get_seconds(pupil_utils.get_values(df, time))
+    order = np.lexsort((seconds, codes))
+    codes, seconds = codes[order], seconds[order]
+    values = np.asarray(pupil_utils.get_values(df, signal), dtype=np.float64)[order]
+    counts = np.bincount(codes, minlength=len(uniques))
+    samples = np.arange(len(codes)) - np.repeat(np.cumsum(counts) - counts, counts)
+    times = np.full((len(uniques), counts.max()), np.nan)
+    matrix = np.full(times.shape, np.nan)
+    times[codes, samples] = seconds
+    matrix[codes, samples] = values
+    diffs = np.diff(times, axis=1)
+    period = np.nanmedian(diffs) if np.isfinite(diffs).any() else np.nan
+    info = pd.DataFrame(list(uniques), columns=trial)
+    if 'Baseline' in df.columns:
+        baseline = np.asarray(df['Baseline'], dtype=np.float64)[order]
+        info['Baseline'] = baseline[np.cumsum(counts) - counts]
+    return info, times, matrix, period
+
+
+def get_bounds(info, bound):
+    """Window bound of each trial: a number, a column of info, or a
+    (column, offset) tuple."""
+    if isinstance(bound, tuple):
+        return get_bounds(info, bound[0]) + bound[1]
+    if isinstance(bound, str):
+        return pd.to_numeric(pd.Series(info[bound].astype(str)), errors='coerce').to_numpy()
+    return np.full(len(info), float(bound))
+
+
+def window_mask(info, times, window):
+    """Samples in (start, stop] of each trial's window. Comparisons with
+    padding (NaN) are False."""
+    start, stop = [get_bounds(info, bound)[:, None] for bound in window]
+    # Tolerance for rounding of resampled times
+    with np.errstate(invalid='ignore'):
+        return (times > start + 1e-9) & (times <= stop + 1e-9)
+
+
+def extract_features(info, times, matrix, period, window, encoding, final):
+    """Compute FEATURE_COLS of every trial (row of matrix) with array
+    reductions along the sample axis."""
+    valid = ~np.isnan(matrix)
+    values = np.where(valid, matrix, 0.)
+    t = np.where(np.isnan(times), 0., times)
+    features = pd.DataFrame(index=info.index)
+    inwindow = window_mask(info, times, window)
+    mask = inwindow & valid
+    n = mask.sum(axis=1)
+    total = (values * mask).sum(axis=1)
+    rows = np.arange(len(matrix))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features['MeanDilation'] = np.where(n > 0, total / n, np.nan)
+        peakidx = np.where(mask, matrix, -np.inf).argmax(axis=1)
+        features['PeakDilation'] = np.where(n > 0, matrix[rows, peakidx], np.nan)
+        features['PeakLatency'] = np.where(n > 0, times[rows, peakidx], np.nan)
+        features['AUC'] = np.where(n > 0, total * period, np.nan)
+        # Least squares slope from sums over valid samples of each trial
+        mask = window_mask(info, times, encoding) & valid
+        n_enc = mask.sum(axis=1)
+        st, sy = (t * mask).sum(axis=1), (values * mask).sum(axis=1)
+        stt, sty = (t * t * mask).sum(axis=1), (t * values * mask).sum(axis=1)
+        denom = n_enc * stt - st ** 2
+        features['Slope'] = np.where((n_enc > 1) & (denom > 0),
+                                     (n_enc * sty - st * sy) / denom, np.nan)
+        mask = window_mask(info, times, final) & valid
+        n_final = mask.sum(axis=1)
+        features['FinalDilation'] = np.where(n_final > 0, (values * mask).sum(axis=1) / n_final, np.nan)
+        nwindow = inwindow.sum(axis=1)
+        features['ValidPct'] = np.where(nwindow > 0, n / nwindow, np.nan)
+    return features[FEATURE_COLS]
+
+
+def get_trial_features(df, subid, task, signal='Dilation', time='Timestamp'):
+    """Trial level features of one subject from baseline corrected, resampled
+    data of all trials, using the windows of TASK_FEATURES[task]."""
+    spec = TASK_FEATURES[task]
+    info, times, matrix, period = trial_matrix(df, spec['trial'], signal=signal, time=time)
+    features = extract_features(info, times, matrix, period, spec['window'],
+                                spec['encoding'], spec['final'])
+    info.insert(0, 'Subject', subid)
+    info.insert(1, 'Task', task)
+    return pd.concat([info, features], axis=1)
+
+
+def read_features(filelist):
+    dtype = {'Subject': 'category', 'Task': 'category', 'Condition': 'category',
+             'Trial': 'category', 'Load': 'category'}
+    return pupil_io.read_csv_files(filelist, dtype=dtype)
+
+
+def average_features(features, condition):
+    """Average features over trials of each subject and condition, with the
+    number of trials with a response (ntrials)."""
+    cols = [col for col in FEATURE_COLS + ['Baseline'] if col in features.columns]
+    grouped = features.groupby(['Subject', condition], observed=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        averaged = grouped[cols].mean()
+    averaged['ntrials'] = grouped['MeanDilation'].count()
+    return averaged.reset_index()
+
+
+def proc_features(datadir):
+    """Combine trial features of all subjects in datadir. Writes all trials
+    and averages per subject and condition of each task."""
+    filelist = sorted(glob(os.path.join(datadir, '*_TrialFeatures.csv')))
+    tstamp = datetime.now().strftime("%Y-%m-%d")
+    for task, spec in sorted(TASK_FEATURES.items()):
+        taskfiles = [f for f in filelist if os.path.basename(f).startswith(task + '_')]
+        if not taskfiles:
+            continue
+        features = read_features(taskfiles)
+        prefix = os.path.join(datadir, task + '_features_')
+        features.to_csv(prefix + 'trials_' + tstamp + '.csv', index=False)
+        average_features(features, spec['condition']).to_csv(
+            prefix + 'subjects_' + tstamp + '.csv', index=False)
+        print('{0}: features of {1} trials of {2} subjects'.format(
+            task, len(features), features.Subject.nunique()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Combine trial level pupil
+                                     features of processed subjects.""")
+    parser.add_argument('datadir', help='Directory of *_TrialFeatures.csv files.')
+    args = parser.parse_args()
+    proc_features(args.datadir)
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Longitudinal index of processed pupil outputs across VETSA waves.
+
+Wave 2/3 NeurOptics outputs and wave 4 Tobii outputs are kept in separate
+directory trees with different naming conventions. This script walks those
+trees and records in an SQLite database which files belong to each VETSAID,
+wave and task, along with summary metrics. The index is updated
+incrementally: only files that are new or have changed since the last run
+are read, and files that no longer exist are removed.
+
+Tables:
+    files: path, mtime, size, vetsaid, wave, task, kind
+    metrics: path, vetsaid, wave, task, kind, condition, seconds, measure, value
+
+Metrics are stored from:
+    Tobii subject files (kind 'processed', 'tertiles'): Dilation, Baseline,
+        Diameter, BlinkPct and ntrials of each condition and second.
+    NeurOptics DS templates (kind 'template', createPupilTemplate.py): mean
+        Diameter of each subject, load and second of the 30Hz profiles, with
+        the same (s-1, s] bins as the Tobii files, and ntrials. Templates are
+        not baseline corrected, so Dilation is only available for wave 4.
+    NeurOptics PLR metrics (kind 'plrmetrics', computePLRMetrics.py): mean of
+        each metric over the records of a subject.
+Parsed NeurOptics files and plots are indexed without metrics. Templates and
+PLR metric files hold a whole cohort and are stored in files without a
+VETSAID.
+
+Tasks are stored as 'digitspan', 'fluency', 'plr' and 'cfrec' for both
+devices. Wave is taken from a 'VETSA <n>' or 'Wave <n>' folder in the path if
+present, otherwise Tobii files are assigned wave 4 and NeurOptics files the
+wave given on the command line.
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import re
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# Filename patterns: (regex, device, task, kind). The first group is the ID,
+# patterns of cohort files have no group.
+FILE_PATTERNS = [
+    (r'^DigitSpan_(\d{5}[AB])_ProcessedPupil\.csv$', 'tobii', 'digitspan', 'processed'),
+    (r'^DigitSpan_(\d{5}[AB])_PupilPlot\.png$', 'tobii', 'digitspan', 'plot'),
+    (r'^Fluency_(\d{5}[AB])_ProcessedPupil\.csv$', 'tobii', 'fluency', 'processed'),
+    (r'^Fluency_(\d{5}[AB])_ProcessedPupil_Tertiles\.csv$', 'tobii', 'fluency', 'tertiles'),
+    (r'^Fluency_(\d{5}[AB])_PupilPlot\.png$', 'tobii', 'fluency', 'plot'),
+    (r'^(\d{5}[AB])_Pupil_DS_Parsed_\d+\.csv$', 'neuroptics', 'digitspan', 'parsed'),
+    (r'^(\d{5}[AB])_Pupil_PLR_Parsed_\d+\.csv$', 'neuroptics', 'plr', 'parsed'),
+    (r'^(\d{5}[AB])_Pupil_CFREC_Parsed_\d+\.csv$', 'neuroptics', 'cfrec', 'parsed'),
+    (r'^DS_Template_\d+\.(?:xlsx|csv|parquet)$', 'neuroptics', 'digitspan', 'template'),
+    (r'^PLR_Metrics_\d+\.csv$', 'neuroptics', 'plr', 'plrmetrics'),
+]
+
+# Summary measures stored from Tobii subject level files
+MEASURES = ['Dilation', 'Baseline', 'Diameter', 'BlinkPct', 'ntrials']
+# Column that identifies the condition in each task
+CONDITION_COLS = {'digitspan': 'Load', 'fluency': 'Condition'}
+# Sampling rate of NeurOptics pupil profiles (Hz)
+NEUROPTICS_RATE = 30.
+# Metrics of computePLRMetrics.py stored as subject averages
+PLR_MEASURES = ['Init', 'Min', 'Amplitude', 'ConstrictionPct', 'Latency',
+                'MaxConstrictionVel', 'MeanConstrictionVel', 'DilationVel',
+                'Recovery75']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+    vetsaid TEXT, wave INTEGER, task TEXT, kind TEXT);
+CREATE TABLE IF NOT EXISTS metrics (
+    path TEXT, vetsaid TEXT, wave INTEGER, task TEXT, kind TEXT,
+    condition TEXT, seconds REAL, measure TEXT, value REAL);
+CREATE INDEX IF NOT EXISTS idx_files_sub ON files (vetsaid, task, wave);
+CREATE INDEX IF NOT EXISTS idx_metrics_sub ON metrics (task, kind, measure, condition, vetsaid);
+CREATE INDEX IF NOT EXISTS idx_metrics_path ON metrics (path);
+"""
+
+
+def connect(dbfile):
+    """Open index database, creating tables if needed."""
+    con = sqlite3.connect(dbfile)
+    con.executescript(SCHEMA)
+    return con
+
+
+def match_file(fname):
+    """Return (vetsaid, device, task, kind) if file is a recognized output,
+    otherwise None. vetsaid is None for cohort files."""
+    fname_base = os.path.basename(fname)
+    for pattern, device, task, kind in FILE_PATTERNS:
+        match = re.match(pattern, fname_base, re.IGNORECASE)
+        if match:
+            vetsaid = match.group(1).upper() if match.re.groups else None
+            return vetsaid, device, task, kind
+    return None
+
+
+def get_wave(fname, device, default_wave=None):
+    """Get wave from a VETSA/Wave folder in the path. Tobii data were only
+    collected in wave 4."""
+    match = re.search(r'(?:VETSA|Wave)[ _]?(\d)', fname, re.IGNORECASE)
+    if match:
+        return int(match.group(1))
+    if device == 'tobii':
+        return 4
+    return default_wave
+
+
+def read_processed(fname, task, vetsaid):
+    """Summary metrics of a Tobii subject level processed file."""
+    condcol = CONDITION_COLS[task]
+    df = pd.read_csv(fname)
+    measures = [col for col in MEASURES if col in df.columns]
+    df = df.rename(columns={condcol: 'condition', 'Seconds': 'seconds'})
+    df['condition'] = df['condition'].astype(str)
+    df['vetsaid'] = vetsaid
+    return df.melt(id_vars=['vetsaid', 'condition', 'seconds'], value_vars=measures,
+                   var_name='measure', value_name='value')
+
+
+def read_template(fname, task, vetsaid):
+    """Mean diameter of each subject, load and second of a NeurOptics DS
+    template. Load is taken from Bx Trial (e.g. S9a)."""
+    if fname.lower().endswith('.xlsx'):
+        df = pd.read_excel(fname)
+    elif fname.lower().endswith('.parquet'):
+        df = pd.read_parquet(fname)
+    else:
+        df = pd.read_csv(fname)
+    datacols = [col for col in df.columns if str(col).endswith('data pt')]
+    profiles = df[datacols].to_numpy(dtype=np.float64)
+    # Bins (s-1, s] labeled by their end, as the Tobii per second data
+    seconds = np.ceil(np.arange(len(datacols)) / NEUROPTICS_RATE - 1e-9)
+    bysecond = pd.DataFrame(profiles.T).groupby(seconds).mean().T
+    bysecond['vetsaid'] = df['ID'].astype(str).str.upper().to_numpy()
+    bysecond['condition'] = df['Bx Trial'].astype(str).str.extract(r'^S(\d+)', expand=False).to_numpy()
+    grouped = bysecond.groupby(['vetsaid', 'condition'])
+    means = grouped.mean().stack(dropna=False).rename('value').reset_index()
+    means.columns = ['vetsaid', 'condition', 'seconds', 'value']
+    means['measure'] = 'Diameter'
+    ntrials = grouped.size().rename('value').reset_index()
+    ntrials['seconds'] = np.nan
+    ntrials['measure'] = 'ntrials'
+    return pd.concat([means, ntrials], ignore_index=True)[
+        ['vetsaid', 'condition', 'seconds', 'measure', 'value']]
+
+
+def read_plr_metrics(fname, task, vetsaid):
+    """Mean PLR metrics of each subject of a computePLRMetrics.py output."""
+    df = pd.read_csv(fname)
+    measures = [col for col in PLR_MEASURES if col in df.columns]
+    df['vetsaid'] = df['Subject ID'].astype(str).str.upper()
+    grouped = df.groupby('vetsaid')
+    means = grouped[measures].mean()
+    means['ntrials'] = grouped.size()
+    metrics = means.reset_index().melt(id_vars='vetsaid', var_name='measure',
+                                       value_name='value')
+    metrics['condition'] = None
+    metrics['seconds'] = np.nan
+    return metrics[['vetsaid', 'condition', 'seconds', 'measure', 'value']]
+
+
+METRIC_READERS = {'processed': read_processed, 'tertiles': read_processed,
+                  'template': read_template, 'plrmetrics': read_plr_metrics}
+
+
+def read_metrics(fname, task, kind, vetsaid=None):
+    """Read summary metrics of an indexed file in long format with columns:
+    vetsaid, condition, seconds, measure, value. Returns None for files
+    without metrics."""
+    if kind not in METRIC_READERS:
+        return None
+    if kind in ['processed', 'tertiles'] and task not in CONDITION_COLS:
+        return None
+    return METRIC_READERS[kind](fname, task, vetsaid)
+
+
+def walk_files(datadirs):
+    """Yield paths of all recognized files under the data directories."""
+    for datadir in datadirs:
+        for root, dirs, files in os.walk(datadir):
+            for fname in files:
+                if match_file(fname):
+                    yield os.path.abspath(os.path.join(root, fname))
+
+
+def update_index(dbfile, datadirs, wave=None):
+    """Add new or changed files under datadirs to the index and remove files
+    that no longer exist. Returns number of files updated and removed."""
+    con = connect(dbfile)
+    indexed = dict(((path, (mtime, size)) for path, mtime, size in
+                    con.execute('SELECT path, mtime, size FROM files')))
+    seen = set()
+    nupdated = 0
+    for path in walk_files(datadirs):
+        seen.add(path)
+        stat = os.stat(path)
+        if indexed.get(path) == (stat.st_mtime, stat.st_size):
+            continue
+        vetsaid, device, task, kind = match_file(path)
+        filewave = get_wave(path, device, default_wave=wave)
+        metrics = read_metrics(path, task, kind, vetsaid=vetsaid)
+        with con:
+            con.execute('DELETE FROM metrics WHERE path = ?', (path,))
+            con.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (path, stat.st_mtime, stat.st_size, vetsaid, filewave, task, kind))
+            if metrics is not None:
+                rows = ((path, subid, filewave, task, kind, cond,
+                         None if pd.isnull(secs) else float(secs), measure,
+                         None if pd.isnull(value) else float(value))
+                        for subid, cond, secs, measure, value in metrics.itertuples(index=False, name=None))
+                con.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        nupdated += 1
+    # Remove files from scanned directories that no longer exist
+    scanned = tuple(os.path.join(os.path.abspath(d), '') for d in datadirs)
+    removed = [path for path in indexed if path.startswith(scanned) and path not in seen]
+    with con:
+        for path in removed:
+            con.execute('DELETE FROM metrics WHERE path = ?', (path,))
+            con.execute('DELETE FROM files WHERE path = ?', (path,))
+    con.close()
+    return nupdated, len(removed)
+
+
+def build_where(clauses):
+    """Build WHERE clause and parameters from list of (column, values)."""
+    sql, params = [], []
+    for col, values in clauses:
+        if values is None:
+            continue
+        if isinstance(values, (str, int, float)):
+            values = [values]
+        values = list(values)
+        sql.append('{} IN ({})'.format(col, ','.join('?' * len(values))))
+        params.extend(values)
+    return (' WHERE ' + ' AND '.join(sql) if sql else ''), params
+
+
+def query_metrics(dbfile, task, measure=None, condition=None, vetsaids=None,
+                  waves=None, seconds=None, kind=['processed', 'template']):
+    """Query summary metrics, e.g. digit span load 9 diameter across waves
+    (wave 4 processed files and wave 2/3 templates):
+        query_metrics(dbfile, 'digitspan', 'Diameter', condition='9')
+    Dilation is only stored for wave 4. Fluency tertile summaries are
+    returned with kind='tertiles' and PLR metrics with kind='plrmetrics'."""
+    if condition is not None and not isinstance(condition, (list, tuple)):
+        condition = [condition]
+    if condition is not None:
+        condition = [str(c) for c in condition]
+    where, params = build_where([('task', task), ('kind', kind), ('measure', measure),
+                            ('condition', condition), ('vetsaid', vetsaids),
+                            ('wave', waves), ('seconds', seconds)])
+    con = connect(dbfile)
+    df = pd.read_sql_query('SELECT vetsaid, wave, task, kind, condition, seconds, measure, value '
+                           'FROM metrics' + where + ' ORDER BY vetsaid, wave, condition, seconds',
+                           con, params=params)
+    con.close()
+    return df
+
+
+def query_files(dbfile, vetsaids=None, task=None, waves=None, kind=None):
+    """Query indexed output files for subjects, task, wave and file kind."""
+    where, params = build_where([('vetsaid', vetsaids), ('task', task),
+                            ('wave', waves), ('kind', kind)])
+    con = connect(dbfile)
+    df = pd.read_sql_query('SELECT vetsaid, wave, task, kind, path FROM files' + where +
+                           ' ORDER BY vetsaid, wave, task, kind', con, params=params)
+    con.close()
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Build or update index of
+                                     processed pupil outputs across waves.""")
+    parser.add_argument('dbfile', help='SQLite index file (created if missing).')
+    parser.add_argument('datadirs', nargs='+', help='Directories to scan.')
+    parser.add_argument('--wave', type=int, default=None,
+                        help='Wave of NeurOptics files if not found in path.')
+    args = parser.parse_args()
+    nupdated, nremoved = update_index(args.dbfile, args.datadirs, wave=args.wave)
+    print('Indexed {0} new or changed files, removed {1}'.format(nupdated, nremoved))
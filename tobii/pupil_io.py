@@ -0,0 +1,324 @@
+"""
+Readers and writers shared by the Tobii and NeurOptics scripts.
+
+Many parsed or processed pupil files are read concurrently on a thread pool
+with explicit dtypes (float32 pupil profiles, categorical IDs) and only the
+requested columns, then combined with a single concatenation.
+
+Subject level scripts prefetch the next raw file and write outputs on
+background threads so that I/O overlaps with processing.
+"""
+from __future__ import division, print_function, absolute_import
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+# Metadata columns of NeurOptics files created by parsePupilData.py. All
+# remaining columns hold the pupil profile and are named by their time point.
+PARSED_PUPIL_DTYPES = {'Subject ID': 'category', 'Device ID': 'category',
+                       'Eye Measured': 'category', 'Record ID': 'category',
+                       'Profile Normal': 'category',
+                       'Measurement Duration': 'category',
+                       'Date': str, 'Time': str}
+
+# Subject level files created by the Tobii *_proc_subject.py scripts
+PROCESSED_PUPIL_DTYPES = {'Subject': 'category', 'Timestamp': str}
+
+# Opt-in compact schema of subject level files: float32 signals, small int
+# counts and categorical IDs and labels. Time is given by numeric Seconds, so
+# the formatted Timestamp is not stored.
+COMPACT_PUPIL_DTYPES = {'Subject': 'category', 'Load': 'category',
+                        'Condition': 'category', 'Task': 'category',
+                        'Seconds': 'float32', 'Dilation': 'float32',
+                        'Baseline': 'float32', 'Diameter': 'float32',
+                        'BlinkPct': 'float32', 'ntrials': 'UInt8',
+                        'Trial': 'category', 'ValidPct': 'float32',
+                        'BaselineBlinks': 'float32', 'BaselineSD': 'float32',
+                        'MeanDilation': 'float32', 'PeakDilation': 'float32',
+                        'PeakLatency': 'float32', 'AUC': 'float32',
+                        'Slope': 'float32', 'FinalDilation': 'float32'}
+
+# Event and label columns of raw Tobii exports, read as categories
+GAZEDATA_LABEL_COLS = ['CurrentObject', 'DigitList', 'Condition', 'TrialId']
+
+# Columns of raw Tobii exports used by the processing scripts. Only these are
+# read from raw files.
+GAZEDATA_COLS = ['Subject', 'Session', 'RTTime', 'CurrentObject', 'DigitList',
+                 'Condition', 'TrialId', 'Load', 'CRESP', 'ACC', 'RT',
+                 'PupilDiameterLeftEye', 'PupilDiameterRightEye',
+                 'PupilValidityLeftEye', 'PupilValidityRightEye']
+
+# Pupil columns of raw Tobii exports. Tokens that are not numbers are missing.
+GAZEDATA_PUPIL_COLS = ['PupilDiameterLeftEye', 'PupilDiameterRightEye']
+
+
+def is_profile_col(col):
+    """Profile columns of parsed NeurOptics files are named by time point
+    (e.g., '0.000000000', '0.033333333')."""
+    try:
+        float(col)
+        return True
+    except ValueError:
+        return False
+
+
+def parsed_pupil_dtypes(columns, profile_dtype='float32'):
+    """Build dtype map for a parsed NeurOptics file given its header."""
+    dtypes = {}
+    for col in columns:
+        if is_profile_col(col):
+            dtypes[col] = profile_dtype
+        elif col in PARSED_PUPIL_DTYPES:
+            dtypes[col] = PARSED_PUPIL_DTYPES[col]
+        else:
+            dtypes[col] = str
+    return dtypes
+
+
+def read_header(fname, sep=','):
+    """Return list of column names without reading data."""
+    return list(pd.read_csv(fname, sep=sep, nrows=0).columns)
+
+
+def read_typed_csv(fname, usecols=None, dtype=None, sep=',', preprocess=None):
+    """Read a single file with explicit dtypes. dtype can either be a dict or
+    a function that takes the column names in the header and returns a dict.
+    Optional preprocess function is applied to the dataframe after reading."""
+    if callable(dtype):
+        header = read_header(fname, sep=sep)
+        if callable(usecols):
+            header = [c for c in header if usecols(c)]
+        elif usecols is not None:
+            header = [c for c in header if c in usecols]
+        dtype = dtype(header)
+    df = pd.read_csv(fname, sep=sep, usecols=usecols, dtype=dtype)
+    if preprocess is not None:
+        df = preprocess(df, fname)
+    return df
+
+
+def union_categories(frames):
+    """Give categorical columns the same categories in every frame so that
+    concatenation keeps them categorical rather than falling back to object.
+    Returns new frames, so frames that are slices of other frames can be
+    passed without modifying them."""
+    catcols = set()
+    for df in frames:
+        catcols.update(df.select_dtypes(include='category').columns)
+    dtypes = {}
+    for col in catcols:
+        cats = pd.Index([])
+        for df in frames:
+            if col in df.columns:
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    cats = cats.union(df[col].cat.categories)
+                else:
+                    cats = cats.union(df[col].dropna().unique())
+        dtypes[col] = pd.CategoricalDtype(cats)
+    return [df.astype(dict((col, dtype) for col, dtype in dtypes.items() if col in df.columns))
+            for df in frames]
+
+
+def read_csv_files(filelist, usecols=None, dtype=None, sep=',',
+                   preprocess=None, max_workers=None, verbose=False):
+    """Read list of csv files concurrently and concatenate into one dataframe.
+    Row order follows the order of filelist.
+        filelist: paths of files to read
+        usecols: list of columns (or function of column name) to load
+        dtype: dict or function of header returning dict of column dtypes
+        preprocess: function of (df, fname) applied to each file after reading
+        max_workers: number of threads, defaults to ThreadPoolExecutor default
+    """
+    def _read(fname):
+        if verbose:
+            print("Loading {}".format(fname))
+        return read_typed_csv(fname, usecols=usecols, dtype=dtype, sep=sep,
+                              preprocess=preprocess)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(_read, filelist))
+    frames = union_categories(frames)
+    return pd.concat(frames, ignore_index=True, sort=False, copy=False)
+
+
+def compact_frame(df):
+    """Convert subject level output to the compact schema."""
+    df = df.drop(columns=['Timestamp'], errors='ignore')
+    dtypes = dict((col, dtype) for col, dtype in COMPACT_PUPIL_DTYPES.items() if col in df.columns)
+    return df.astype(dtypes)
+
+
+def to_typed_array(values):
+    """Convert object array of cell values to a numeric array if possible.
+    Empty cells (None) become NaN."""
+    try:
+        return pd.to_numeric(values)
+    except (ValueError, TypeError):
+        return values
+
+
+def read_xlsx(fname, usecols=None, chunksize=20000):
+    """Read the first sheet of an .xlsx file. Rows are streamed in read-only
+    mode without building the openpyxl cell objects, only usecols (all if
+    None) are kept and each chunk of rows is converted to typed arrays, so
+    only one chunk of cell values is held at a time. Columns are numeric
+    where possible as with pd.read_excel; label columns are categories."""
+    import openpyxl
+    wb = openpyxl.load_workbook(fname, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        columns = [(i, col) for i, col in enumerate(header)
+                   if col is not None and (usecols is None or col in usecols)]
+        chunks = dict((col, []) for i, col in columns)
+        while True:
+            chunk = [row for _, row in zip(range(chunksize), rows)]
+            if not chunk:
+                break
+            # Pad short rows (trailing empty cells are not returned)
+            width = len(header)
+            chunk = [row + (None,) * (width - len(row)) if len(row) < width else row
+                     for row in chunk]
+            values = np.array(chunk, dtype=object)
+            for i, col in columns:
+                chunks[col].append(to_typed_array(values[:, i]))
+    finally:
+        wb.close()
+    data = {}
+    for i, col in columns:
+        if not chunks[col]:
+            data[col] = np.array([], dtype=np.float64)
+            continue
+        # Chunks of a column may have different types (e.g. int and float);
+        # object chunks make the whole column object
+        kinds = set(chunk.dtype.kind for chunk in chunks[col])
+        if 'O' in kinds:
+            data[col] = to_typed_array(np.concatenate([c.astype(object) for c in chunks[col]]))
+        else:
+            data[col] = np.concatenate(chunks[col])
+    df = pd.DataFrame(data, columns=[col for i, col in columns])
+    labelcols = [col for col in GAZEDATA_LABEL_COLS if col in df.columns]
+    df[labelcols] = df[labelcols].astype('category')
+    return df
+
+
+def read_tsv(fname, usecols=None):
+    """Read a tab delimited raw Tobii export. Only usecols (all if None) are
+    parsed. The file is tokenized on multiple threads by the pyarrow CSV
+    reader (pandas C parser if pyarrow is not installed) with pupil columns
+    declared as float64, so they are ready for deblinking. If a pupil column
+    contains tokens that are not numbers, it is parsed as text and those
+    tokens are set to missing. Label columns are categories with sorted
+    categories as with pd.read_csv."""
+    header = read_header(fname, sep='\t')
+    cols = [col for col in header if usecols is None or col in usecols]
+    pupilcols = [col for col in GAZEDATA_PUPIL_COLS if col in cols]
+    labelcols = [col for col in GAZEDATA_LABEL_COLS if col in cols]
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pacsv
+    except ImportError:
+        dtype = dict((col, 'category') for col in labelcols)
+        df = pd.read_csv(fname, sep='\t', usecols=cols, dtype=dtype)
+        df[pupilcols] = df[pupilcols].apply(pd.to_numeric, errors='coerce')
+        return df
+    coltypes = dict((col, pa.dictionary(pa.int32(), pa.string())) for col in labelcols)
+    coltypes.update((col, pa.float64()) for col in pupilcols)
+    read_options = pacsv.ReadOptions(use_threads=True)
+    parse_options = pacsv.ParseOptions(delimiter='\t')
+    try:
+        table = pacsv.read_csv(fname, read_options=read_options, parse_options=parse_options,
+                               convert_options=pacsv.ConvertOptions(
+                                   include_columns=cols, column_types=coltypes,
+                                   strings_can_be_null=True))
+        badcols = []
+    except pa.ArrowInvalid:
+        coltypes.update((col, pa.string()) for col in pupilcols)
+        table = pacsv.read_csv(fname, read_options=read_options, parse_options=parse_options,
+                               convert_options=pacsv.ConvertOptions(
+                                   include_columns=cols, column_types=coltypes,
+                                   strings_can_be_null=True))
+        badcols = pupilcols
+    df = table.to_pandas()
+    for col in badcols:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in labelcols:
+        df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+    return df
+
+
+def read_gazedata(fname):
+    """Read raw Tobii export. Tab delimited .gazedata, .csv and .txt files
+    (see read_tsv) as well as .xlsx files (see read_xlsx) are supported. Only
+    GAZEDATA_COLS are read. Event and label columns are returned as
+    categories."""
+    if fname.lower().endswith(".gazedata") | fname.lower().endswith(".csv") | fname.lower().endswith(".txt"):
+        df = read_tsv(fname, usecols=GAZEDATA_COLS)
+    elif fname.lower().endswith(".xlsx"):
+        df = read_xlsx(fname, usecols=GAZEDATA_COLS)
+    else:
+        raise IOError('Could not open {}'.format(fname))
+    return df
+
+
+def prefetch(items, load, depth=2):
+    """Iterate over (item, load(item)) while the next items are loaded on a
+    background thread. At most depth items are loaded ahead of the one being
+    processed, which bounds memory use."""
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        nextidx = 0
+        for i, item in enumerate(items):
+            while nextidx < len(items) and nextidx <= i + depth:
+                pending.append(executor.submit(load, items[nextidx]))
+                nextidx += 1
+            yield item, pending.popleft().result()
+
+
+class OutputWriter(object):
+    """Runs output jobs (writing csv files, saving plots) on background
+    threads so the next subject can be processed while outputs are written.
+    submit() blocks once max_pending jobs are queued or running. Errors raised
+    by jobs are re-raised when the writer is closed. Jobs must not share
+    dataframes that are modified after submission.
+
+    Usage:
+        with OutputWriter() as writer:
+            writer.submit(df.to_csv, outfile, index=False)
+    """
+    def __init__(self, max_workers=1, max_pending=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, func, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        """Wait for all jobs to finish and raise first error, if any."""
+        self.executor.shutdown(wait=True)
+        errors = [f.exception() for f in self.futures if f.exception() is not None]
+        self.futures = []
+        if errors:
+            raise errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True)
+        return False
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+QC plots of processed subject data.
+
+Figures are drawn with the object oriented matplotlib API (Figure and Agg
+canvas) instead of global pyplot state, so they can be rendered in worker
+processes or threads. Per-subject plots are rendered from the
+*_ProcessedPupil.csv files written by the task scripts, so rendering can be
+run separately from processing. Plots of a whole cohort can be combined
+into tiled mosaic images and an HTML index for fast visual review.
+
+Usage:
+    python pupil_qc.py <data directory> [--jobs N] [--mosaic] [--html]
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import argparse
+from glob import glob
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import seaborn as sns
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib.image as mpimg
+
+
+def plot_digitspan(pupildf, ax):
+    """Plot dilation by load."""
+    palette = sns.cubehelix_palette(len(pupildf.Load.unique()))
+    sns.lineplot(data=pupildf, x="Seconds",y="Dilation", hue="Load", palette=palette, legend="brief", errorbar=None, ax=ax)
+    ax.set_ylim(-.2, .5)
+
+
+def plot_fluency(pupildf, ax):
+    """Plot dilation by condition with baseline and instruction periods shaded."""
+    # Define a custom color palette
+    condition_colors = {'C': 'blue', 'L': 'dodgerblue', 'GirlsNames': 'red',  'Vegetables': 'lightcoral'}
+    palette = [condition_colors[condition] for condition in pupildf.Condition.unique()]
+    sns.lineplot(data=pupildf, x="Seconds", y="Dilation", hue="Condition", palette=palette, legend="brief", errorbar=None, ax=ax)
+    ax.set_ylim(-1.0, 1.0)
+    # Set the ordering of the legend
+    handles, labels = ax.get_legend_handles_labels()
+    ordered_labels = ['C', 'L', 'GirlsNames', 'Vegetables']
+    ordered_handles = [handles[labels.index(label)] for label in ordered_labels]
+    ax.legend(ordered_handles, ordered_labels, loc='best')
+    # Add shading for baseline period
+    ax.axvspan(-6, -4, alpha=0.2, color='lightgreen', zorder=0)
+    # Add shading for instruction period
+    ax.axvspan(-4, 0, alpha=0.4, color='lightgray', zorder=0)
+
+
+# Plot function and seaborn style for each task, keyed by output file prefix
+TASK_PLOTS = {'DigitSpan': (plot_digitspan, None),
+              'Fluency': (plot_fluency, 'ticks')}
+
+
+def save_plot(plotfunc, pupildf, outfile, style=None, title=None, figsize=None, **kwargs):
+    """Draw plotfunc(pupildf, ax) on a new figure and save to outfile. Seaborn
+    style, if given, is only applied to this figure. Other keyword arguments
+    (e.g. dpi) are passed to savefig."""
+    with (sns.axes_style(style) if style else nullcontext()):
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        plotfunc(pupildf, ax)
+    if title:
+        ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(outfile, **kwargs)
+    return outfile
+
+
+def get_plot_outname(pupil_fname):
+    return pupil_fname.replace("_ProcessedPupil.csv", "_PupilPlot.png")
+
+
+def render_subject(pupil_fname):
+    """Render QC plot from a subject's processed file. Returns path of plot,
+    or None if the data could not be plotted."""
+    task = os.path.basename(pupil_fname).split('_')[0]
+    plotfunc, style = TASK_PLOTS[task]
+    pupildf = pd.read_csv(pupil_fname)
+    subid = str(pupildf['Subject'].iat[0]) if 'Subject' in pupildf.columns else None
+    try:
+        return save_plot(plotfunc, pupildf, get_plot_outname(pupil_fname),
+                         style=style, title=subid)
+    except (KeyError, ValueError) as e:
+        print("Skipping plotting of {0}: {1}".format(pupil_fname, e))
+        return None
+
+
+def render_all(filelist, jobs=None):
+    """Render QC plots for all processed files in worker processes."""
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        plotfiles = list(executor.map(render_subject, filelist, chunksize=4))
+    return [f for f in plotfiles if f is not None]
+
+
+def make_mosaic(plotfiles, outfile, ncols=6, nrows=6, scale=2):
+    """Tile plots into mosaic images of ncols x nrows plots. Plots are
+    downsampled by taking every scale-th pixel. If there are more plots than
+    fit on one image, additional pages are numbered. Returns list of mosaic
+    files."""
+    pagesize = ncols * nrows
+    outbase, outext = os.path.splitext(outfile)
+    mosaics = []
+    for page, start in enumerate(range(0, len(plotfiles), pagesize)):
+        tiles = [mpimg.imread(f)[::scale, ::scale, :3] for f in plotfiles[start:start+pagesize]]
+        tile_h = max(t.shape[0] for t in tiles)
+        tile_w = max(t.shape[1] for t in tiles)
+        rows_used = int(np.ceil(len(tiles) / ncols))
+        mosaic = np.ones((rows_used * tile_h, min(len(tiles), ncols) * tile_w, 3), dtype=np.float32)
+        for i, tile in enumerate(tiles):
+            r, c = divmod(i, ncols)
+            mosaic[r*tile_h:r*tile_h+tile.shape[0], c*tile_w:c*tile_w+tile.shape[1]] = tile
+        if len(plotfiles) > pagesize:
+            mosaic_fname = '{0}_{1:03d}{2}'.format(outbase, page + 1, outext)
+        else:
+            mosaic_fname = outfile
+        mpimg.imsave(mosaic_fname, mosaic)
+        mosaics.append(mosaic_fname)
+    return mosaics
+
+
+def make_html_index(plotfiles, outfile, width=320):
+    """Write HTML page with thumbnails of all plots linking to full size."""
+    outdir = os.path.dirname(os.path.abspath(outfile))
+    lines = ['<html><head><title>Pupil QC</title></head><body>',
+             '<h1>Pupil QC ({} plots)</h1>'.format(len(plotfiles))]
+    for plotfile in sorted(plotfiles):
+        relpath = os.path.relpath(os.path.abspath(plotfile), outdir).replace(os.sep, '/')
+        label = os.path.basename(plotfile).replace('_PupilPlot.png', '')
+        lines.append('<div style="display:inline-block;margin:4px;text-align:center">'
+                     '<a href="{0}"><img src="{0}" width="{1}"></a><br>{2}</div>'.format(relpath, width, label))
+    lines.append('</body></html>')
+    with open(outfile, 'w') as f:
+        f.write('\n'.join(lines))
+    return outfile
+
+
+def proc_qc(datadir, jobs=None, mosaic=False, html=False, filelist=None):
+    """Render QC plots of all processed files in datadir, or of filelist if
+    given. Mosaics and HTML index are written to datadir."""
+    if filelist is None:
+        filelist = sorted(glob(os.path.join(datadir, '*_ProcessedPupil.csv')))
+    plotfiles = render_all(filelist, jobs=jobs)
+    print('Rendered {} QC plots'.format(len(plotfiles)))
+    if mosaic and plotfiles:
+        mosaics = make_mosaic(plotfiles, os.path.join(datadir, 'QC_mosaic.png'))
+        print('Wrote {} mosaic images'.format(len(mosaics)))
+    if html and plotfiles:
+        indexfile = make_html_index(plotfiles, os.path.join(datadir, 'QC_index.html'))
+        print('Wrote QC index to {}'.format(indexfile))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Render QC plots from
+                                     processed subject files.""")
+    parser.add_argument('datadir', help='Directory of *_ProcessedPupil.csv files.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of worker processes (default: all CPUs).')
+    parser.add_argument('--mosaic', action='store_true', help='Write tiled mosaic images.')
+    parser.add_argument('--html', action='store_true', help='Write HTML index of plots.')
+    args = parser.parse_args()
+    proc_qc(args.datadir, jobs=args.jobs, mosaic=args.mosaic, html=args.html)
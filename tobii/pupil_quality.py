@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Quality scoring and exclusion of pupil data.
+
+The subject scripts write a quality table (<Task>_<subject>_Quality.csv)
+with one row per trial and second:
+    Subject, Task, Condition, Trial, Seconds
+    BlinkPct: fraction of samples flagged as blinks
+    ValidPct: fraction of samples with pupil data before interpolation
+    Baseline, BaselineBlinks, BaselineSD: baseline pupil size, fraction of
+        blinks and standard deviation of pupil size in the baseline window
+    Diameter, Dilation: mean pupil size and dilation
+
+Quality tables of a cohort are summarized per trial and per subject (adding
+number of trials and BaselineStability, the SD of baselines across trials)
+in a few groupby passes. Exclusion rules are given per level as lists of
+(column, operator, threshold):
+    {'second': [('BlinkPct', '>', .5)],
+     'trial': [('BaselineBlinks', '>', .5)],
+     'subject': [('ntrials', '<', 2)]}
+Rules at trial and subject level refer to columns of the trial and subject
+summaries. Missing values only meet the '!=' and 'missing' operators. Since
+the quality table holds trial level data, an exclusion policy can be changed
+and averages recomputed (average_trials) without reprocessing raw data.
+
+Usage:
+    python pupil_quality.py <data directory> [--rules rules.json] [--average]
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import json
+import argparse
+import operator
+from glob import glob
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pupil_io
+import pupil_utils
+
+QUALITY_DTYPES = {'Subject': 'category', 'Task': 'category',
+                  'Condition': 'category', 'Trial': 'category'}
+QUALITY_COLS = ['Subject', 'Task', 'Condition', 'Trial', 'Seconds', 'BlinkPct',
+                'ValidPct', 'Baseline', 'BaselineBlinks', 'BaselineSD',
+                'Diameter', 'Dilation']
+
+# Exclusion rules applied by the processing scripts. Baselines of digit span
+# trials with more than 50% blinks are already set to missing when they are
+# computed (digitspan_proc_subject.BASELINE).
+QUALITY_RULES = {'DigitSpan': {'second': [('BlinkPct', '>', .5)]},
+                 'Fluency': {'second': [('BlinkPct', '>', .5)],
+                             'subject': [('BlinkPct', '>', .5)]}}
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt,
+             '<=': operator.le, '==': operator.eq, '!=': operator.ne}
+
+
+def get_valid(df, signal='PupilDiameterLRSmooth'):
+    """Mark resampled samples with pupil data before interpolation."""
+    return df[signal].notnull().astype(np.float64)
+
+
+def get_quality_table(df, subid, task, condition, trial, signal='PupilDiameterLRFilt',
+                      blinks='BlinksLR', valid='ValidLR'):
+    """Quality table of one subject from baseline corrected data averaged
+    per second. condition and trial are columns of df."""
+    seconds = pupil_utils.convert_timestamp(df['Timestamp']).dt.total_seconds()
+    quality = pd.DataFrame({'Subject': subid, 'Task': task,
+                            'Condition': df[condition].to_numpy(),
+                            'Trial': df[trial].to_numpy(),
+                            'Seconds': seconds.to_numpy(),
+                            'BlinkPct': df[blinks].to_numpy(),
+                            'ValidPct': df[valid].to_numpy(),
+                            'Baseline': df['Baseline'].to_numpy(),
+                            'BaselineBlinks': df['BaselineBlinks'].to_numpy(),
+                            'BaselineSD': df['BaselineSD'].to_numpy(),
+                            'Diameter': df[signal].to_numpy(),
+                            'Dilation': df['Dilation'].to_numpy()})
+    return quality[QUALITY_COLS]
+
+
+def read_quality(filelist):
+    return pupil_io.read_csv_files(filelist, dtype=QUALITY_DTYPES)
+
+
+def summarize_quality(quality, subject=['Subject'], trial=['Trial']):
+    """Trial and subject summaries of a quality table. Numeric columns
+    (except Seconds) are averaged over seconds of each trial and over all
+    seconds of each subject. Subject summary also has ntrials (trials with a
+    baseline, or all trials if there is no Baseline column) and
+    BaselineStability (SD of baselines across trials)."""
+    trialkeys = subject + trial
+    numcols = [c for c in quality.select_dtypes(include='number').columns
+               if c not in trialkeys + ['Seconds']]
+    trials = quality.groupby(trialkeys, observed=True)[numcols].mean()
+    subjects = quality.groupby(subject, observed=True)[numcols].mean()
+    if 'Baseline' in trials.columns:
+        bytrial = trials['Baseline'].groupby(level=subject, observed=True)
+        subjects['ntrials'] = bytrial.count()
+        subjects['BaselineStability'] = bytrial.std()
+    else:
+        subjects['ntrials'] = trials.groupby(level=subject, observed=True).size()
+    return trials, subjects
+
+
+def get_exclusions(table, rules):
+    """Boolean array of rows of table meeting any of the exclusion rules."""
+    exclude = np.zeros(len(table), dtype=bool)
+    for col, op, threshold in rules:
+        values = table[col]
+        if op == 'missing':
+            exclude |= values.isnull().to_numpy()
+        else:
+            exclude |= OPERATORS[op](values, threshold).to_numpy(dtype=bool)
+    return exclude
+
+
+def apply_rules(quality, rules, subject=['Subject'], trial=['Trial']):
+    """Add ExcludeSecond, ExcludeTrial, ExcludeSubject and Exclude (any)
+    columns to a copy of quality, applying the rules of each level. Returns
+    (quality, trial summary, subject summary), with exclusion flags added to
+    the summaries."""
+    quality = quality.copy()
+    trials, subjects = summarize_quality(quality, subject=subject, trial=trial)
+    trials['ExcludeTrial'] = get_exclusions(trials, rules.get('trial', []))
+    subjects['ExcludeSubject'] = get_exclusions(subjects, rules.get('subject', []))
+    trials['ExcludeSubject'] = subjects['ExcludeSubject'].reindex(
+        trials.index.droplevel(trial) if len(trial) else trials.index).to_numpy()
+    quality['ExcludeSecond'] = get_exclusions(quality, rules.get('second', []))
+    rowtrials = pd.MultiIndex.from_frame(quality[subject + trial])
+    quality['ExcludeTrial'] = trials['ExcludeTrial'].reindex(rowtrials).to_numpy()
+    quality['ExcludeSubject'] = trials['ExcludeSubject'].reindex(rowtrials).to_numpy()
+    quality['Exclude'] = quality[['ExcludeSecond', 'ExcludeTrial', 'ExcludeSubject']].any(axis=1)
+    return quality, trials, subjects
+
+
+def average_trials(quality, by=['Subject', 'Task', 'Condition', 'Seconds'],
+                   values=['Dilation', 'Baseline', 'Diameter', 'BlinkPct']):
+    """Average values across trials after setting excluded seconds to
+    missing, as in the processed subject files. ntrials is the number of
+    trials with dilation that contributed to each average."""
+    masked = quality[by + values].copy()
+    if 'Exclude' in quality.columns:
+        masked.loc[quality['Exclude'].to_numpy(), values] = np.nan
+    averaged = masked.groupby(by, observed=True)[values].mean()
+    averaged['ntrials'] = masked.dropna(subset=['Dilation']).groupby(by, observed=True).size()
+    return averaged.reset_index()
+
+
+def load_rules(rulesfile):
+    """Read exclusion rules from json file of the form
+    {"second": [["BlinkPct", ">", 0.5]], "subject": [["ntrials", "<", 2]]}."""
+    with open(rulesfile) as f:
+        rules = json.load(f)
+    return dict((level, [tuple(rule) for rule in levelrules])
+                for level, levelrules in rules.items())
+
+
+def proc_quality(datadir, rules=None, average=False):
+    """Summarize quality tables in datadir and apply exclusion rules. Rules
+    default to QUALITY_RULES of each task."""
+    filelist = sorted(glob(os.path.join(datadir, '*_Quality.csv')))
+    quality = read_quality(filelist)
+    tstamp = datetime.now().strftime("%Y-%m-%d")
+    for task, taskquality in quality.groupby('Task', observed=True):
+        taskrules = rules if rules is not None else QUALITY_RULES.get(task, {})
+        taskquality, trials, subjects = apply_rules(taskquality, taskrules,
+                                                    subject=['Subject', 'Task'],
+                                                    trial=['Condition', 'Trial'])
+        prefix = os.path.join(datadir, task + '_quality_')
+        trials.reset_index().to_csv(prefix + 'trials_' + tstamp + '.csv', index=False)
+        subjects.reset_index().to_csv(prefix + 'subjects_' + tstamp + '.csv', index=False)
+        print('{0}: excluded {1} of {2} subjects, {3} of {4} trials'.format(
+            task, subjects.ExcludeSubject.sum(), len(subjects),
+            trials.ExcludeTrial.sum(), len(trials)))
+        if average:
+            averaged = average_trials(taskquality)
+            averaged.to_csv(prefix + 'averaged_' + tstamp + '.csv', index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Summarize quality tables of
+                                     processed subjects and apply exclusion
+                                     rules.""")
+    parser.add_argument('datadir', help='Directory of *_Quality.csv files.')
+    parser.add_argument('--rules', default=None,
+                        help='JSON file of exclusion rules (default: rules used in processing).')
+    parser.add_argument('--average', action='store_true',
+                        help='Write trial averages after exclusions.')
+    args = parser.parse_args()
+    rules = load_rules(args.rules) if args.rules else None
+    proc_quality(args.datadir, rules=rules, average=args.average)
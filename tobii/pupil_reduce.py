@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming reduction of processed subject files.
+
+Group scripts reduce every subject file to a few rows (e.g. trial averages
+of each condition after blink exclusion). reduce_files reads one file at a
+time, applies the reduction and only keeps the reduced rows, so memory use
+does not grow with the size of the subject files. The next file is read on
+a background thread while the current one is reduced.
+
+RunningStats keeps running counts, means and variances of each cell (e.g.
+task and second) using Welford's method, updated with one chunk of rows at
+a time. Group means and standard deviations can thus be computed for
+cohorts of any size without keeping subject level data. The group scripts
+use it with stream=True, which writes only this summary: bootstrap
+confidence intervals and the long and wide files need every subject row.
+"""
+from __future__ import division, print_function, absolute_import
+from functools import partial
+import numpy as np
+import pandas as pd
+import pupil_io
+
+
+class RunningStats(object):
+    """Running count, mean and sum of squared deviations (M2) of values in
+    each cell defined by the by columns. Chunks are merged with the parallel
+    form of Welford's algorithm (Chan et al.), so the result does not depend
+    on how rows are split into chunks. Missing values are ignored.
+
+    Usage:
+        stats = RunningStats(['Task', 'Seconds'], ['Dilation'])
+        for df in chunks:
+            stats.update(df)
+        summary = stats.summary()
+    """
+    def __init__(self, by, values):
+        self.by = [by] if isinstance(by, str) else list(by)
+        self.values = [values] if isinstance(values, str) else list(values)
+        self.n = self.mean = self.m2 = None
+
+    def update(self, df):
+        grouped = df.groupby(self.by, observed=True)[self.values]
+        n = grouped.count().astype(np.float64)
+        mean = grouped.mean().astype(np.float64).fillna(0.)
+        m2 = (grouped.var(ddof=0).astype(np.float64) * n).fillna(0.)
+        if self.n is None:
+            self.n, self.mean, self.m2 = n, mean, m2
+            return self
+        index = self.n.index.union(n.index)
+        n_a, mean_a, m2_a = [x.reindex(index, fill_value=0.) for x in (self.n, self.mean, self.m2)]
+        n_b, mean_b, m2_b = [x.reindex(index, fill_value=0.) for x in (n, mean, m2)]
+        total = n_a + n_b
+        delta = mean_b - mean_a
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean = (mean_a + delta * n_b / total).fillna(0.)
+            self.m2 = (m2_a + m2_b + delta ** 2 * n_a * n_b / total).fillna(0.)
+        self.n = total
+        return self
+
+    def summary(self):
+        """Long dataframe with the by columns and Measure, N, Mean, SD and
+        SEM, as pupil_stats.group_summary without confidence intervals."""
+        summaries = []
+        for value in self.values:
+            n = self.n[value]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sd = np.sqrt(self.m2[value] / (n - 1)).where(n > 1)
+            summary = pd.DataFrame({'Measure': value,
+                                    'N': n.astype(int),
+                                    'Mean': self.mean[value].where(n > 0),
+                                    'SD': sd})
+            summary['SEM'] = summary['SD'] / np.sqrt(summary['N'])
+            summaries.append(summary.reset_index())
+        return pd.concat(summaries, ignore_index=True)
+
+
+def reduce_files(filelist, reduce, dtype=None, stats=None, keep=True):
+    """Read subject files one at a time and concatenate the rows returned by
+    reduce(df, fname). If stats (RunningStats) is given, it is updated with
+    the reduced rows of each file. With keep=False reduced rows are not
+    kept and None is returned, so only stats are computed. Categorical
+    columns are combined as in pupil_io.read_csv_files."""
+    load = partial(pupil_io.read_typed_csv, dtype=dtype)
+    frames = []
+    for fname, df in pupil_io.prefetch(filelist, load, depth=1):
+        reduced = reduce(df, fname)
+        if stats is not None:
+            stats.update(reduced)
+        if keep:
+            frames.append(reduced)
+    if not keep:
+        return None
+    frames = pupil_io.union_categories(frames)
+    return pd.concat(frames, ignore_index=True, sort=False, copy=False)
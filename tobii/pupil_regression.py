@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Golden output regression harness.
+
+Runs the digit span and fluency subject and group scripts on a fixed corpus
+of gazedata files and compares every output column with golden CSVs stored
+from a previous run. It also checks that the epoch specs of the tasks
+(pupil_epochs.TASK_EPOCHS) reproduce the per second dilation of every trial
+in the quality tables. Numeric columns must agree within an absolute or
+relative tolerance (per column if needed), other columns must match exactly.
+The maximum absolute and relative deviation of every column is reported.
+
+The wall time and peak memory (Python and numpy allocations traced with
+tracemalloc) of each stage are stored with the golden outputs, so a check
+also flags stages that became slower or use more memory than the baseline.
+Wall time is the best of --repeat untraced runs of each stage, and memory
+is traced in a separate run, so timings do not include tracing overhead.
+
+By default the corpus is generated from a fixed seed (make_corpus), so no
+subject data has to be stored with the golden outputs. An anonymized corpus
+can be given instead with --corpus.
+
+Usage:
+    python pupil_regression.py update <golden dir> [--corpus DIR] [--repeat N]
+    python pupil_regression.py check <golden dir> [--corpus DIR] [--tol COL=ATOL] [--repeat N]
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+from glob import glob
+import numpy as np
+import pandas as pd
+import digitspan_proc_subject
+import fluency_proc_subject
+import digitspan_proc_group
+import fluency_proc_group
+import pupil_io
+import pupil_utils
+import pupil_epochs
+
+DEFAULT_ATOL = 1e-9
+DEFAULT_RTOL = 1e-7
+# Absolute tolerance of columns that need to differ from the default
+COLUMN_TOLERANCES = {}
+# Allowed increase of wall time and peak memory relative to the baseline
+TIME_TOLERANCE = .5
+MEMORY_TOLERANCE = .2
+# Number of untraced runs of each stage, the best wall time is kept
+REPEAT = 3
+
+# Absolute tolerance of per second dilation of TASK_EPOCHS epochs relative
+# to the quality tables. Fluency seconds are taken from E-Prime RTTime, which
+# is averaged within resampled bins, rather than from the resampled grid, so
+# a few samples fall in neighbouring seconds.
+EPOCH_TOLERANCES = {'DigitSpan': DEFAULT_ATOL, 'Fluency': .005}
+
+TIMINGS_FILE = 'timings.csv'
+SUBJECTS = [('12345', 1), ('23456', 2), ('34567', 1)]
+
+
+def simulate_pupil(n, rng, fs):
+    """Slowly varying pupil diameter with noise and blinks (coded as -1)."""
+    t = np.arange(n) / fs
+    diameter = 3.5 + .2 * np.sin(2 * np.pi * .1 * t) + rng.normal(0, .02, n)
+    for start in rng.integers(0, n - 10, size=max(1, n // 300)):
+        diameter[start:start + int(.15 * fs)] = -1
+    return diameter
+
+
+def add_pupil_columns(df, subid, session, fs, rng):
+    n = len(df)
+    for eye in ['Left', 'Right']:
+        diameter = simulate_pupil(n, rng, fs)
+        df['PupilDiameter' + eye + 'Eye'] = diameter
+        df['PupilValidity' + eye + 'Eye'] = np.where(diameter < 0, 4, 0)
+    df['Subject'] = int(subid)
+    df['Session'] = session
+    df['CRESP'] = 1
+    df['ACC'] = 1
+    df['RT'] = 500
+    return df
+
+
+def make_digitspan(subid, session, fs, rng):
+    """Digit span gazedata with two trials of loads 3, 6 and 9."""
+    trials = []
+    t0 = 100000.
+    for load in [3, 6, 9]:
+        for trial in ['1', '2']:
+            digitlist = 'ListLoad{0}{1}'.format(load, trial)
+            n = int((load + 2.5) * fs)
+            rttime = t0 + np.arange(n) * 1000. / fs
+            t0 = rttime[-1] + 1000.
+            trials.append(pd.DataFrame({'RTTime': rttime, 'CurrentObject': 'Ready',
+                                        'DigitList': digitlist}))
+            trials.append(pd.DataFrame({'RTTime': t0 - 500. + np.arange(5),
+                                        'CurrentObject': 'Fixation', 'DigitList': digitlist}))
+    df = pd.concat(trials, ignore_index=True)
+    # Load column of E-Prime exports is incorrect and recomputed from DigitList
+    df['Load'] = 99
+    return add_pupil_columns(df, subid, session, fs, rng)
+
+
+def make_fluency(subid, session, fs, rng):
+    """Fluency gazedata with the four conditions and their trial phases."""
+    phases = []
+    t0 = 100000.
+    for condition in ['C', 'L', 'GirlsNames', 'Vegetables']:
+        for obj, duration in [('Fixation', 1.), ('Baseline', 2.), ('Instructions', 4.),
+                              ('RecordLetter', 31.)]:
+            n = int(duration * fs)
+            rttime = t0 + np.arange(n) * 1000. / fs
+            t0 = rttime[-1] + 1000. / fs
+            phases.append(pd.DataFrame({'RTTime': rttime, 'CurrentObject': obj,
+                                        'Condition': condition}))
+    df = pd.concat(phases, ignore_index=True)
+    # Exports have occasional missing CurrentObject values
+    df.loc[::50, 'CurrentObject'] = np.nan
+    return add_pupil_columns(df, subid, session, fs, rng)
+
+
+def make_corpus(outdir, fs=60., seed=0):
+    """Write synthetic digit span and fluency gazedata files of SUBJECTS."""
+    rng = np.random.default_rng(seed)
+    for subid, session in SUBJECTS:
+        for task, make_task in [('DigitSpan', make_digitspan), ('Fluency', make_fluency)]:
+            fname = os.path.join(outdir, '{0}-{1}-{2}.gazedata'.format(task, subid, session))
+            make_task(subid, session, fs, rng).to_csv(fname, sep='\t', index=False)
+
+
+def get_stages(corpus, outdir):
+    """Pipeline stages as (name, function) run in order."""
+    dsdir = os.path.join(outdir, 'ds')
+    fldir = os.path.join(outdir, 'fl')
+    for d in [dsdir, fldir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    dsfiles = sorted(glob(os.path.join(corpus, 'DigitSpan*')))
+    flfiles = sorted(glob(os.path.join(corpus, 'Fluency*')))
+    return [('digitspan_subject', lambda: digitspan_proc_subject.proc_subject(dsfiles, dsdir, plot=False)),
+            ('fluency_subject', lambda: fluency_proc_subject.proc_subject(flfiles, fldir, plot=False)),
+            ('digitspan_group', lambda: digitspan_proc_group.proc_group(dsdir)),
+            ('fluency_group', lambda: fluency_proc_group.proc_group(fldir))]
+
+
+def time_stage(stage, repeat=REPEAT):
+    """Best wall time (s) of repeat untraced runs of stage and peak memory
+    (MB) traced in a separate run. Stages overwrite their own outputs, so
+    they can be run more than once."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        stage()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def run_pipeline(corpus, outdir, repeat=REPEAT):
+    """Run all stages in order and return dataframe of wall time (s) and peak
+    traced memory (MB) of each stage."""
+    timings = []
+    for name, stage in get_stages(corpus, outdir):
+        seconds, peak = time_stage(stage, repeat=repeat)
+        timings.append({'Stage': name, 'Seconds': seconds, 'PeakMB': peak})
+    return pd.DataFrame(timings)
+
+
+def strip_date(fname):
+    """Remove date stamp of group outputs so runs on different days compare."""
+    return re.sub(r'_\d{4}-\d{2}-\d{2}(?=\.csv$)', '', fname)
+
+
+def get_outputs(outdir):
+    """Output CSVs keyed by path relative to outdir without date stamps."""
+    outputs = {}
+    for fname in glob(os.path.join(outdir, '*', '*.csv')):
+        outputs[strip_date(os.path.relpath(fname, outdir))] = fname
+    return outputs
+
+
+def compare_column(new, golden, atol=DEFAULT_ATOL, rtol=DEFAULT_RTOL):
+    """Maximum absolute and relative deviation of column from golden column,
+    and whether it is within tolerance. Missing values must match."""
+    if pd.api.types.is_numeric_dtype(new) and pd.api.types.is_numeric_dtype(golden):
+        new = new.to_numpy(dtype=np.float64)
+        golden = golden.to_numpy(dtype=np.float64)
+        newnan, goldnan = np.isnan(new), np.isnan(golden)
+        valid = ~newnan & ~goldnan
+        absdev = np.abs(new[valid] - golden[valid])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reldev = np.where(absdev > 0, absdev / np.abs(golden[valid]), 0.)
+        max_abs = absdev.max() if absdev.size else 0.
+        max_rel = reldev.max() if reldev.size else 0.
+        passed = (newnan == goldnan).all() and (absdev <= atol + rtol * np.abs(golden[valid])).all()
+        return max_abs, max_rel, bool(passed)
+    passed = (new.astype(str).to_numpy() == golden.astype(str).to_numpy()).all()
+    return np.nan, np.nan, bool(passed)
+
+
+def compare_outputs(outdir, goldendir, tolerances=None):
+    """Compare all outputs with golden outputs. Returns dataframe with one
+    row per file and column."""
+    tolerances = dict(COLUMN_TOLERANCES, **(tolerances or {}))
+    new, golden = get_outputs(outdir), get_outputs(goldendir)
+    rows = []
+    for name in sorted(set(new) | set(golden)):
+        if name not in new or name not in golden:
+            rows.append({'File': name, 'Column': None, 'MaxAbs': np.nan, 'MaxRel': np.nan,
+                         'Passed': False, 'Note': 'missing' if name in golden else 'extra'})
+            continue
+        newdf, golddf = pd.read_csv(new[name]), pd.read_csv(golden[name])
+        if list(newdf.columns) != list(golddf.columns) or len(newdf) != len(golddf):
+            rows.append({'File': name, 'Column': None, 'MaxAbs': np.nan, 'MaxRel': np.nan,
+                         'Passed': False, 'Note': 'shape {0} != {1}'.format(newdf.shape, golddf.shape)})
+            continue
+        for col in golddf.columns:
+            max_abs, max_rel, passed = compare_column(newdf[col], golddf[col],
+                                                      atol=tolerances.get(col, DEFAULT_ATOL))
+            rows.append({'File': name, 'Column': col, 'MaxAbs': max_abs, 'MaxRel': max_rel,
+                         'Passed': passed, 'Note': ''})
+    return pd.DataFrame(rows, columns=['File', 'Column', 'MaxAbs', 'MaxRel', 'Passed', 'Note'])
+
+
+def get_epoch_dilation(fname, task):
+    """Per second dilation of every trial of a raw file from epochs of the
+    TASK_EPOCHS spec, taken from the resampled trials of the subject script.
+    Returns subject ID and series indexed by Trial and Seconds."""
+    df = pupil_io.read_gazedata(fname)
+    subid = pupil_utils.prep_gazedata(df, fname)
+    if task == 'DigitSpan':
+        trialevents = digitspan_proc_subject.get_trial_events(digitspan_proc_subject.prep_trials(df, subid))
+        resampled = digitspan_proc_subject.resample_trials(trialevents)
+        resampled = resampled.reset_index(level='Trial', drop=True)
+    else:
+        resampled = fluency_proc_subject.resample_trials(df).set_index('Timestamp')
+    spec = pupil_epochs.TASK_EPOCHS[task]
+    epochs, times, info = pupil_epochs.epoch(resampled, spec)
+    seconds, binned = pupil_epochs.bin_epochs(epochs, times)
+    dilation = pd.DataFrame(binned, index=info[spec['trial']].astype(str), columns=seconds)
+    dilation = dilation.stack(dropna=False)
+    dilation.index.names = ['Trial', 'Seconds']
+    return subid, dilation
+
+
+def compare_epochs(corpus, outdir):
+    """Check that TASK_EPOCHS reproduces the per second dilation of each
+    trial in the quality tables of the subject scripts. Returns dataframe
+    with one row per raw file."""
+    rows = []
+    for task, subdir in [('DigitSpan', 'ds'), ('Fluency', 'fl')]:
+        for fname in sorted(glob(os.path.join(corpus, task + '*'))):
+            subid, dilation = get_epoch_dilation(fname, task)
+            quality = pd.read_csv(os.path.join(outdir, subdir, '{0}_{1}_Quality.csv'.format(task, subid)),
+                                  dtype={'Trial': str})
+            expected = quality.set_index(['Trial', 'Seconds'])['Dilation']
+            result = dilation.reindex(expected.index)
+            valid = expected.notnull().to_numpy() & result.notnull().to_numpy()
+            absdev = np.abs(result.to_numpy()[valid] - expected.to_numpy()[valid])
+            max_abs = absdev.max() if absdev.size else 0.
+            passed = (expected.isnull().to_numpy() == result.isnull().to_numpy()).all() and \
+                max_abs <= EPOCH_TOLERANCES[task]
+            rows.append({'Task': task, 'Subject': subid, 'Seconds': len(expected),
+                         'MaxAbs': max_abs, 'Passed': bool(passed)})
+    return pd.DataFrame(rows)
+
+
+def compare_timings(timings, baseline, time_tol=TIME_TOLERANCE, mem_tol=MEMORY_TOLERANCE):
+    """Compare stage timings with baseline. Stages are flagged if wall time
+    or peak memory increased by more than the given fraction."""
+    merged = timings.merge(baseline, on='Stage', how='left', suffixes=('', 'Baseline'))
+    merged['TimeRatio'] = merged['Seconds'] / merged['SecondsBaseline']
+    merged['MemoryRatio'] = merged['PeakMB'] / merged['PeakMBBaseline']
+    merged['Passed'] = ~((merged['TimeRatio'] > 1 + time_tol) | (merged['MemoryRatio'] > 1 + mem_tol))
+    return merged
+
+
+def run_corpus(corpus, outdir, repeat=REPEAT):
+    """Run pipeline on corpus, generating the synthetic corpus if none given."""
+    if corpus is None:
+        corpus = os.path.join(outdir, 'corpus')
+        os.makedirs(corpus)
+        make_corpus(corpus)
+    return run_pipeline(corpus, outdir, repeat=repeat)
+
+
+def update_golden(goldendir, corpus=None, repeat=REPEAT):
+    """Run pipeline and store outputs and timings as golden baseline."""
+    if os.path.isdir(goldendir):
+        shutil.rmtree(goldendir)
+    workdir = tempfile.mkdtemp()
+    try:
+        timings = run_corpus(corpus, workdir, repeat=repeat)
+        for name, fname in get_outputs(workdir).items():
+            outfile = os.path.join(goldendir, name)
+            if not os.path.isdir(os.path.dirname(outfile)):
+                os.makedirs(os.path.dirname(outfile))
+            shutil.copyfile(fname, outfile)
+    finally:
+        shutil.rmtree(workdir)
+    timings.to_csv(os.path.join(goldendir, TIMINGS_FILE), index=False)
+    print(timings.to_string(index=False))
+    print('Stored golden outputs in {}'.format(goldendir))
+
+
+def check_golden(goldendir, corpus=None, tolerances=None, time_tol=TIME_TOLERANCE,
+                 mem_tol=MEMORY_TOLERANCE, keep=False, repeat=REPEAT):
+    """Run pipeline and compare outputs and timings with golden baseline.
+    Returns True if all checks passed."""
+    workdir = tempfile.mkdtemp()
+    try:
+        timings = run_corpus(corpus, workdir, repeat=repeat)
+        results = compare_outputs(workdir, goldendir, tolerances=tolerances)
+        epochcheck = compare_epochs(corpus or os.path.join(workdir, 'corpus'), workdir)
+    finally:
+        if keep:
+            print('Outputs kept in {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir)
+    failed = results[~results.Passed]
+    numeric = results.dropna(subset=['MaxAbs'])
+    print('Compared {0} columns of {1} files'.format(len(results), results.File.nunique()))
+    if len(numeric):
+        print('Largest deviation: {0:.3g} absolute, {1:.3g} relative'.format(
+            numeric.MaxAbs.max(), numeric.MaxRel.max()))
+    if len(failed):
+        print('Outputs differing from golden:')
+        print(failed.to_string(index=False))
+    baseline = pd.read_csv(os.path.join(goldendir, TIMINGS_FILE))
+    timecheck = compare_timings(timings, baseline, time_tol=time_tol, mem_tol=mem_tol)
+    print(timecheck[['Stage', 'Seconds', 'SecondsBaseline', 'PeakMB', 'PeakMBBaseline',
+                     'Passed']].to_string(index=False, float_format='{:.3f}'.format))
+    print('Epochs of pupil_epochs.TASK_EPOCHS against quality tables:')
+    print(epochcheck.to_string(index=False))
+    return len(failed) == 0 and timecheck.Passed.all() and epochcheck.Passed.all()
+
+
+def parse_tolerance(value):
+    """argparse type for COL=ATOL."""
+    col, sep, atol = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('tolerance must be given as COL=ATOL, not {}'.format(value))
+    return col, float(atol)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Compare pipeline outputs,
+                                     wall time and peak memory with a golden
+                                     baseline.""")
+    parser.add_argument('mode', choices=['update', 'check'],
+                        help='Store new golden baseline or check against it.')
+    parser.add_argument('goldendir', help='Directory of golden outputs.')
+    parser.add_argument('--corpus', default=None,
+                        help='Directory of gazedata files (default: synthetic corpus).')
+    parser.add_argument('--tol', type=parse_tolerance, action='append', default=[],
+                        help='Absolute tolerance of a column, given as COL=ATOL.')
+    parser.add_argument('--time-tol', type=float, default=TIME_TOLERANCE,
+                        help='Allowed fractional increase of wall time.')
+    parser.add_argument('--mem-tol', type=float, default=MEMORY_TOLERANCE,
+                        help='Allowed fractional increase of peak memory.')
+    parser.add_argument('--keep', action='store_true', help='Keep outputs of check run.')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='Untraced runs of each stage, the best wall time is kept.')
+    args = parser.parse_args()
+    if args.mode == 'update':
+        update_golden(args.goldendir, corpus=args.corpus, repeat=args.repeat)
+    else:
+        passed = check_golden(args.goldendir, corpus=args.corpus, tolerances=dict(args.tol),
+                              time_tol=args.time_tol, mem_tol=args.mem_tol, keep=args.keep,
+                              repeat=args.repeat)
+        print('PASSED' if passed else 'FAILED')
+        sys.exit(0 if passed else 1)
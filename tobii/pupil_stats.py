@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Group level summaries of processed pupil data.
+
+Means, standard errors and bootstrap confidence intervals are computed for
+every cell (e.g. load, condition and second) at once. Subjects are resampled
+with a single matrix of resampling weights drawn from a seeded RNG, so the
+bootstrap means of all cells are one matrix product and results are
+reproducible. Plots are drawn from these precomputed summaries instead of
+bootstrapping again in seaborn.
+"""
+from __future__ import division, print_function, absolute_import
+import warnings
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+
+def bootstrap_means(data, n_boot=1000, seed=0):
+    """Bootstrap means of each column of a (subjects x cells) array. Missing
+    values are ignored. Each bootstrap sample is a row of multinomial weights
+    (number of times each subject is drawn). Returns (n_boot x cells) array."""
+    data = np.asarray(data, dtype=np.float64)
+    nsub = data.shape[0]
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(nsub, np.full(nsub, 1. / nsub), size=n_boot).astype(np.float64)
+    valid = ~np.isnan(data)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (weights @ np.where(valid, data, 0.)) / (weights @ valid)
+
+
+def group_summary(df, by, values='Dilation', subject='Subject', n_boot=1000,
+                  ci=95, seed=0):
+    """Summarize values across subjects for each combination of the by
+    columns. Repeated rows within subject and cell (e.g. trials) are averaged
+    first. Returns long dataframe with the by columns and Measure, N, Mean,
+    SD, SEM, CI_Low and CI_High."""
+    by = [by] if isinstance(by, str) else list(by)
+    values = [values] if isinstance(values, str) else list(values)
+    cellmeans = df.groupby([subject] + by, observed=True)[values].mean()
+    alpha = (100. - ci) / 2.
+    summaries = []
+    for value in values:
+        cellmat = cellmeans[value].unstack(by)
+        data = cellmat.to_numpy(dtype=np.float64)
+        boot = bootstrap_means(data, n_boot=n_boot, seed=seed)
+        nsub = (~np.isnan(data)).sum(axis=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            ci_low, ci_high = np.nanpercentile(boot, [alpha, 100. - alpha], axis=0)
+            summary = pd.DataFrame({'Measure': value,
+                                    'N': nsub,
+                                    'Mean': np.nanmean(data, axis=0),
+                                    'SD': np.nanstd(data, axis=0, ddof=1)},
+                                   index=cellmat.columns)
+        summary['SEM'] = summary['SD'] / np.sqrt(summary['N'])
+        summary['CI_Low'] = ci_low
+        summary['CI_High'] = ci_high
+        summaries.append(summary.reset_index())
+    return pd.concat(summaries, ignore_index=True)
+
+
+def plot_summary(summary, ax, x, hue=None, kind='point', capsize=8):
+    """Plot means and precomputed confidence intervals of one measure from
+    group_summary. kind='point' places x categories at equal spacing with
+    error bars (as seaborn pointplot), kind='line' plots numeric x with
+    shaded confidence bands (as seaborn lineplot)."""
+    groups = list(summary.groupby(hue, sort=False, observed=True)) if hue else [(None, summary)]
+    palette = sns.color_palette(n_colors=len(groups))
+    categories = list(pd.unique(summary[x]))
+    for (label, grp), color in zip(groups, palette):
+        if kind == 'point':
+            xpos = [categories.index(val) for val in grp[x]]
+            yerr = [grp['Mean'] - grp['CI_Low'], grp['CI_High'] - grp['Mean']]
+            ax.errorbar(xpos, grp['Mean'], yerr=yerr, fmt='o-', color=color,
+                        capsize=capsize, label=label)
+        elif kind == 'line':
+            ax.plot(grp[x], grp['Mean'], color=color, label=label)
+            ax.fill_between(grp[x], grp['CI_Low'], grp['CI_High'], color=color, alpha=.2)
+        else:
+            raise ValueError("kind must be 'point' or 'line', not {}".format(kind))
+    if kind == 'point':
+        ax.set_xticks(range(len(categories)))
+        ax.set_xticklabels(categories)
+    ax.set_xlabel(x)
+    ax.set_ylabel(summary['Measure'].iat[0])
+    if hue:
+        ax.legend(title=hue)
+    sns.despine(ax=ax)
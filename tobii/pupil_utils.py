@@ -1,24 +1,22 @@
 from __future__ import division, print_function, absolute_import
 import os
 import re
+import warnings
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
-from scipy.signal import butter, filtfilt
+from fractions import Fraction
+from scipy.signal import butter, filtfilt, resample_poly
 # import matlab_wrapper
 from scipy.signal import fftconvolve
 from nilearn.glm import ARModel, OLSModel
 
-def get_vetsaid(df, fname):
-    """
-    Extract VETSAID from data. VETSAID is 5 digits followed either an A or B.
-    IDs were coded as 5 digits followed by a dash followed by a single digit, 
-    with 1 indicating an A and 2 indicating a B. This function will return the
-    VETSAID as a string. VETSAID contained in the data will be checked against
-    the VETSAID in the filename. If they do not match, an exception will be
-    raised.
-    """
+def get_fname_vetsaid(fname):
+    """Extract VETSAID from basename of file. IDs in filenames are coded as 5
+    digits followed by a dash followed by 1 (A) or 2 (B), e.g. 12345-1 is
+    returned as 12345A."""
     fname_base = os.path.basename(fname)  
     try:
         vetsaid = re.search(r'(\d{5}-[12])', fname_base, re.IGNORECASE).group(1)
@@ -30,6 +28,19 @@ def get_vetsaid(df, fname):
             raise Exception("VETSAID in filename does not end in 1 or 2.")
     except AttributeError:
         raise Exception("Could not find valid VETSAID in path of input file.")
+    return vetsaid
+
+
+def get_vetsaid(df, fname):
+    """
+    Extract VETSAID from data. VETSAID is 5 digits followed either an A or B.
+    IDs were coded as 5 digits followed by a dash followed by a single digit, 
+    with 1 indicating an A and 2 indicating a B. This function will return the
+    VETSAID as a string. VETSAID contained in the data will be checked against
+    the VETSAID in the filename. If they do not match, an exception will be
+    raised.
+    """
+    vetsaid = get_fname_vetsaid(fname)
     
     df['VETSAID'] = df['Subject'].astype(str) + df['Session'].map({1: 'A', 2: 'B'})
     
@@ -43,6 +54,17 @@ def get_vetsaid(df, fname):
         raise Exception('VETSAID in file {0} does not match filename: {1}'.format(df['VETSAID'].unique()[0], fname))
 
 
+def prep_gazedata(df, fname):
+    """Preprocessing shared by all tasks of raw Tobii data read with
+    pupil_io.read_gazedata. Checks VETSAID against filename and converts pupil
+    diameters to numeric in place. Returns VETSAID."""
+    vetsaid = get_vetsaid(df, fname)
+    # Convert PupilDiameterLeftEye and PupilDiameterRightEye to numeric
+    df['PupilDiameterLeftEye'] = pd.to_numeric(df['PupilDiameterLeftEye'], errors='coerce')
+    df['PupilDiameterRightEye'] = pd.to_numeric(df['PupilDiameterRightEye'], errors='coerce')
+    return vetsaid
+
+
 def get_fname_subid(fname):
     """Given the input files, extract subject ID from basename. IDs are
     assumed to be 5 digits followed by a dash and another digit."""
@@ -100,12 +122,21 @@ def zscore(x):
     return (x - x.mean()) / x.std()
 
 
+def get_proc_outdir(infile):
+    """Processed data folder corresponding to raw data file. Changes path from
+    raw to proc."""
+    outdir = os.path.dirname(infile)
+    outdir = re.sub('Raw Pupil Data', 'Processed Pupil Data', outdir, flags=re.IGNORECASE)
+    # Drop the (Gaze|Edat) data folder. dirname has no trailing separator,
+    # so match the path component rather than a trailing slash.
+    outdir = re.sub(r"[\\/](Gaze|Edat) data(?=[\\/]|$)", "", outdir, flags=re.IGNORECASE)
+    return outdir
+
+
 def get_proc_outfile(infile, suffix):
     """Take infile to derive outdir. Changes path from raw to proc
     and adds suffix to basename."""
-    outdir = os.path.dirname(infile)
-    outdir = re.sub('Raw Pupil Data', 'Processed Pupil Data', outdir, flags=re.IGNORECASE)
-    outdir = re.sub("(Gaze|Edat) data/","", outdir, flags=re.IGNORECASE)
+    outdir = get_proc_outdir(infile)
     if not os.path.exists(outdir):
         'Output directory does not exist, creating now: "{0}"'.format(outdir)
         os.makedirs(outdir)
@@ -150,16 +181,85 @@ def get_blinks(diameter, validity, pupilthresh_hi=5., pupilthresh_lo=1., gradien
     return blinks
 
 
-def deblink(dfraw, **kwargs):
-    """ Set dilation of all blink trials to nan."""
+def mask_to_intervals(mask):
+    """Run-length encode a boolean vector. Returns (n x 2) array of
+    [start, stop) sample indices of each run of True values."""
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return np.column_stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def intervals_to_mask(intervals, n_samples):
+    """Boolean vector of length n_samples that is True within each [start,
+    stop) interval. Overlapping intervals are allowed."""
+    intervals = np.asarray(intervals, dtype=np.intp).reshape(-1, 2)
+    counts = np.zeros(n_samples + 1, dtype=np.intp)
+    np.add.at(counts, np.clip(intervals[:, 0], 0, n_samples), 1)
+    np.add.at(counts, np.clip(intervals[:, 1], 0, n_samples), -1)
+    return np.cumsum(counts[:-1]) > 0
+
+
+def pad_intervals(intervals, n_samples, pad=0):
+    """Extend intervals by pad samples on each side, clip to signal and merge
+    intervals that overlap or touch."""
+    intervals = np.asarray(intervals, dtype=np.intp).reshape(-1, 2)
+    if pad == 0 or len(intervals) == 0:
+        return intervals
+    padded = np.column_stack((intervals[:, 0] - pad, intervals[:, 1] + pad))
+    return mask_to_intervals(intervals_to_mask(padded, n_samples))
+
+
+def get_blinks_velocity(diameter, validity=None, pupilthresh_hi=5., pupilthresh_lo=1.,
+                        gradient_crit=4, smooth_window=5, pad=3):
+    """Velocity based blink detection. Missing, invalid and out of range
+    samples mark the core of each blink. The blink is extended in both
+    directions over adjacent samples whose absolute smoothed velocity exceeds
+    the threshold from get_gradient (lid closing and opening alike), then
+    padded by pad samples on each side.
+    Returns (n x 2) array of [start, stop) blink intervals and vector of
+    blink samples (1 = blink)."""
+    diameter = pd.Series(np.asarray(diameter, dtype=np.float64))
+    n_samples = len(diameter)
+    core = diameter.isnull().to_numpy() | (diameter > pupilthresh_hi).to_numpy() | (diameter < pupilthresh_lo).to_numpy()
+    if validity is not None:
+        core |= np.asarray(validity) == 4
+    smoothed = diameter.where(~core).rolling(smooth_window, center=True, min_periods=1).mean()
+    velocity = np.gradient(smoothed.to_numpy()) if n_samples > 1 else np.zeros(n_samples)
+    thresh = get_gradient(smoothed, gradient_crit=gradient_crit)
+    with np.errstate(invalid='ignore'):
+        fast = np.abs(velocity) > thresh
+    # Runs of fast or missing samples, kept only if they contain missing data
+    candidates = mask_to_intervals(core | fast)
+    ncore = np.concatenate(([0], np.cumsum(core)))
+    candidates = candidates[ncore[candidates[:, 1]] > ncore[candidates[:, 0]]]
+    intervals = pad_intervals(candidates, n_samples, pad=pad)
+    blinks = intervals_to_mask(intervals, n_samples).astype(int)
+    return intervals, blinks
+
+
+def deblink(dfraw, method='heuristic', return_intervals=False, **kwargs):
+    """ Set dilation of all blink trials to nan. Method is 'heuristic' to use
+    get_blinks or 'velocity' to use get_blinks_velocity. If return_intervals
+    is True, also returns dict with [start, stop) blink intervals of each eye
+    (positional sample indices; only for velocity method)."""
     df = dfraw.copy()
     df.loc[df.PupilDiameterLeftEye<0, 'PupilDiameterLeftEye'] = np.nan
     df.loc[df.PupilDiameterRightEye<0, 'PupilDiameterRightEye'] = np.nan
-    df['BlinksLeft'] = get_blinks(df.PupilDiameterLeftEye, df.PupilValidityLeftEye, **kwargs)
-    df['BlinksRight'] = get_blinks(df.PupilDiameterRightEye, df.PupilValidityRightEye, **kwargs)
+    if method == 'heuristic':
+        intervals = None
+        df['BlinksLeft'] = get_blinks(df.PupilDiameterLeftEye, df.PupilValidityLeftEye, **kwargs)
+        df['BlinksRight'] = get_blinks(df.PupilDiameterRightEye, df.PupilValidityRightEye, **kwargs)
+    elif method == 'velocity':
+        left_intervals, df['BlinksLeft'] = get_blinks_velocity(df.PupilDiameterLeftEye, df.PupilValidityLeftEye, **kwargs)
+        right_intervals, df['BlinksRight'] = get_blinks_velocity(df.PupilDiameterRightEye, df.PupilValidityRightEye, **kwargs)
+        intervals = {'Left': left_intervals, 'Right': right_intervals}
+    else:
+        raise ValueError("Unknown blink detection method: {}".format(method))
     df.loc[df.BlinksLeft==1, "PupilDiameterLeftEye"] = np.nan
-    df.loc[df.BlinksRight==1, "PupilDiameterRightEye"] = np.nan    
+    df.loc[df.BlinksRight==1, "PupilDiameterRightEye"] = np.nan
     df['BlinksLR'] = np.where(df.BlinksLeft+df.BlinksRight>=2, 1, 0)
+    if return_intervals:
+        return df, intervals
     return df
 
 
@@ -206,7 +306,103 @@ def get_gradient(diameter, gradient_crit=4, n_timepoints=1):
     diffstd = np.nanstd(diff)
     gradient = diffmean + (gradient_crit*diffstd)
     return gradient
-    
+
+
+def get_iqr_matrix(x):
+    """Row-wise version of get_iqr for a (records x samples) array."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q75, q25 = np.nanpercentile(x, [75, 25], axis=1)
+    iqr = q75 - q25
+    return q25 - (iqr*1.5), q75 + (iqr*1.5)
+
+
+def get_blinks_matrix(diameter, validity=None, pupilthresh_hi=5., pupilthresh_lo=1., n_timepoints=1):
+    """Version of get_blinks applied to every row of a (records x samples)
+    array at once. Uses the same criteria as get_blinks, but statistics are
+    computed within each record. Missing samples count as blinks."""
+    diameter = np.asarray(diameter, dtype=np.float64)
+    fwddiff = np.full_like(diameter, np.nan)
+    fwddiff[:, n_timepoints:] = diameter[:, n_timepoints:] - diameter[:, :-n_timepoints]
+    bwddiff = np.full_like(diameter, np.nan)
+    bwddiff[:, :-n_timepoints] = diameter[:, :-n_timepoints] - diameter[:, n_timepoints:]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        diffmin, diffmax = get_iqr_matrix(fwddiff)
+        bigdiff = (np.abs(fwddiff) < diffmin[:, None]) | (np.abs(bwddiff) > diffmax[:, None])
+        zscores = (diameter - np.nanmean(diameter, axis=1, keepdims=True)) / np.nanstd(diameter, axis=1, ddof=1, keepdims=True)
+        zoutliers = np.abs(zscores) > 2.5
+        mindiameter, maxdiameter = get_iqr_matrix(diameter)
+        diameter_outliers = (diameter < mindiameter[:, None]) | (diameter > maxdiameter[:, None])
+        pupil_outlier = (diameter > pupilthresh_hi) | (diameter < pupilthresh_lo)
+    invalid = np.isnan(diameter)
+    if validity is not None:
+        invalid |= np.asarray(validity) == 4
+    blinks = np.where(invalid | bigdiff | zoutliers | diameter_outliers | pupil_outlier, 1, 0)
+    return blinks
+
+
+def smooth_matrix(x, window=5):
+    """Centered moving average along rows. Matches pandas rolling(window,
+    center=True).mean(): any missing sample in the window gives a missing
+    value, which also pads the edges of blinks."""
+    x = np.asarray(x, dtype=np.float64)
+    out = np.full_like(x, np.nan)
+    if x.shape[1] < window:
+        return out
+    half = window // 2
+    out[:, half:x.shape[1]-(window-1-half)] = sliding_window_view(x, window, axis=1).mean(axis=-1)
+    return out
+
+
+def interpolate_matrix(x):
+    """Linear interpolation of missing samples along each row. Leading and
+    trailing gaps are filled with the nearest valid sample. Rows without any
+    valid samples are left missing."""
+    x = np.asarray(x, dtype=np.float64)
+    nrec, nsamp = x.shape
+    valid = ~np.isnan(x)
+    idx = np.arange(nsamp)
+    # Index of previous and next valid sample for every position
+    prev_idx = np.maximum.accumulate(np.where(valid, idx, -1), axis=1)
+    next_idx = np.minimum.accumulate(np.where(valid, idx, nsamp)[:, ::-1], axis=1)[:, ::-1]
+    prev_idx_f = np.where(prev_idx < 0, next_idx, prev_idx)
+    next_idx_f = np.where(next_idx >= nsamp, prev_idx_f, next_idx)
+    prev_idx_f = np.clip(prev_idx_f, 0, nsamp - 1)
+    next_idx_f = np.clip(next_idx_f, 0, nsamp - 1)
+    prev_val = np.take_along_axis(x, prev_idx_f, axis=1)
+    next_val = np.take_along_axis(x, next_idx_f, axis=1)
+    span = next_idx_f - prev_idx_f
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(span > 0, (idx - prev_idx_f) / span, 0.)
+    out = prev_val + frac * (next_val - prev_val)
+    return np.where(valid, x, out)
+
+
+def clean_matrix(diameter, validity=None, filt_type='low', fs=30., smooth_window=5, **kwargs):
+    """Batch version of the deblink, smooth, interpolate and filter steps for
+    a (records x samples) array of pupil diameters sampled at fs. Returns the
+    cleaned array and a dataframe with the fraction of samples per record
+    that were flagged as blinks and that were interpolated."""
+    diameter = np.array(diameter, dtype=np.float64)
+    diameter[diameter <= 0] = np.nan
+    blinks = get_blinks_matrix(diameter, validity=validity, **kwargs)
+    deblinked = np.where(blinks == 1, np.nan, diameter)
+    smoothed = smooth_matrix(deblinked, window=smooth_window)
+    interpolated = interpolate_matrix(smoothed)
+    cleaned = np.full_like(interpolated, np.nan)
+    hasdata = ~np.isnan(interpolated).any(axis=1)
+    if hasdata.any():
+        if filt_type == 'band':
+            cleaned[hasdata] = butter_bandpass_filter(interpolated[hasdata], fs=fs)
+        elif filt_type == 'low':
+            cleaned[hasdata] = butter_lowpass_filter(interpolated[hasdata], fs=fs)
+        else:
+            cleaned[hasdata] = interpolated[hasdata]
+    quality = pd.DataFrame({'BlinkPct': blinks.mean(axis=1),
+                            'InterpPct': np.isnan(smoothed).mean(axis=1)})
+    return cleaned, quality
+
     
 # def chap_deblink(raw_pupil, gradient, gradient_crit=4, z_outliers=2.5, zeros_outliers = 20,
 #                  data_rate=30, linear_interpolation=True, trial2show=0): 
@@ -224,7 +420,7 @@ def get_gradient(diameter, gradient_crit=4, n_timepoints=1):
 #     return clean_pupil, blinks
 
 
-def resamp_filt_data(df, bin_length='33ms', filt_type='band', string_cols=None):
+def resamp_filt_data(df, bin_length='33ms', filt_type='band', string_cols=None, method='bin'):
     """Takes dataframe of raw pupil data and performs the following steps:
         1. Smooths left and right pupil by taking average of 2 surrounding samples
         2. Averages left and right pupils
@@ -233,8 +429,18 @@ def resamp_filt_data(df, bin_length='33ms', filt_type='band', string_cols=None):
         5. Nearest neighbor interpolation for blinks, trial, and subject level data 
         6. Linear interpolation (bidirectional) of dilation data
         7. Applies Butterworth bandpass filter to remove high and low freq noise
-        8. If string columns should be retained, forward fill and merge with resamp data
+        8. If string columns should be retained, they are resampled along with
+           the numeric data as category codes. Each bin gets the last label at
+           or before the end of the bin.
+    If method is 'poly', data are instead decimated to the rate given by
+    bin_length with resamp_poly_filt_data, which is faster for high rate
+    recordings.
         """
+    if method == 'poly':
+        fs = 1. / pd.Timedelta(bin_length).total_seconds()
+        return resamp_poly_filt_data(df, fs=fs, filt_type=filt_type, string_cols=string_cols)
+    elif method != 'bin':
+        raise ValueError("Unknown resampling method: {}".format(method))
     # Smooth the pupil diameter data
     df['PupilDiameterLeftEyeSmooth'] = df.PupilDiameterLeftEye.rolling(5, center=True).mean()  
     df['PupilDiameterRightEyeSmooth'] = df.PupilDiameterRightEye.rolling(5, center=True).mean()  
@@ -246,8 +452,16 @@ def resamp_filt_data(df, bin_length='33ms', filt_type='band', string_cols=None):
     # Convert the time to a datetime object and set it as the index
     df['Timestamp'] = pd.to_datetime(df.Time, unit='s')
     df = df.set_index('Timestamp')
+    # Label columns are carried through resampling as category codes
+    string_cols = string_cols or []
+    labels = dict((col, df[col].astype('category')) for col in string_cols)
+    numdf = df.drop(columns=string_cols).select_dtypes(exclude=['object', 'category'])
+    codes = pd.DataFrame(dict((col, labels[col].cat.codes) for col in string_cols), index=df.index)
+    aggfuncs = dict([(col, 'mean') for col in numdf.columns] + [(col, 'last') for col in string_cols])
     # Resample the data to 100 ms bins
-    dfresamp = df.select_dtypes(exclude=['object']).resample(bin_length, closed='right', label='right').mean()
+    dfresamp = numdf.join(codes).resample(bin_length, closed='right', label='right').agg(aggfuncs)
+    coderesamp = dfresamp[string_cols]
+    dfresamp = dfresamp.drop(columns=string_cols)
     # Fill in missing values by interpolating from nearest value
     dfresamp['Subject'] = df.Subject[0]
     nearestcols = ['Subject','Session','CRESP','ACC','RT',
@@ -270,11 +484,144 @@ def resamp_filt_data(df, bin_length='33ms', filt_type='band', string_cols=None):
         dfresamp['PupilDiameterRightEyeFilt'] = butter_lowpass_filter(dfresamp.PupilDiameterRightEyeResamp)           
     dfresamp['Session'] = dfresamp['Session'].astype('int')    
     if string_cols:
-        stringdf = df[string_cols].resample(bin_length).ffill()
-        dfresamp = dfresamp.merge(stringdf, left_index=True, right_index=True)
+        # Drop bins that end after the last label, fill empty bins with label
+        # of previous bin
+        dfresamp = dfresamp.loc[dfresamp.index <= df.index[-1]]
+        coderesamp = coderesamp.loc[dfresamp.index].ffill().fillna(-1).astype(int)
+        for col in string_cols:
+            dfresamp[col] = pd.Categorical.from_codes(coderesamp[col], dtype=labels[col].dtype)
     return dfresamp
 
 
+def get_sample_rate(rttime):
+    """Estimate native sampling rate in Hz from RTTime in ms. Intervals more
+    than twice the median (dropped samples) are ignored."""
+    intervals = np.diff(np.asarray(rttime, dtype=np.float64))
+    intervals = intervals[intervals > 0]
+    return 1000. / intervals[intervals < 2 * np.median(intervals)].mean()
+
+
+def resamp_poly_filt_data(df, fs=30., filt_type='band', string_cols=None):
+    """Version of resamp_filt_data for high rate (e.g. 120 or 300Hz)
+    recordings. The native sampling rate is detected from RTTime and data are
+    decimated straight to fs, so cost scales with the output rate:
+        1. Averages left and right pupils
+        2. Linear interpolation of missing samples onto a uniform time grid
+           at the native rate
+        3. Anti-aliased polyphase decimation (resample_poly) of pupil and
+           blink data to fs
+        4. Remaining numeric and string columns are taken from the last
+           sample at or before each output time
+        5. Applies Butterworth filter designed for the output rate
+    Output has the same columns as resamp_filt_data. Smooth columns are
+    missing where more than half of the decimated samples were missing."""
+    fs_in = get_sample_rate(df.RTTime)
+    ratio = Fraction(fs / fs_in).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+    fs_out = fs_in * up / down
+    time = (df.RTTime.to_numpy(dtype=np.float64) - df.RTTime.iloc[0]) / 1000.
+    t_in = np.arange(int(np.floor(time[-1] * fs_in)) + 1) / fs_in
+    t_out = np.arange(int(np.ceil(len(t_in) * up / down))) / fs_out
+    # All other columns from the last sample at or before each output time
+    string_cols = string_cols or []
+    nearest = np.clip(np.searchsorted(time, t_out, side='right') - 1, 0, len(df) - 1)
+    numdf = df.drop(columns=string_cols).select_dtypes(exclude=['object', 'category'])
+    dfresamp = numdf.iloc[nearest].set_index(pd.to_datetime(t_out, unit='s'))
+    dfresamp.index.name = 'Timestamp'
+    dfresamp['Time'] = t_out
+    dfresamp['RTTime'] = df.RTTime.iloc[0] + t_out * 1000.
+    dfresamp['Subject'] = df.Subject.iloc[0]
+    # Decimate blinks and round to nearest whole number
+    for col in ['BlinksLeft','BlinksRight','BlinksLR']:
+        blinks = resample_poly(np.interp(t_in, time, df[col].to_numpy(dtype=np.float64)), up, down, padtype='line')
+        dfresamp[col] = np.clip(blinks, 0, 1).round()
+    # Decimate pupil diameter after interpolating over missing samples
+    pupil = {'PupilDiameterLRSmooth': df[['PupilDiameterLeftEye','PupilDiameterRightEye']].mean(axis=1, skipna=True),
+             'PupilDiameterLeftEyeSmooth': df.PupilDiameterLeftEye,
+             'PupilDiameterRightEyeSmooth': df.PupilDiameterRightEye}
+    for col, diameter in pupil.items():
+        diameter = diameter.to_numpy(dtype=np.float64)
+        valid = ~np.isnan(diameter)
+        if not valid.any():
+            dfresamp[col] = dfresamp[col.replace('Smooth','Resamp')] = np.nan
+            continue
+        resamp = resample_poly(np.interp(t_in, time[valid], diameter[valid]), up, down, padtype='line')
+        missing = resample_poly(np.interp(t_in, time, (~valid).astype(np.float64)), up, down, padtype='line')
+        dfresamp[col] = np.where(missing > .5, np.nan, resamp)
+        dfresamp[col.replace('Smooth','Resamp')] = resamp
+    # Filter the pupil data
+    if filt_type=='band':
+        dfresamp['PupilDiameterLRFilt'] = butter_bandpass_filter(dfresamp.PupilDiameterLRResamp, fs=fs_out)
+        dfresamp['PupilDiameterLeftEyeFilt'] = butter_bandpass_filter(dfresamp.PupilDiameterLeftEyeResamp, fs=fs_out)
+        dfresamp['PupilDiameterRightEyeFilt'] = butter_bandpass_filter(dfresamp.PupilDiameterRightEyeResamp, fs=fs_out)
+    elif filt_type=='low':
+        dfresamp['PupilDiameterLRFilt'] = butter_lowpass_filter(dfresamp.PupilDiameterLRResamp, fs=fs_out)
+        dfresamp['PupilDiameterLeftEyeFilt'] = butter_lowpass_filter(dfresamp.PupilDiameterLeftEyeResamp, fs=fs_out)
+        dfresamp['PupilDiameterRightEyeFilt'] = butter_lowpass_filter(dfresamp.PupilDiameterRightEyeResamp, fs=fs_out)
+    dfresamp['Session'] = dfresamp['Session'].astype('int')
+    for col in string_cols:
+        labels = df[col].astype('category')
+        dfresamp[col] = pd.Categorical.from_codes(labels.cat.codes.to_numpy()[nearest], dtype=labels.dtype)
+    # Drop sample at time 0 so first sample is at the same time as the first
+    # right labelled bin of resamp_filt_data
+    return dfresamp.iloc[1:]
+
+
+def get_values(df, key):
+    """Values of a column, or of an index level if there is no such column."""
+    if key in df.columns:
+        return df[key].to_numpy()
+    return df.index.get_level_values(key).to_numpy()
+
+
+def get_baselines(df, trial, phasecol, phase, duration=None, align='last',
+                  time='Timestamp', signal='PupilDiameterLRFilt', blinks='BlinksLR'):
+    """Baseline pupil size and fraction of blinks for all trials at once.
+    The baseline window is all samples of each trial where phasecol equals
+    phase. If duration (e.g. '250ms') is given, the window is restricted to
+    the last or first duration of the phase, as selected by align. This
+    matches pandas last() and first() applied to each trial. trial and time
+    may be columns or index levels. Returns dataframe indexed by trial with
+    columns Baseline, BaselineBlinks and BaselineSD (standard deviation of
+    signal in the window)."""
+    trials = get_values(df, trial)
+    inwindow = get_values(df, phasecol) == phase
+    if duration is not None:
+        times = pd.Series(get_values(df, time))
+        offset = pd.Timedelta(duration)
+        phasetimes = times.where(inwindow)
+        if align == 'last':
+            inwindow &= (times > phasetimes.groupby(trials).transform('max') - offset).to_numpy()
+        elif align == 'first':
+            inwindow &= (times < phasetimes.groupby(trials).transform('min') + offset).to_numpy()
+        else:
+            raise ValueError("align must be 'last' or 'first', not {}".format(align))
+    windowdf = pd.DataFrame({'Baseline': get_values(df, signal)[inwindow],
+                             'BaselineBlinks': get_values(df, blinks)[inwindow]})
+    grouped = windowdf.groupby(trials[inwindow], sort=False)
+    baselines = grouped.mean()
+    baselines['BaselineSD'] = grouped['Baseline'].std()
+    baselines.index.name = trial
+    return baselines
+
+
+def baseline_correct(df, trial, phasecol, phase, max_blinks=None,
+                     signal='PupilDiameterLRFilt', blinks='BlinksLR', **kwargs):
+    """Add Baseline and Dilation (signal - Baseline) columns to segmented data
+    of all trials. Baseline windows are defined as in get_baselines. Baselines
+    with more than max_blinks fraction of blink samples are set to missing.
+    BaselineBlinks and BaselineSD are added for quality scoring."""
+    baselines = get_baselines(df, trial, phasecol, phase, signal=signal,
+                              blinks=blinks, **kwargs)
+    if max_blinks is not None:
+        baselines.loc[baselines.BaselineBlinks > max_blinks, 'Baseline'] = np.nan
+    baselines = baselines.reindex(get_values(df, trial))
+    for col in ['Baseline', 'BaselineBlinks', 'BaselineSD']:
+        df[col] = baselines[col].to_numpy()
+    df['Dilation'] = df[signal] - df['Baseline']
+    return df
+
+
 # Convert 'Timestamp' to timedelta relative to the Unix epoch
 def convert_timestamp(ts):
     """Converts timestamp to timedelta relative to the Unix epoch"""
@@ -342,8 +689,9 @@ def plot_qc(dfresamp, infile):
     signal = dfresamp.PupilDiameterLRResamp.values
     signal_bp = dfresamp.PupilDiameterLRFilt.values
     blinktimes = dfresamp.BlinksLR.values
-    plt.plot(range(len(signal)), signal, sns.xkcd_rgb["pale red"], 
-         range(len(signal_bp)), signal_bp+np.nanmean(signal), sns.xkcd_rgb["denim blue"], 
-         blinktimes, sns.xkcd_rgb["amber"], lw=1)
-    plt.savefig(outfile)
-    plt.close()
+    fig = Figure()
+    ax = fig.subplots()
+    ax.plot(range(len(signal)), signal, sns.xkcd_rgb["pale red"], 
+            range(len(signal_bp)), signal_bp+np.nanmean(signal), sns.xkcd_rgb["denim blue"], 
+            blinktimes, sns.xkcd_rgb["amber"], lw=1)
+    fig.savefig(outfile)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Cached index of raw pupil data files.
+
+Walks a raw data tree laid out as
+    Raw Pupil Data/.../Timepoint <n>/(Gaze|Edat) data/<Task>-<ID>-<n>.<ext>
+and stores every raw file in an SQLite database with its VETSAID, session,
+timepoint, task and type (gaze or edat). Directory modification times are
+stored as well. A directory's mtime only changes when entries are added to
+or removed from it, so on later runs unchanged directories are not listed
+again. Only their subdirectories are checked, and the work list is returned
+from the index.
+
+Processed outputs are expected in the folder given by
+pupil_utils.get_proc_outdir and named <Task>_<VETSAID>_ProcessedPupil.csv.
+Whether they exist is checked when the work list is requested, with one
+directory listing per output folder.
+
+Usage:
+    python raw_index.py <index file> <raw data dir> [--task T] [--unprocessed]
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import re
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+import pupil_utils
+
+# Extensions of raw files and their type if not given by parent folder
+RAW_EXTENSIONS = {'.gazedata': 'gaze', '.xlsx': 'gaze', '.edat2': 'edat', '.txt': 'edat'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+CREATE TABLE IF NOT EXISTS rawfiles (
+    path TEXT PRIMARY KEY, dir TEXT, vetsaid TEXT, session INTEGER,
+    timepoint INTEGER, task TEXT, type TEXT);
+CREATE INDEX IF NOT EXISTS idx_dirs_parent ON dirs (parent);
+CREATE INDEX IF NOT EXISTS idx_rawfiles_dir ON rawfiles (dir);
+"""
+
+
+def connect(dbfile):
+    """Open index database, creating tables if needed."""
+    con = sqlite3.connect(dbfile)
+    con.executescript(SCHEMA)
+    return con
+
+
+def parse_raw_file(path):
+    """Return (vetsaid, session, timepoint, task, type) of a raw file, or None
+    if it is not a raw pupil file."""
+    fname, ext = os.path.splitext(os.path.basename(path))
+    if ext.lower() not in RAW_EXTENSIONS:
+        return None
+    try:
+        vetsaid = pupil_utils.get_fname_vetsaid(path)
+    except Exception:
+        return None
+    session = 1 if vetsaid.endswith('A') else 2
+    timepoint = None
+    if re.search(r'Timepoint \d+', path, re.IGNORECASE):
+        timepoint = int(pupil_utils.get_tpfolder(path))
+    task = re.split(r'[-_ ]', fname)[0]
+    typematch = re.search(r'(Gaze|Edat) data', os.path.dirname(path), re.IGNORECASE)
+    rawtype = typematch.group(1).lower() if typematch else RAW_EXTENSIONS[ext.lower()]
+    return vetsaid, session, timepoint, task, rawtype
+
+
+def scan_dir(con, path, mtime):
+    """List directory and replace its entries in the index. Returns list of
+    subdirectories."""
+    subdirs, rows = [], []
+    for entry in os.scandir(path):
+        if entry.is_dir():
+            subdirs.append(entry.path)
+        elif entry.is_file():
+            info = parse_raw_file(entry.path)
+            if info is not None:
+                rows.append((entry.path, path) + info)
+    with con:
+        con.execute('DELETE FROM rawfiles WHERE dir = ?', (path,))
+        con.executemany('INSERT INTO rawfiles VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        # Remove subdirectories that no longer exist, with everything below them
+        cached = [p for p, in con.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+        for removed in set(cached) - set(subdirs):
+            remove_tree(con, removed)
+        con.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                    (path, os.path.dirname(path), mtime))
+        con.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)',
+                        ((d, path) for d in subdirs))
+    return subdirs
+
+
+def below_pattern(path):
+    """LIKE pattern (with escape character !) matching paths below path."""
+    escaped = path.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    return os.path.join(escaped, '%')
+
+
+def remove_tree(con, path):
+    """Remove directory and everything below it from the index."""
+    below = below_pattern(path)
+    con.execute("DELETE FROM rawfiles WHERE dir = ? OR dir LIKE ? ESCAPE '!'", (path, below))
+    con.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '!'", (path, below))
+
+
+def update_index(dbfile, rawdir):
+    """Walk raw data tree, listing only directories that are new or whose
+    mtime changed. Returns number of directories scanned."""
+    con = connect(dbfile)
+    rawdir = os.path.abspath(rawdir)
+    cached = dict(con.execute('SELECT path, mtime FROM dirs'))
+    children = {}
+    for path, parent in con.execute('SELECT path, parent FROM dirs'):
+        children.setdefault(parent, []).append(path)
+    nscanned = 0
+    stack = [rawdir]
+    while stack:
+        path = stack.pop()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            with con:
+                remove_tree(con, path)
+            continue
+        if cached.get(path) == mtime:
+            stack.extend(children.get(path, []))
+        else:
+            stack.extend(scan_dir(con, path, mtime))
+            nscanned += 1
+    con.close()
+    return nscanned
+
+
+def get_outfile(rawfile, task, vetsaid):
+    """Expected processed output of a raw file."""
+    return os.path.join(pupil_utils.get_proc_outdir(rawfile),
+                        '{0}_{1}_ProcessedPupil.csv'.format(task, vetsaid))
+
+
+def get_worklist(dbfile, rawdir=None, task=None, rawtype='gaze', unprocessed=False):
+    """Raw files in the index, optionally only those under rawdir, of a task
+    and type, or without processed output. Returns dataframe with path,
+    vetsaid, session, timepoint, task, type, outfile and processed."""
+    sql, params = ['1=1'], []
+    if rawdir is not None:
+        sql.append("(dir = ? OR dir LIKE ? ESCAPE '!')")
+        rawdir = os.path.abspath(rawdir)
+        params.extend([rawdir, below_pattern(rawdir)])
+    if task is not None:
+        sql.append('lower(task) = lower(?)')
+        params.append(task)
+    if rawtype is not None:
+        sql.append('type = ?')
+        params.append(rawtype)
+    con = connect(dbfile)
+    files = pd.read_sql_query('SELECT path, vetsaid, session, timepoint, task, type '
+                              'FROM rawfiles WHERE ' + ' AND '.join(sql) +
+                              ' ORDER BY path', con, params=params)
+    con.close()
+    files['outfile'] = [get_outfile(p, t, v) for p, t, v in
+                        zip(files.path, files.task, files.vetsaid)]
+    # One listing per output folder instead of a stat per file
+    listings = {}
+    for outdir in set(os.path.dirname(f) for f in files.outfile):
+        listings[outdir] = set(os.listdir(outdir)) if os.path.isdir(outdir) else set()
+    files['processed'] = np.array([os.path.basename(f) in listings[os.path.dirname(f)]
+                                   for f in files.outfile], dtype=bool)
+    if unprocessed:
+        files = files[~files.processed]
+    return files.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Update cached index of raw
+                                     pupil files and print work list.""")
+    parser.add_argument('dbfile', help='SQLite index file (created if missing).')
+    parser.add_argument('rawdir', help='Raw data directory to scan.')
+    parser.add_argument('--task', default=None, help='Only list files of this task.')
+    parser.add_argument('--unprocessed', action='store_true',
+                        help='Only list files without processed output.')
+    args = parser.parse_args()
+    nscanned = update_index(args.dbfile, args.rawdir)
+    print('Scanned {} new or changed directories'.format(nscanned))
+    worklist = get_worklist(args.dbfile, args.rawdir, task=args.task,
+                            unprocessed=args.unprocessed)
+    for path in worklist.path:
+        print(path)
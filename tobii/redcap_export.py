@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Delta export of wide REDCap tables.
+
+The last exported wide table is kept in the output directory as
+<prefix>_REDCap_last.csv. On each export the new table is compared with it
+and only records and fields that were added or changed by more than a
+numeric tolerance are written to an import file:
+    <prefix>_REDCap_delta_<time>.csv: record ID and changed fields. Cells of
+        fields that did not change for a record are left blank, so they are
+        not overwritten on import.
+    <prefix>_REDCap_changes_<time>.csv: one row per changed value with the
+        old and new value and the type of change (added, changed, removed).
+Values that became missing are only listed in the change log, since blank
+cells are skipped on a normal REDCap import.
+
+<time> is the date and time of the export (YYYY-MM-DD_HHMMSS). Existing
+delta files are never overwritten. Every exported table is also kept as
+<prefix>_REDCap_state_<time>.csv, and _last is only replaced after the delta
+and change log are written, so an export can be redone against an earlier
+state by copying its state file to _last.
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import numpy as np
+import pandas as pd
+
+
+def get_state_file(outdir, prefix):
+    return os.path.join(outdir, prefix + '_REDCap_last.csv')
+
+
+def get_changes(new, old, key='subject', atol=1e-6):
+    """Compare new and old wide tables indexed by record. Returns boolean
+    dataframe (records of new x fields) of values that were added or
+    changed, and long dataframe logging every change."""
+    new = new.set_index(key)
+    old = old.set_index(key).reindex(index=new.index, columns=new.columns)
+    changed = pd.DataFrame(False, index=new.index, columns=new.columns)
+    for col in new.columns:
+        newvals, oldvals = new[col], old[col]
+        newnull, oldnull = newvals.isnull().to_numpy(), oldvals.isnull().to_numpy()
+        if pd.api.types.is_numeric_dtype(newvals) and pd.api.types.is_numeric_dtype(oldvals):
+            with np.errstate(invalid='ignore'):
+                differs = np.abs(newvals.to_numpy(dtype=np.float64) - oldvals.to_numpy(dtype=np.float64)) > atol
+        else:
+            differs = (newvals.astype(str) != oldvals.astype(str)).to_numpy()
+        changed[col] = (newnull != oldnull) | (differs & ~newnull & ~oldnull)
+    # Log of changed values
+    stacked = changed.stack()
+    stacked = stacked[stacked]
+    records = stacked.index.get_level_values(0)
+    fields = stacked.index.get_level_values(1)
+    oldvals = [old.at[rec, field] for rec, field in zip(records, fields)]
+    newvals = [new.at[rec, field] for rec, field in zip(records, fields)]
+    changelog = pd.DataFrame({key: records, 'field': fields,
+                              'old': oldvals, 'new': newvals})
+    changelog['change'] = np.where(changelog.old.isnull(), 'added',
+                                   np.where(changelog.new.isnull(), 'removed', 'changed'))
+    return changed, changelog
+
+
+def get_delta(new, changed, key='subject'):
+    """Records and fields with values to import. Unchanged and removed values
+    are left blank."""
+    values = new.set_index(key).where(changed)
+    values = values.loc[values.notnull().any(axis=1), values.notnull().any(axis=0)]
+    return values.reset_index()
+
+
+def export_delta(wide, outdir, prefix, key='subject', atol=1e-6, tstamp=None):
+    """Write delta import file and change log of wide table relative to the
+    last export, then store wide table as the last export. If there is no
+    previous export, all records are included. Raises IOError if delta
+    files of tstamp already exist. Returns delta dataframe."""
+    if tstamp is None:
+        tstamp = pd.Timestamp.now().strftime("%Y-%m-%d_%H%M%S")
+    delta_outfile = os.path.join(outdir, prefix + '_REDCap_delta_' + tstamp + '.csv')
+    changes_outfile = os.path.join(outdir, prefix + '_REDCap_changes_' + tstamp + '.csv')
+    history_file = os.path.join(outdir, prefix + '_REDCap_state_' + tstamp + '.csv')
+    for outfile in [delta_outfile, changes_outfile, history_file]:
+        if os.path.exists(outfile):
+            raise IOError('{0} already exists, not overwriting delta export'.format(outfile))
+    state_file = get_state_file(outdir, prefix)
+    if os.path.exists(state_file):
+        old = pd.read_csv(state_file, dtype={key: str})
+    else:
+        old = pd.DataFrame(columns=wide.columns)
+    wide = wide.astype({key: str})
+    changed, changelog = get_changes(wide, old, key=key, atol=atol)
+    delta = get_delta(wide, changed, key=key)
+    print('Writing {0} changed records to {1}'.format(len(delta), delta_outfile))
+    delta.to_csv(delta_outfile, index=False)
+    changelog.to_csv(changes_outfile, index=False)
+    # Keep every exported state and replace _last only once outputs exist
+    wide.to_csv(history_file, index=False)
+    tmp_file = state_file + '.tmp'
+    wide.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, state_file)
+    return delta
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Processes all Tobii tasks of testing sessions in one pass. Each raw gazedata
+file is read once and the preprocessing shared by all tasks (VETSAID check
+and numeric conversion, pupil_utils.prep_gazedata) is run once. The prepared
+data is then passed to the handler of each task found in the file, which
+writes the same outputs as digitspan_proc_subject.py and
+fluency_proc_subject.py.
+
+Tasks are identified from the columns of the file. If an export contains
+more than one task, each handler only receives the rows of its own task.
+
+Reading and preparing a file once only saves work for exports that hold
+more than one task. With per-task exports (DigitSpan-*.gazedata,
+Fluency-*.gazedata) each file is read and prepared once anyway, so the
+driver costs the same as running the task scripts. By default blinks are
+detected per trial inside each handler, as in the task scripts. With
+--shared-deblink, blinks are detected once on the whole file and the
+handlers skip this step. This also helps per-task exports. Outputs then
+differ slightly from the task scripts, because samples next to trial
+boundaries and fixation periods are part of the blink detection.
+
+Usage:
+    python session_proc_subject.py <raw pupil files> -o <output dir> [--shared-deblink]
+        [--blink-method {heuristic,velocity}]
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import argparse
+import pupil_utils
+import pupil_io
+import digitspan_proc_subject
+import fluency_proc_subject
+try:
+    # for Python2
+    import Tkinter as tkinter
+    import tkFileDialog as filedialog
+except ImportError:
+    # for Python3
+    import tkinter
+    from tkinter import filedialog
+
+# Task name, column that identifies rows of the task, and task handler
+TASK_HANDLERS = [('DigitSpan', 'DigitList', digitspan_proc_subject.proc_task),
+                 ('Fluency', 'Condition', fluency_proc_subject.proc_task)]
+
+
+def get_task_data(df):
+    """Find tasks in prepared session data. Returns list of (task, handler,
+    data). Data is only split by task if more than one task is present."""
+    found = [(task, col, handler) for task, col, handler in TASK_HANDLERS
+             if col in df.columns and df[col].notnull().any()]
+    if len(found) == 1:
+        task, col, handler = found[0]
+        return [(task, handler, df)]
+    return [(task, handler, df.loc[df[col].notnull()].reset_index(drop=True))
+            for task, col, handler in found]
+
+
+def proc_session(filelist, outdir, plot=True, resample='bin', compact=False,
+                 shared_deblink=False, blink_method='heuristic'):
+    """Process every task in each raw file. Files are read ahead and outputs
+    written on background threads as in the single task scripts. Set
+    shared_deblink=True to detect blinks once on the whole file instead of
+    per trial in each handler. blink_method is the method of
+    pupil_utils.deblink."""
+    with pupil_io.OutputWriter() as writer:
+        for fname, df in pupil_io.prefetch(filelist, pupil_io.read_gazedata):
+            print('Processing {}'.format(fname))
+            subid = pupil_utils.prep_gazedata(df, fname)
+            if shared_deblink:
+                df = pupil_utils.deblink(df, method=blink_method)
+            tasks = get_task_data(df)
+            if not tasks:
+                print('No known task found in {}'.format(fname))
+            for task, handler, taskdf in tasks:
+                handler(taskdf, subid, outdir, writer, plot=plot, resample=resample,
+                        compact=compact, deblinked=shared_deblink, blink_method=blink_method)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Process digit span and
+                                     fluency data of testing sessions, reading
+                                     each raw file once. If no files are given,
+                                     they are chosen with a dialog.""")
+    parser.add_argument('filelist', nargs='*', help='Raw pupil files (*.gazedata).')
+    parser.add_argument('-o', '--outdir', help='Folder to save processed data.')
+    parser.add_argument('--no-plot', dest='plot', action='store_false',
+                        help='Skip QC plots (can be rendered later with pupil_qc.py).')
+    parser.add_argument('--resample', choices=['bin', 'poly'], default='bin',
+                        help='Resampling method (poly for high rate recordings).')
+    parser.add_argument('--compact', action='store_true',
+                        help='Write outputs with compact float32/categorical schema.')
+    parser.add_argument('--shared-deblink', action='store_true',
+                        help='Detect blinks once per file instead of per trial (faster, not identical).')
+    parser.add_argument('--blink-method', choices=['heuristic', 'velocity'], default='heuristic',
+                        help='Blink detection method (see pupil_utils.deblink).')
+    args = parser.parse_args()
+    if not args.filelist or not args.outdir:
+        root = tkinter.Tk()
+        root.withdraw()
+    if not args.filelist:
+        # Select files to process
+        args.filelist = list(filedialog.askopenfilenames(parent=root,
+                                 title='Choose pupil gazedata files to process'))
+    if not args.outdir:
+        # Select folder to save processed data
+        args.outdir = filedialog.askdirectory(parent=root,
+                                 title='Choose folder to save processed data')
+    filelist = [os.path.abspath(f) for f in args.filelist]
+    proc_session(filelist, args.outdir, plot=args.plot, resample=args.resample,
+                 compact=args.compact, shared_deblink=args.shared_deblink,
+                 blink_method=args.blink_method)